@@ -0,0 +1,110 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_audio_path.py — temp-file audio path vs. the in-memory one (server/audio.py)
+#
+#   python bench/bench_audio_path.py [--requests 200] [--parts 6]
+#
+# Models are replaced by a synthetic generator so only the audio plumbing is measured:
+#   STT side: upload bytes -> float32 16 kHz array the decoder hands to Whisper
+#   TTS side: N SSML parts + pauses -> one PCM_16 WAV
+# Reports wall time, Python allocation peak per request (tracemalloc), file-system audit
+# events (open/remove/...) and, on Linux, read/write syscalls from /proc/self/io — all per request.
+import argparse, io, os, sys, tempfile, time, tracemalloc
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from audio import decode_audio, encode_wav_segments, resample, WHISPER_SR  # noqa: E402
+
+FS_EVENTS = {"open", "os.remove", "os.rename", "os.unlink", "os.truncate", "os.listdir", "os.mkdir"}
+_fs_events = 0
+
+def _audit(event, args):
+    global _fs_events
+    if event in FS_EVENTS:
+        _fs_events += 1
+
+def proc_io():
+    try:
+        with open("/proc/self/io") as f:
+            vals = dict(line.split(": ") for line in f.read().splitlines())
+        return int(vals["syscr"]), int(vals["syscw"])
+    except OSError:
+        return 0, 0
+
+# ── legacy paths (what main.py did before) ───────────────────────────────────
+def stt_legacy(upload: bytes) -> np.ndarray:
+    with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as tmp:
+        tmp.write(upload); tmp.flush()
+        audio, sr = sf.read(tmp.name, dtype="float32")  # stands in for Whisper reading the path
+    return resample(audio, sr, WHISPER_SR)  # Whisper resamples internally too
+
+def tts_legacy(parts, sr=24000) -> bytes:
+    waves = []
+    for audio, pause_ms in parts:
+        with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as fout:
+            sf.write(fout.name, audio, sr)  # stands in for tts_to_file
+            a, sr = sf.read(fout.name, dtype="float32")
+            waves.append(a)
+        if pause_ms > 0:
+            waves.append(np.zeros(int((pause_ms / 1000.0) * sr), dtype="float32"))
+    audio = np.concatenate(waves)
+    with io.BytesIO() as buf:
+        sf.write(buf, audio, sr, format="WAV", subtype="PCM_16")
+        return buf.getvalue()
+
+# ── in-memory paths (main.py now) ────────────────────────────────────────────
+def stt_inmem(upload: bytes) -> np.ndarray:
+    return decode_audio(upload)
+
+def tts_inmem(parts, sr=24000) -> bytes:
+    return encode_wav_segments([(a, int((ms / 1000.0) * sr)) for a, ms in parts], sr)
+
+def measure(name, fn, arg, n):
+    fn(arg)  # warm caches / imports
+    tracemalloc.start()
+    ev0, (r0, w0) = _fs_events, proc_io()
+    t0 = time.perf_counter()
+    peak_sum = 0
+    for _ in range(n):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(arg)
+        peak_sum += tracemalloc.get_traced_memory()[1] - base
+    dt = time.perf_counter() - t0
+    tracemalloc.stop()
+    r1, w1 = proc_io()
+    return {"name": name, "ms": 1000 * dt / n, "peak_kib": peak_sum / n / 1024,
+            "fs_events": (_fs_events - ev0) / n, "read_sys": (r1 - r0) / n, "write_sys": (w1 - w0) / n}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=200)
+    ap.add_argument("--parts", type=int, default=6, help="SSML parts per TTS reply")
+    ap.add_argument("--upload-seconds", type=float, default=4.0)
+    ap.add_argument("--upload-sr", type=int, default=48000)
+    args = ap.parse_args()
+    sys.addaudithook(_audit)
+
+    rng = np.random.default_rng(0)
+    upload_sr = args.upload_sr
+    with io.BytesIO() as buf:
+        sf.write(buf, (0.1 * rng.standard_normal(int(upload_sr * args.upload_seconds))).astype("float32"),
+                 upload_sr, format="WAV", subtype="PCM_16")
+        upload = buf.getvalue()
+    parts = [((0.1 * rng.standard_normal(24000)).astype("float32"), 300) for _ in range(args.parts)]
+
+    rows = [
+        measure("stt legacy (tempfile)", stt_legacy, upload, args.requests),
+        measure("stt in-memory", stt_inmem, upload, args.requests),
+        measure("tts legacy (tempfile)", tts_legacy, parts, args.requests),
+        measure("tts in-memory", tts_inmem, parts, args.requests),
+    ]
+    print(f"{'path':<24}{'ms/req':>9}{'peak KiB':>11}{'fs events':>11}{'read()':>9}{'write()':>9}")
+    for r in rows:
+        print(f"{r['name']:<24}{r['ms']:>9.2f}{r['peak_kib']:>11.0f}{r['fs_events']:>11.1f}"
+              f"{r['read_sys']:>9.1f}{r['write_sys']:>9.1f}")
+
+if __name__ == "__main__":
+    main()
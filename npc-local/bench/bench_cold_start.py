@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_cold_start.py — time from process start to /healthz and /readyz
+#
+#   python bench/bench_cold_start.py [--runs 3] [--port 8765] [--warmup stt,tts]
+#
+# Starts `uvicorn main:app` from server/ with the current environment (plus WARMUP), polls
+# /healthz (process up, routes served) and /readyz (warm-up finished) and prints both per run,
+# together with the per-component load/warm timings the server reports. Run it inside the
+# server image (or any environment with the models installed and downloaded).
+import argparse, json, os, subprocess, sys, time, urllib.error, urllib.request
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+def get(url: str):
+    try:
+        with urllib.request.urlopen(url, timeout=2) as r:
+            return r.status, json.loads(r.read() or b"null")
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b"null")
+    except (urllib.error.URLError, OSError):
+        return None, None
+
+def one_run(port: int, warmup: str, timeout_s: float):
+    env = dict(os.environ, WARMUP=warmup)
+    t0 = time.monotonic()
+    proc = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+                            cwd=SERVER, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    healthy = ready = None
+    report = None
+    try:
+        while time.monotonic() - t0 < timeout_s and proc.poll() is None:
+            if healthy is None and get(f"http://127.0.0.1:{port}/healthz")[0] == 200:
+                healthy = time.monotonic() - t0
+            if healthy is not None:
+                status, report = get(f"http://127.0.0.1:{port}/readyz")
+                if status == 200 or (report and any(c["state"] == "failed" for c in report["components"].values())):
+                    ready = time.monotonic() - t0 if status == 200 else None
+                    break
+            time.sleep(0.05)
+    finally:
+        proc.terminate()
+        try: proc.wait(10)
+        except subprocess.TimeoutExpired: proc.kill()
+    return healthy, ready, report
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--warmup", default="stt,tts")
+    ap.add_argument("--timeout", type=float, default=600)
+    args = ap.parse_args()
+
+    fmt = lambda v: f"{v:8.2f}" if v is not None else "       -"
+    print(f"{'run':<5}{'healthz_s':>10}{'readyz_s':>10}{'server_s':>10}  components")
+    for i in range(args.runs):
+        healthy, ready, report = one_run(args.port, args.warmup, args.timeout)
+        comps = ", ".join(f"{n}:{c['state']} load={c.get('load_s', '-')} warm={c.get('warm_s', '-')}"
+                          for n, c in ((report or {}).get("components") or {}).items())
+        server_s = (report or {}).get("cold_start_s")
+        print(f"{i:<5}{fmt(healthy):>10}{fmt(ready):>10}{fmt(server_s):>10}  {comps}")
+
+if __name__ == "__main__":
+    main()
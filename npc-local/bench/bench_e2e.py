@@ -0,0 +1,270 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_e2e.py — end-to-end latency/throughput of the real app on stub models
+#
+#   python bench/bench_e2e.py                                   # all scenarios, concurrency 8
+#   python bench/bench_e2e.py --scenarios reply,reply.wav --concurrency 16 --requests 200
+#   python bench/bench_e2e.py --save-baseline bench/baselines/e2e.json
+#   python bench/bench_e2e.py --baseline bench/baselines/e2e.json [--tolerance 0.15]   # exit 1 on regression
+#   python bench/bench_e2e.py --env STT_WORKERS=4 --env BENCH_TTS_MS=120                  # server settings
+#   python bench/bench_e2e.py --scenarios reply.wav --audio-format opus                   # reply encoding
+#
+# Starts the stub Ollama (in this process) and `stub_models.py app` (uvicorn + main.app with
+# stand-ins for WhisperModel and the XTTS TTS object, see stub_models.py for the delay knobs) in
+# a scratch directory, waits for /readyz, creates one NPC and then drives each scenario with
+# `--concurrency` clients, every client its own session sending requests back to back:
+#
+#   stt        POST /stt                 2 s clip
+#   chat       POST /chat                one user message per request
+#   reply      POST /npcs/{id}/reply     clip -> STT -> LLM -> TTS, base64 WAV in JSON
+#   reply.wav  POST /npcs/{id}/reply.wav same, WAV body
+#
+# Per scenario: p50/p95/p99 latency, requests/s, errors, server peak RSS (VmHWM, reset before each
+# scenario where the kernel allows it) and the mean Server-Timing stages. The synthetic model
+# delays dominate the absolute numbers; what a regression shows is the server's own overhead or
+# lost concurrency around them. CPU only, nothing leaves 127.0.0.1.
+import argparse, asyncio, io, json, os, re, shutil, socket, subprocess, sys, tempfile, time
+
+import httpx
+import numpy as np
+import soundfile as sf
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH)
+from stub_models import start_ollama  # noqa: E402
+
+SCENARIOS = ("stt", "chat", "reply", "reply.wav")
+# compared against a baseline: (metric, higher_is_worse)
+GATED = (("p50_ms", True), ("p95_ms", True), ("rps", False))
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wav_bytes(seconds: float, sr: int, seed: int = 0) -> bytes:
+    """Speech-ish test signal: a few harmonics under a syllable-rate envelope, plus a little noise."""
+    t = np.arange(int(seconds * sr)) / sr
+    rng = np.random.default_rng(seed)
+    voice = sum(np.sin(2 * np.pi * f * t) / k for k, f in enumerate((140, 280, 420, 560), 1))
+    env = 0.5 * (1 + np.sin(2 * np.pi * 4 * t))
+    audio = (0.2 * env * voice + 0.01 * rng.standard_normal(len(t))).astype("float32")
+    buf = io.BytesIO()
+    sf.write(buf, audio, sr, format="WAV", subtype="PCM_16")
+    return buf.getvalue()
+
+# ── server process ──────────────────────────────────────────────────────────
+def start_server(workdir: str, port: int, ollama_port: int, extra_env):
+    voices = os.path.join(workdir, "voices")
+    os.makedirs(voices)
+    with open(os.path.join(voices, "bench_voice.wav"), "wb") as f:
+        f.write(wav_bytes(3.0, 24000, seed=1))
+    env = dict(os.environ,
+               OLLAMA_URL=f"http://127.0.0.1:{ollama_port}", DB_PATH=os.path.join(workdir, "npcs.db"),
+               VOICES_DIR=voices, VOICES_STORAGE=os.path.join(workdir, "storage"),
+               AUDIO_CACHE_DIR=os.path.join(workdir, "tts_cache"), WARMUP="stt,tts,llm",
+               WARMUP_VOICE="bench_voice.wav", MODEL_HOST="", PYTHONUNBUFFERED="1")
+    env.update(extra_env)
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    proc = subprocess.Popen([sys.executable, os.path.join(BENCH, "stub_models.py"), "app", "--port", str(port)],
+                            env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc, log
+
+async def wait_ready(client: httpx.AsyncClient, proc, timeout_s: float):
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            r = await client.get("/readyz")
+            if r.status_code == 200: return r.json()
+            if any(c["state"] == "failed" for c in r.json()["components"].values()):
+                raise RuntimeError(f"warm-up failed: {r.json()}")
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("server not ready in time")
+
+def read_status_kb(pid: int, field: str):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"): return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f: f.write("5")  # resets VmHWM to the current RSS
+        return True
+    except OSError:
+        return False
+
+# ── load ────────────────────────────────────────────────────────────────────
+def make_request(scenario: str, npc_id: int, session: str, i: int, clip: bytes, reply_fields):
+    if scenario == "stt":
+        return "/stt", {"files": {"file": ("clip.wav", clip, "audio/wav")}, "data": {"lang": "en"}}
+    if scenario == "chat":
+        messages = [{"role": "user", "content": f"Question {i}: what do you have for sale today?"}]
+        if i == 0: messages.insert(0, {"role": "system", "content": "You are Bram, a terse dockside merchant."})
+        return "/chat", {"json": {"session_id": session, "messages": messages}}
+    return f"/npcs/{npc_id}/{scenario}", {"files": {"file": ("clip.wav", clip, "audio/wav")},
+                                         "data": dict(reply_fields, session_id=session, lang="en")}
+
+def parse_server_timing(value: str):
+    out = {}
+    for part in value.split(","):
+        m = re.match(r"\s*([\w.-]+);dur=([\d.]+)", part)
+        if m: out[m.group(1)] = float(m.group(2))
+    return out
+
+async def run_scenario(client, scenario, npc_id, clip, concurrency, requests, warmup_requests, tag, reply_fields):
+    latencies, errors, stages = [], [], {}
+
+    async def worker(w: int, count: int, record: bool):
+        session = f"{tag}-{scenario}-{w}-{'m' if record else 'w'}"
+        for i in range(count):
+            path, kwargs = make_request(scenario, npc_id, session, i, clip, reply_fields)
+            t = time.perf_counter()
+            try:
+                r = await client.post(path, **kwargs)
+                await r.aread()
+            except httpx.HTTPError as e:
+                if record: errors.append(f"{type(e).__name__}: {e}")
+                continue
+            elapsed = time.perf_counter() - t
+            if not record: continue
+            if r.status_code != 200:
+                errors.append(f"HTTP {r.status_code}: {r.text[:120]}")
+                continue
+            latencies.append(elapsed)
+            for name, ms in parse_server_timing(r.headers.get("server-timing", "")).items():
+                stages.setdefault(name, []).append(ms)
+
+    def split(n):
+        return [n // concurrency + (1 if w < n % concurrency else 0) for w in range(concurrency)]
+
+    await asyncio.gather(*(worker(w, n, False) for w, n in enumerate(split(warmup_requests))))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(w, n, True) for w, n in enumerate(split(requests))))
+    wall = time.perf_counter() - t0
+    return latencies, errors, stages, wall
+
+def summarize(latencies, errors, stages, wall, peak_rss_kb):
+    ms = np.asarray(latencies) * 1000.0
+    pct = (lambda q: round(float(np.percentile(ms, q)), 1)) if len(ms) else (lambda q: None)
+    return {"requests": len(latencies), "errors": len(errors), "p50_ms": pct(50), "p95_ms": pct(95),
+            "p99_ms": pct(99), "mean_ms": round(float(ms.mean()), 1) if len(ms) else None,
+            "rps": round(len(latencies) / wall, 2) if wall > 0 else None,
+            "peak_rss_mb": round(peak_rss_kb / 1024, 1) if peak_rss_kb else None,
+            "stages_ms": {k: round(sum(v) / len(v), 1) for k, v in stages.items()}}
+
+# ── baseline ────────────────────────────────────────────────────────────────
+def compare(results, baseline, tolerance: float, rss_tolerance: float):
+    """Regressions as human-readable lines; empty when every gated metric is within tolerance."""
+    problems = []
+    for scenario, cur in results.items():
+        base = baseline["results"].get(scenario)
+        if cur["errors"]:
+            problems.append(f"{scenario}: {cur['errors']} failed requests")
+        if base is None:
+            continue
+        checks = GATED + (("peak_rss_mb", True),)
+        for metric, higher_is_worse in checks:
+            b, c = base.get(metric), cur.get(metric)
+            if not b or c is None: continue
+            tol = rss_tolerance if metric == "peak_rss_mb" else tolerance
+            change = (c - b) / b
+            if (change > tol) if higher_is_worse else (change < -tol):
+                problems.append(f"{scenario}: {metric} {b} -> {c} ({change:+.0%}, tolerance {tol:.0%})")
+    return problems
+
+def config_of(args):
+    return {k: getattr(args, k) for k in ("concurrency", "requests", "clip_seconds", "audio_format")} | {"env": sorted(args.env)}
+
+# ── main ────────────────────────────────────────────────────────────────────
+async def bench(args):
+    extra_env = dict(kv.split("=", 1) for kv in args.env)
+    for k, v in extra_env.items(): os.environ.setdefault(k, v)  # BENCH_LLM_* also apply to the in-process Ollama stub
+    ollama = start_ollama()
+    workdir = tempfile.mkdtemp(prefix="npc-bench-")
+    port = args.port or free_port()
+    proc, log = start_server(workdir, port, ollama.server_port, extra_env)
+    clip = wav_bytes(args.clip_seconds, 16000)
+    limits = httpx.Limits(max_connections=args.concurrency + 4, max_keepalive_connections=args.concurrency + 4)
+    results = {}
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=args.timeout, limits=limits) as client:
+            ready = await wait_ready(client, proc, args.start_timeout)
+            print(f"server ready in {ready.get('cold_start_s')}s (pid {proc.pid}, scratch {workdir})")
+            r = await client.post("/npcs", data={"name": f"Bench {port}", "persona": "You are Bram, a terse dockside merchant.",
+                                                 "voice_ref": "bench_voice.wav"})
+            r.raise_for_status()
+            npc_id = r.json()["id"]
+            tag = f"b{int(time.time())}"
+            print(f"{'scenario':<11}{'n':>6}{'err':>5}{'p50_ms':>9}{'p95_ms':>9}{'p99_ms':>9}{'req/s':>8}{'rss_mb':>8}  stages (mean ms)")
+            for scenario in args.scenarios:
+                rss_reset = reset_peak_rss(proc.pid)
+                lat, errs, stages, wall = await run_scenario(client, scenario, npc_id, clip, args.concurrency,
+                                                             args.requests, args.warmup_requests, tag,
+                                                             {"audio_format": args.audio_format} if args.audio_format else {})
+                res = results[scenario] = summarize(lat, errs, stages, wall, read_status_kb(proc.pid, "VmHWM"))
+                res["peak_rss_reset"] = rss_reset
+                fmt = lambda v: "-" if v is None else v
+                print(f"{scenario:<11}{res['requests']:>6}{res['errors']:>5}{fmt(res['p50_ms']):>9}{fmt(res['p95_ms']):>9}"
+                      f"{fmt(res['p99_ms']):>9}{fmt(res['rps']):>8}{fmt(res['peak_rss_mb']):>8}  "
+                      + " ".join(f"{k}={v}" for k, v in res["stages_ms"].items()))
+                for e in sorted(set(errs))[:3]: print(f"    {e}")
+    finally:
+        proc.terminate()
+        try: proc.wait(10)
+        except subprocess.TimeoutExpired: proc.kill()
+        log.close()
+        ollama.shutdown()
+        if args.keep: print(f"server log: {os.path.join(workdir, 'server.log')}")
+        else: shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--requests", type=int, default=64, help="measured requests per scenario")
+    ap.add_argument("--warmup-requests", type=int, default=8, help="unmeasured requests before each scenario")
+    ap.add_argument("--clip-seconds", type=float, default=2.0)
+    ap.add_argument("--audio-format", help="reply audio (wav, opus, pcm, l16); default: the server's")
+    ap.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                    help="server environment, e.g. STT_WORKERS=4 or the BENCH_* stub delays")
+    ap.add_argument("--port", type=int, default=0)
+    ap.add_argument("--timeout", type=float, default=120.0)
+    ap.add_argument("--start-timeout", type=float, default=60.0)
+    ap.add_argument("--json", help="also write the results here")
+    ap.add_argument("--save-baseline", help="write results + config as the new baseline")
+    ap.add_argument("--baseline", help="compare with this baseline and exit 1 on regression")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="allowed relative change of p50/p95/req/s")
+    ap.add_argument("--rss-tolerance", type=float, default=0.25)
+    ap.add_argument("--keep", action="store_true", help="keep the scratch dir (server log, db)")
+    args = ap.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown: ap.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(bench(args))
+    out = {"config": config_of(args), "results": results}
+    for path in (args.json, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w") as f: json.dump(out, f, indent=2)
+            print(f"wrote {path}")
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        if baseline.get("config") != out["config"]:
+            print(f"warning: baseline was recorded with {baseline.get('config')}, this run is {out['config']}")
+        problems = compare(results, baseline, args.tolerance, args.rss_tolerance)
+        for p in problems: print(f"REGRESSION {p}")
+        if problems: sys.exit(1)
+        print(f"no regressions against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_history.py — history write throughput: per-message commits vs. HistoryStore
+#
+#   python bench/bench_history.py [--sessions 32] [--turns 50] [--history 20]
+#
+# Each thread plays one chat session and does what a reply does to the DB per turn:
+#   legacy : default SQLite pragmas, no (chat_session_id, created_at) index, look up/create the
+#            session, commit the user message, query the last N, look the session up again,
+#            commit the assistant message
+#   store  : WAL + tuned pragmas + indexes (db.py), HistoryStore ring buffer + write-behind
+# and we report turns/s and persisted messages/s (store numbers include a final flush).
+import argparse, os, sys, tempfile, threading, time
+
+tmp = tempfile.mkdtemp(prefix="npc-bench-")
+os.environ["DB_PATH"] = os.path.join(tmp, "store.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from sqlalchemy import create_engine, func, text  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+import db  # noqa: E402
+from db import Base, NPC, ChatSession, Message  # noqa: E402
+from history import HistoryStore  # noqa: E402
+
+def make_npc(session_factory) -> NPC:
+    s = session_factory()
+    npc = NPC(name="Bench", slug="bench", persona="You are a bench.")
+    s.add(npc); s.commit(); s.refresh(npc); s.close()
+    return npc
+
+def legacy_turn(session_factory, npc, session_id, n_hist, i):
+    db_ = session_factory()
+    try:
+        chat = db_.query(ChatSession).filter_by(npc_id=npc.id, session_id=session_id).first()
+        if chat is None:
+            chat = ChatSession(npc_id=npc.id, session_id=session_id)
+            db_.add(chat); db_.commit(); db_.refresh(chat)
+            db_.add(Message(chat_session_id=chat.id, role="system", content=npc.persona)); db_.commit()
+        db_.add(Message(chat_session_id=chat.id, role="user", content=f"user line {i}")); db_.commit()
+        db_.query(Message).filter_by(chat_session_id=chat.id).order_by(Message.created_at.desc()).limit(n_hist).all()
+        chat = db_.query(ChatSession).filter_by(npc_id=npc.id, session_id=session_id).first()
+        db_.add(Message(chat_session_id=chat.id, role="assistant", content=f"assistant line {i}")); db_.commit()
+    finally:
+        db_.close()
+
+def store_turn(store, session_factory, npc, session_id, n_hist, i):
+    db_ = session_factory()
+    try:
+        pk = store.session_pk(db_, npc, session_id)
+        store.recent(db_, pk)
+        store.append(pk, "user", f"user line {i}")
+        store.append(pk, "assistant", f"assistant line {i}")
+    finally:
+        db_.close()
+
+def drive(turn, sessions, turns):
+    errors = []
+
+    def player(k):
+        for i in range(turns):
+            try: turn(f"s{k}", i)
+            except Exception as e: errors.append(e)
+
+    threads = [threading.Thread(target=player, args=(k,)) for k in range(sessions)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return time.perf_counter() - t0, errors
+
+def count_messages(session_factory):
+    s = session_factory()
+    try: return s.query(func.count(Message.id)).scalar()
+    finally: s.close()
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sessions", type=int, default=32)
+    ap.add_argument("--turns", type=int, default=50)
+    ap.add_argument("--history", type=int, default=20, help="HIST_MAX_TURNS*2")
+    args = ap.parse_args()
+
+    # legacy: plain engine, default pragmas, tables without the newer indexes
+    legacy_engine = create_engine(f"sqlite:///{os.path.join(tmp, 'legacy.db')}", future=True)
+    Base.metadata.create_all(legacy_engine)
+    with legacy_engine.begin() as c:
+        c.execute(text("DROP INDEX IF EXISTS ix_message_session_created"))
+        c.execute(text("DROP INDEX IF EXISTS uq_chat_session_npc_session"))
+    legacy_sf = sessionmaker(legacy_engine, expire_on_commit=False, future=True)
+    npc = make_npc(legacy_sf)
+    dt, errs = drive(lambda sid, i: legacy_turn(legacy_sf, npc, sid, args.history, i), args.sessions, args.turns)
+    legacy = (dt, count_messages(legacy_sf), errs)
+
+    db.init_db()
+    npc2 = make_npc(db.SessionLocal)
+    store = HistoryStore(db.SessionLocal, args.history)
+    t0 = time.perf_counter()
+    _, errs = drive(lambda sid, i: store_turn(store, db.SessionLocal, npc2, sid, args.history, i), args.sessions, args.turns)
+    store.close()
+    store_res = (time.perf_counter() - t0, count_messages(db.SessionLocal), errs)
+
+    turns = args.sessions * args.turns
+    print(f"{args.sessions} concurrent sessions x {args.turns} turns ({turns} turns, {2 * turns} messages + system rows)")
+    print(f"{'path':<8}{'seconds':>9}{'turns/s':>10}{'msgs/s':>10}{'rows':>8}{'errors':>8}")
+    for name, (secs, rows, errs) in (("legacy", legacy), ("store", store_res)):
+        print(f"{name:<8}{secs:>9.2f}{turns / secs:>10.0f}{rows / secs:>10.0f}{rows:>8}{len(errs):>8}")
+    for name, (_, _, errs) in (("legacy", legacy), ("store", store_res)):
+        if errs: print(f"{name} first error: {errs[0]!r}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_history_retention.py — long-lived NPCs: full-history reads, paging, export, retention, delete
+#
+#   python bench/bench_history_retention.py [--sessions 400] [--messages 250] [--old-share 0.9]
+#
+# Builds one NPC with --sessions sessions of --messages messages each (--old-share of them
+# 60 days old) in a WAL database (db.py), then reports, on a copy of it:
+#   read       : old GET /history (every message of a session) vs. one keyset page of 200
+#   window     : a cold prompt-window load (HistoryStore.window) before and after retention
+#   retention  : HistoryRetention.run_once (archive mode, 30 days) — rows moved per second
+#   export     : HistoryStore.export_npc over the whole NPC (archived messages included)
+#   delete     : the old per-session delete loop vs. HistoryStore.delete_npc
+import argparse, datetime, os, shutil, sys, tempfile, time
+
+tmp = tempfile.mkdtemp(prefix="npc-bench-")
+os.environ["DB_PATH"] = os.path.join(tmp, "seed.db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+
+from sqlalchemy import create_engine, event, insert  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+import db  # noqa: E402
+from db import NPC, ChatSession, Message  # noqa: E402
+from history import HistoryStore  # noqa: E402
+from retention import HistoryRetention  # noqa: E402
+
+def seed(args) -> int:
+    db.init_db()
+    s = db.SessionLocal()
+    npc = NPC(name="Bench", slug="bench", persona="You are a bench.", retention_days=30)
+    s.add(npc); s.commit()
+    now, old = datetime.datetime.utcnow(), datetime.datetime.utcnow() - datetime.timedelta(days=60)
+    n_old = int(args.messages * args.old_share)
+    for k in range(args.sessions):
+        chat = ChatSession(npc_id=npc.id, session_id=f"s{k}")
+        s.add(chat); s.flush()
+        rows = [{"chat_session_id": chat.id, "role": "system", "content": npc.persona, "created_at": old}]
+        rows += [{"chat_session_id": chat.id, "role": "user" if i % 2 == 0 else "assistant",
+                  "content": f"line {i}: " + "the smith talks about swords and the weather. " * 3,
+                  "created_at": old if i < n_old else now} for i in range(args.messages)]
+        s.execute(insert(Message), rows)
+    s.commit(); npc_id = npc.id; s.close()
+    db.engine.dispose()
+    return npc_id
+
+def open_copy(name: str):
+    path = os.path.join(tmp, name)
+    for ext in ("", "-wal", "-shm"):
+        if os.path.exists(db.DB_PATH + ext): shutil.copy(db.DB_PATH + ext, path + ext)
+    engine = create_engine(f"sqlite:///{path}", future=True)
+    event.listen(engine, "connect", db._sqlite_pragmas)
+    return sessionmaker(engine, expire_on_commit=False, future=True)
+
+def timed(fn, repeat=1):
+    t = time.perf_counter()
+    for _ in range(repeat): out = fn()
+    return 1000 * (time.perf_counter() - t) / repeat, out
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sessions", type=int, default=400)
+    ap.add_argument("--messages", type=int, default=250, help="per session")
+    ap.add_argument("--old-share", type=float, default=0.9, help="share of messages older than the retention age")
+    ap.add_argument("--window", type=int, default=24, help="prompt window (history.max_messages)")
+    args = ap.parse_args()
+    npc_id = seed(args)
+    print(f"{args.sessions} sessions x {args.messages} messages, {args.old_share:.0%} older than 30 days")
+
+    factory = open_copy("work.db")
+    store = HistoryStore(factory, args.window, max_sessions=0)
+    s = factory()
+    pk = s.query(ChatSession.id).filter_by(session_id="s0").scalar()
+    ms_all, rows = timed(lambda: s.query(Message).filter_by(chat_session_id=pk).order_by(Message.created_at).all(), 5)
+    ms_page, (page, _) = timed(lambda: store.page(s, pk, None, 200), 5)
+    print(f"read       full session {ms_all:8.1f} ms ({len(rows)} rows)   one page {ms_page:6.1f} ms ({len(page)} rows)")
+
+    ms_before, _ = timed(lambda: store.window(s, pk), 20)
+    s.close()
+    ms_ret, run = timed(lambda: HistoryRetention(factory, store, mode="archive", batch=500).run_once())
+    s = factory()
+    ms_after, (total, turns) = timed(lambda: store.window(s, pk), 20)
+    print(f"window     before {ms_before:6.2f} ms   after {ms_after:6.2f} ms ({len(turns)} turns of {total})")
+    print(f"retention  {run['messages']} messages from {run['sessions']} sessions in {ms_ret:.0f} ms "
+          f"({run['messages'] / max(ms_ret / 1000, 1e-9):,.0f} rows/s)")
+
+    ms_exp, n = timed(lambda: sum(1 for _ in store.export_npc(npc_id, chunk=1000)))
+    print(f"export     {n} messages in {ms_exp:.0f} ms ({n / max(ms_exp / 1000, 1e-9):,.0f}/s), 1000 rows per read")
+    s.close()
+
+    legacy = open_copy("legacy.db")()
+    def delete_loop():
+        for chat in legacy.query(ChatSession).filter_by(npc_id=npc_id).all():
+            legacy.query(Message).filter_by(chat_session_id=chat.id).delete(synchronize_session=False)
+            legacy.delete(chat)
+        legacy.delete(legacy.get(NPC, npc_id)); legacy.commit()
+    ms_loop, _ = timed(delete_loop)
+    bulk_factory = open_copy("bulk.db"); bulk = bulk_factory()
+    def delete_bulk():
+        HistoryStore(bulk_factory, args.window).delete_npc(bulk, npc_id)
+        bulk.query(NPC).filter_by(id=npc_id).delete(synchronize_session=False); bulk.commit()
+    ms_bulk, _ = timed(delete_bulk)
+    print(f"delete     per-session loop {ms_loop:6.0f} ms   bulk {ms_bulk:6.0f} ms")
+    shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_llm_backends.py — one Ollama vs. several: least-outstanding routing, session affinity, failover
+#
+#   python bench/bench_llm_backends.py [--backends 3] [--sessions 24] [--turns 6] [--slots 2]
+#
+# Starts --backends stub Ollama servers on 127.0.0.1, each serving --slots generations at a time
+# (OLLAMA_NUM_PARALLEL) with its own prompt cache: time to first token is --ttft-ms plus
+# --prompt-ms-per-kchar for every prompt character past the longest prefix it has already seen
+# for that session, as with Ollama's KV cache. The last backend is --slow-factor times slower.
+# Every session sends --turns growing conversations through the real OllamaClient. Reports turn
+# latency and TTFT (p50/p95), prompt characters evaluated, failovers and canned fallbacks; the
+# last row stops one backend halfway through.
+import argparse, asyncio, json, os, statistics, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from ollama_client import FALLBACK_REPLY, OllamaClient  # noqa: E402
+
+def stub_backend(args, slow: float) -> ThreadingHTTPServer:
+    slots = threading.BoundedSemaphore(args.slots)
+    seen = {}  # session -> prompt length already cached
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, *a): pass
+
+        def do_GET(self):
+            self._send(200, b'{"models": [{"name": "stub"}]}')
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            messages = body.get("messages") or []
+            if not messages: return self._send(200, b'{"done": true}')
+            session, prompt = messages[0]["content"], len(json.dumps(messages))
+            with slots:
+                with lock:
+                    cached = seen.get(session, 0) if prompt >= seen.get(session, 0) else 0
+                    seen[session] = prompt
+                evaluated = prompt - cached
+                time.sleep(slow * (args.ttft_ms + args.prompt_ms_per_kchar * evaluated / 1000) / 1000)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for i in range(args.tokens):
+                        if i: time.sleep(slow * args.token_ms / 1000)
+                        self._chunk({"message": {"content": f"w{i} "}, "done": False})
+                    self._chunk({"done": True, "prompt_eval_count": evaluated, "eval_count": args.tokens})
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+        def _chunk(self, obj):
+            data = json.dumps(obj).encode() + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data)); self.wfile.flush()
+
+        def _send(self, status, data):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers(); self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+async def scenario(name, args, n_backends, slack, kill_halfway=False):
+    servers = [stub_backend(args, args.slow_factor if i == n_backends - 1 and n_backends > 1 else 1.0)
+               for i in range(n_backends)]
+    client = OllamaClient([f"http://127.0.0.1:{s.server_port}" for s in servers], "stub", {},
+                          affinity_slack=max(0, slack), health_interval_s=0.5)
+    client.start_health_checks()
+    turns, ttfts, evaluated, fallbacks = [], [], [], []
+    done = 0
+
+    async def player(k: int):
+        nonlocal done
+        history = [{"role": "system", "content": f"session {k}: " + "You are a blacksmith. " * 40}]
+        for t in range(args.turns):
+            history.append({"role": "user", "content": f"turn {t}: what do you have for sale today?"})
+            stats, t0 = {}, time.perf_counter()
+            reply = await client.chat(history, stats=stats, affinity=f"s{k}" if slack >= 0 else None)
+            turns.append(time.perf_counter() - t0)
+            if "ttft_s" in stats: ttfts.append(stats["ttft_s"])
+            evaluated.append(stats.get("prompt_eval_count", 0))
+            fallbacks.extend(stats.get("fallbacks", ()))
+            history.append({"role": "assistant", "content": reply if reply != FALLBACK_REPLY else "..."})
+            done += 1
+            if kill_halfway and done == args.sessions * args.turns // 2:
+                servers[0].shutdown(); servers[0].server_close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(player(k) for k in range(args.sessions)))
+    wall = time.perf_counter() - t0
+    await client.aclose()
+    for s in servers[1 if kill_halfway else 0:]: s.shutdown(); s.server_close()
+    q = lambda xs, p: 1000 * sorted(xs)[int(p * (len(xs) - 1))] if xs else float("nan")
+    return (name, q(turns, 0.5), q(turns, 0.95), q(ttfts, 0.5), q(ttfts, 0.95), statistics.mean(evaluated),
+            fallbacks.count("failover"), fallbacks.count("okay"), len(turns) / wall)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--backends", type=int, default=3)
+    ap.add_argument("--sessions", type=int, default=24)
+    ap.add_argument("--turns", type=int, default=6)
+    ap.add_argument("--slots", type=int, default=2, help="parallel generations per backend")
+    ap.add_argument("--ttft-ms", type=float, default=40)
+    ap.add_argument("--prompt-ms-per-kchar", type=float, default=60, help="prompt evaluation cost (uncached part)")
+    ap.add_argument("--token-ms", type=float, default=8)
+    ap.add_argument("--tokens", type=int, default=12)
+    ap.add_argument("--slow-factor", type=float, default=2.0, help="the last backend is this much slower")
+    args = ap.parse_args()
+
+    rows = [asyncio.run(scenario("1 backend", args, 1, -1)),
+            asyncio.run(scenario(f"{args.backends} backends, least busy", args, args.backends, -1)),
+            asyncio.run(scenario(f"{args.backends} backends + affinity", args, args.backends, 2)),
+            asyncio.run(scenario("+ one stops halfway", args, args.backends, 2, kill_halfway=True))]
+    print(f"{args.sessions} sessions x {args.turns} turns, {args.slots} slots per backend, "
+          f"last backend {args.slow_factor}x slower")
+    print(f"{'routing':<30}{'turn p50':>9}{'p95':>7}{'ttft p50':>10}{'p95':>7}{'prompt chars':>14}"
+          f"{'failover':>10}{'okay':>6}{'turns/s':>9}")
+    for r in rows:
+        print(f"{r[0]:<30}{r[1]:>9.0f}{r[2]:>7.0f}{r[3]:>10.0f}{r[4]:>7.0f}{r[5]:>14.0f}{r[6]:>10}{r[7]:>6}{r[8]:>9.1f}")
+
+if __name__ == "__main__":
+    main()
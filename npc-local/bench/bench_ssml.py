@@ -0,0 +1,154 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_ssml.py — per-part sequential SSML synthesis vs. the compiled, coalesced one (server/ssml.py)
+#
+#   python bench/bench_ssml.py [--replies 40] [--call-ms 60] [--char-ms 2] [--host-ms 4] [--merge-break-ms 250]
+#
+# XTTS is replaced by a cost model: every call pays --call-ms + --char-ms per character under the
+# model lock (inferences on one model never overlap), plus --host-ms outside it (cache lookup,
+# latents, array handling), which is what concurrent parts can overlap. Replies are break-heavy
+# LLM-style SSML. Reports model calls and wall time per reply, and the parse cost on its own.
+import argparse, os, random, re, statistics, sys, tempfile, time
+
+import numpy as np
+
+_tmp = tempfile.mkdtemp(prefix="bench_ssml_")
+os.environ.update(AUDIO_CACHE_MB="0", AUDIO_CACHE_DISK_MB="0", VOICES_STORAGE=_tmp)  # measure synthesis, not the cache
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+import inference  # noqa: E402
+from audio import encode_wav_segments  # noqa: E402
+from ssml import compile_ssml  # noqa: E402
+
+SR = 24000
+CHARS_PER_S = 15.0
+
+class CostModel:
+    def __init__(self, call_ms: float, char_ms: float, host_ms: float):
+        self.call_ms, self.char_ms, self.host_ms = call_ms, char_ms, host_ms
+        self.calls = 0
+
+    def __call__(self, plain, rate, speaker_wav, language):
+        time.sleep(self.host_ms / 1000)
+        with inference._tts_infer_lock:
+            self.calls += 1
+            time.sleep((self.call_ms + self.char_ms * len(plain)) / 1000)
+        return np.zeros(int(SR * len(plain) / CHARS_PER_S / rate), dtype="float32"), SR
+
+# ── legacy path (what inference.py did before) ───────────────────────────────
+def ssml_to_parts_legacy(text, base_rate=1.0):
+    parts, current, rate_stack = [], [], [base_rate]
+    def flush(p=0):
+        if current:
+            parts.append(("".join(current), rate_stack[-1], p)); current.clear()
+    for tok in re.split(r'(<break[^>]*>|<prosody[^>]*>|</prosody>)', text):
+        if tok.startswith("<break"):
+            m = re.search(r'time="([^"]+)"', tok); ms = 0
+            if m:
+                val = m.group(1).lower()
+                ms = int(float(val[:-2])) if val.endswith("ms") else (int(float(val[:-1])*1000) if val.endswith("s") else 0)
+            flush(ms)
+        elif tok.startswith("<prosody"):
+            m = re.search(r'rate="([^"]+)"', tok)
+            mapped = rate_stack[-1]
+            if m:
+                v = m.group(1).lower()
+                mapped = {"x-slow": 0.6, "slow": 0.8, "medium": 1.0, "fast": 1.2, "x-fast": 1.4}.get(v, mapped)
+                if mapped == rate_stack[-1]:
+                    try: mapped = float(v)
+                    except ValueError: pass
+            rate_stack.append(mapped)
+        elif tok == "</prosody>":
+            if len(rate_stack) > 1: rate_stack.pop()
+        else:
+            current.append(tok)
+    flush()
+    return parts
+
+def synthesize_legacy(text, speaker_wav, language="en"):
+    segments = []
+    for plain, rate, pause_ms in ssml_to_parts_legacy(text):
+        audio = None
+        if plain.strip():
+            audio, _ = inference.tts_segment(plain, rate, speaker_wav, language)
+        segments.append((audio, pause_ms))
+    return encode_wav_segments([(a, int(ms / 1000.0 * SR)) for a, ms in segments], SR)
+
+# ── replies ─────────────────────────────────────────────────────────────────
+FILLERS = ["Hmm.", "Well,", "Ah.", "Look,", "Right.", "Listen."]
+CLAUSES = ["the bridge is out past the mill", "I saw them leave before dawn", "you'll want a lantern",
+           "nobody goes there anymore", "the captain owes me coin", "keep your voice down",
+           "that's all I know", "they took the north road"]
+
+def make_reply(rng: random.Random, sentences: int) -> str:
+    out = []
+    for _ in range(sentences):
+        filler, clause = rng.choice(FILLERS), rng.choice(CLAUSES)
+        pause = f'<break time="{rng.choice((150, 200, 300))}ms"/>'
+        if rng.random() < 0.3:
+            clause = f'<prosody rate="slow">{clause}</prosody>'
+        elif rng.random() < 0.3:  # what a streaming chunk boundary leaves behind: close + reopen
+            words = clause.split(" ")
+            clause = (f'<prosody rate="fast">{" ".join(words[:2])}</prosody><prosody rate="fast"> '
+                      f'{" ".join(words[2:])}</prosody>')
+        out.append(f"{filler}{pause} {clause}.{pause}{pause if rng.random() < 0.3 else ''} ")
+    return "".join(out)
+
+def run(name, fn, replies, voice, cost):
+    cost.calls = 0
+    times = []
+    for text in replies:
+        t = time.perf_counter()
+        fn(text, voice)
+        times.append(1000 * (time.perf_counter() - t))
+    return {"name": name, "calls": cost.calls / len(replies), "mean": statistics.mean(times),
+            "p95": sorted(times)[int(0.95 * (len(times) - 1))]}
+
+def parse_us(fn, replies, rounds=20):
+    t = time.perf_counter()
+    for _ in range(rounds):
+        for text in replies: fn(text)
+    return 1e6 * (time.perf_counter() - t) / (rounds * len(replies))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--replies", type=int, default=40)
+    ap.add_argument("--sentences", type=int, default=4, help="sentences per reply (each has 2-3 breaks)")
+    ap.add_argument("--call-ms", type=float, default=60, help="fixed model cost per call")
+    ap.add_argument("--char-ms", type=float, default=2, help="model cost per character")
+    ap.add_argument("--host-ms", type=float, default=4, help="work per part outside the model lock")
+    ap.add_argument("--threads", type=int, default=4, help="TTS_SEGMENT_THREADS for the compiled path")
+    ap.add_argument("--merge-break-ms", type=int, default=250, help="SSML_MERGE_BREAK_MS for the last row")
+    args = ap.parse_args()
+
+    rng = random.Random(0)
+    replies = [make_reply(rng, args.sentences) for _ in range(args.replies)]
+    voice = os.path.join(_tmp, "voice.wav")
+    with open(voice, "wb") as f: f.write(b"RIFF-bench-voice")
+    cost = CostModel(args.call_ms, args.char_ms, args.host_ms)
+    inference._tts_segment = cost
+
+    def compiled(threads, merge_ms):
+        def fn(text, speaker_wav):
+            inference.SSML_MERGE_BREAK_MS = merge_ms
+            return inference.synthesize_ssml(text, speaker_wav, "en")
+        inference._segment_pool = inference.ThreadPoolExecutor(threads) if threads > 1 else None
+        return fn
+
+    rows = [
+        run("legacy (part by part)", synthesize_legacy, replies, voice, cost),
+        run("compiled, 1 thread", compiled(1, 0), replies, voice, cost),
+        run(f"compiled, {args.threads} threads", compiled(args.threads, 0), replies, voice, cost),
+        run(f"+ merge breaks <= {args.merge_break_ms}ms", compiled(args.threads, args.merge_break_ms), replies, voice, cost),
+    ]
+    print(f"{len(replies)} replies, {statistics.mean(len(r) for r in replies):.0f} chars, "
+          f"{statistics.mean(r.count('<break') for r in replies):.1f} breaks each")
+    print(f"{'path':<28}{'calls/reply':>12}{'ms/reply':>10}{'p95 ms':>9}")
+    for r in rows:
+        print(f"{r['name']:<28}{r['calls']:>12.1f}{r['mean']:>10.1f}{r['p95']:>9.1f}")
+    compile_ssml.cache_clear()
+    print(f"parse: legacy {parse_us(ssml_to_parts_legacy, replies):.1f} us, compile "
+          f"{parse_us(lambda t: (compile_ssml.cache_clear(), compile_ssml(t)), replies):.1f} us, "
+          f"compile (cached) {parse_us(compile_ssml, replies):.2f} us per reply")
+
+if __name__ == "__main__":
+    main()
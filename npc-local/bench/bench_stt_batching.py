@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_stt_batching.py — throughput vs. latency of WhisperBatcher settings
+#
+#   python bench/bench_stt_batching.py                      # synthetic cost model, no models needed
+#   python bench/bench_stt_batching.py --real small --compute int8 --clip-seconds 3
+#
+# N client threads send clips back to back (like N players talking to NPCs at once) through
+# WhisperBatcher for each (WHISPER_BATCH_SIZE, WHISPER_BATCH_WINDOW_MS) pair and we report
+# clips/s and p50/p95 end-to-end latency. The synthetic backend costs
+#   fixed_ms + per_clip_ms * n   per call
+# which is the shape of a batched encoder/decoder call (fixed launch + weight-load cost
+# amortised over the batch); use --real for numbers from faster-whisper itself.
+import argparse, os, statistics, sys, threading, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from stt_batcher import WhisperBatcher, whisper_transcribe_one, whisper_transcribe_batch  # noqa: E402
+
+def synthetic_backend(fixed_ms: float, per_clip_ms: float):
+    lock = threading.Lock()  # one model instance: calls never overlap
+
+    def one(audio, lang):
+        with lock: time.sleep((fixed_ms + per_clip_ms) / 1000.0)
+        return "ok"
+
+    def batch(audios, langs):
+        with lock: time.sleep((fixed_ms + per_clip_ms * len(audios)) / 1000.0)
+        return ["ok"] * len(audios)
+    return one, batch
+
+def real_backend(size: str, compute: str):
+    from faster_whisper import WhisperModel
+    model = WhisperModel(size, device="auto", compute_type=compute)
+    lock = threading.Lock()
+
+    def one(audio, lang):
+        with lock: return whisper_transcribe_one(model, audio, lang)
+
+    def batch(audios, langs):
+        with lock: return whisper_transcribe_batch(model, audios, langs)
+    return one, batch
+
+def run(one, batch, max_batch, window_ms, clients, requests_per_client, clip):
+    batcher = WhisperBatcher(one, batch, max_batch=max_batch, window_ms=window_ms)
+    latencies, lock = [], threading.Lock()
+
+    def client():
+        for _ in range(requests_per_client):
+            t0 = time.perf_counter()
+            batcher.transcribe(clip, "en")
+            with lock: latencies.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.perf_counter() - t0
+    latencies.sort()
+    q = statistics.quantiles(latencies, n=100)
+    return {"throughput": len(latencies) / wall, "p50": 1000 * q[49], "p95": 1000 * q[94],
+            "avg_batch": batcher.clips / batcher.batches if batcher.batches else 1.0}
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--clients", type=int, default=8)
+    ap.add_argument("--requests", type=int, default=20, help="per client")
+    ap.add_argument("--clip-seconds", type=float, default=2.0)
+    ap.add_argument("--fixed-ms", type=float, default=250.0)
+    ap.add_argument("--per-clip-ms", type=float, default=40.0)
+    ap.add_argument("--real", metavar="WHISPER_SIZE", default=None)
+    ap.add_argument("--compute", default="int8")
+    ap.add_argument("--configs", default="1:0,4:20,8:20,8:50,16:50",
+                    help="comma-separated WHISPER_BATCH_SIZE:WHISPER_BATCH_WINDOW_MS pairs")
+    args = ap.parse_args()
+
+    one, batch = real_backend(args.real, args.compute) if args.real else synthetic_backend(args.fixed_ms, args.per_clip_ms)
+    rng = np.random.default_rng(0)
+    clip = (0.05 * rng.standard_normal(int(16000 * args.clip_seconds))).astype(np.float32)
+
+    print(f"clients={args.clients} clip={args.clip_seconds}s backend={'faster-whisper ' + args.real if args.real else 'synthetic'}")
+    print(f"{'batch':>6}{'window':>8}{'clips/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'avg batch':>11}")
+    for cfg in args.configs.split(","):
+        size, window = cfg.split(":")
+        r = run(one, batch, int(size), float(window), args.clients, args.requests, clip)
+        print(f"{size:>6}{window:>8}{r['throughput']:>10.1f}{r['p50']:>9.0f}{r['p95']:>9.0f}{r['avg_batch']:>11.1f}")
+
+if __name__ == "__main__":
+    main()
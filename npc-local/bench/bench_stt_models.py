@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/bench_stt_models.py — one Whisper model for everything vs. routing clips across several
+#
+#   python bench/bench_stt_models.py [--clips 400] [--short-share 0.6] [--budget-mb 2000] [--scale 0.1]
+#
+# Clips are a game-like mix: `--short-share` one- or two-word answers (0.4-1.5 s), the rest
+# sentences (2-8 s), some with a German hint. Each model is a cost model (fixed + RTF * seconds,
+# scaled from the relative speeds of the faster-whisper sizes on CPU int8, plus --load-ms per
+# load, all times * --scale) behind the real WhisperModels (server/stt_models.py). Reports ms per
+# clip overall and by route, and loads; the last row shows the churn when the budget is too small.
+import argparse, os, random, statistics, sys, time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+from stt_models import WhisperModels  # noqa: E402
+
+SR = 16000
+COST = {"tiny": (8, 0.02), "base": (12, 0.035), "small": (30, 0.08), "medium": (70, 0.22)}  # ms, RTF
+
+class CostModel:
+    def __init__(self, size: str, scale: float):
+        self.fixed_s, self.rtf = scale * COST[size][0] / 1000, scale * COST[size][1]
+
+    def run(self, audio):
+        time.sleep(self.fixed_s + self.rtf * len(audio) / SR)
+        return "ok"
+
+def make_clips(rng: random.Random, n: int, short_share: float):
+    out = []
+    for _ in range(n):
+        seconds = rng.uniform(0.4, 1.5) if rng.random() < short_share else rng.uniform(2, 8)
+        out.append((np.zeros(int(seconds * SR), dtype="float32"), "de" if rng.random() < 0.15 else "en"))
+    return out
+
+def run(name, clips, args, **kw):
+    loads = []
+    def load(size, compute):
+        loads.append(size); time.sleep(args.scale * args.load_ms / 1000)
+        return CostModel(size, args.scale)
+    pool = WhisperModels(load, lambda m, a, lang: m.run(a), lambda m, audios, langs: [m.run(a) for a in audios],
+                         max_batch=1, **kw)
+    by_route = {}
+    t0 = time.perf_counter()
+    for audio, lang in clips:
+        model, why = pool.route(len(audio) / SR, lang)
+        t = time.perf_counter()
+        pool.transcribe(audio, lang)
+        by_route.setdefault(f"{why}:{model}", []).append(1000 * (time.perf_counter() - t))
+    total = 1000 * (time.perf_counter() - t0) / len(clips)
+    return (name, total / args.scale, len(loads),
+            {k: statistics.mean(v) / args.scale for k, v in sorted(by_route.items())})
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--clips", type=int, default=400)
+    ap.add_argument("--short-share", type=float, default=0.6)
+    ap.add_argument("--short-s", type=float, default=2.0, help="WHISPER_SHORT_S")
+    ap.add_argument("--load-ms", type=float, default=1500, help="cost of loading a model")
+    ap.add_argument("--budget-mb", type=int, default=2000, help="WHISPER_MEMORY_MB for the routed rows")
+    ap.add_argument("--scale", type=float, default=0.1, help="run model times this much faster (results are scaled back)")
+    args = ap.parse_args()
+
+    clips = make_clips(random.Random(0), args.clips, args.short_share)
+    rows = [
+        run("small only", clips, args, default="small"),
+        run("medium only", clips, args, default="medium"),
+        run("small + tiny for short", clips, args, default="small", short_model="tiny",
+            short_s=args.short_s, budget_mb=args.budget_mb),
+        run("+ de=medium", clips, args, default="small", short_model="tiny", short_s=args.short_s,
+            lang_models={"de": "medium"}, budget_mb=args.budget_mb),
+        run("+ de=medium, budget 1400 MB", clips, args, default="small", short_model="tiny",
+            short_s=args.short_s, lang_models={"de": "medium"}, budget_mb=1400),
+    ]
+    print(f"{len(clips)} clips, {args.short_share:.0%} short, load {args.load_ms:.0f} ms")
+    print(f"{'models':<30}{'ms/clip':>9}{'loads':>7}   ms/clip by route:model")
+    for name, total, loads, routes in rows:
+        print(f"{name:<30}{total:>9.1f}{loads:>7}   " + ", ".join(f"{k} {v:.0f}" for k, v in routes.items()))
+
+if __name__ == "__main__":
+    main()
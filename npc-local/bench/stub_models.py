@@ -0,0 +1,180 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# bench/stub_models.py — stand-ins for Whisper, XTTS and Ollama with synthetic delays
+#
+#   python bench/stub_models.py app --port 8790          # the real app on the stub models
+#   python bench/stub_models.py ollama --port 11499      # just the stub Ollama server
+#
+# The stubs replace the third-party objects, not our code: `faster_whisper.WhisperModel` and
+# `TTS.api.TTS` are registered in sys.modules before server/inference.py imports them lazily, and
+# the Ollama stub speaks the NDJSON streaming API on 127.0.0.1. Everything between the HTTP
+# request and the model call (decoding, batching, pools, prompts, history, caches, WAV encoding)
+# is the real server code. Delays are read from BENCH_* environment variables:
+#
+#   BENCH_STT_MS=40 BENCH_STT_RTF=0.05            Whisper: fixed + RTF * clip seconds per call
+#   BENCH_STT_BATCH_MS=10                         batched call: + this per extra clip (RTF on the longest)
+#   BENCH_TTS_MS=60 BENCH_TTS_MS_PER_CHAR=2       XTTS: fixed + per input character per part
+#   BENCH_TTS_SPEECH_CPS=14                       generated audio length (characters per second)
+#   BENCH_LLM_TTFT_MS=150 BENCH_LLM_TOKEN_MS=15   Ollama: time to first token, then per token
+#   BENCH_LLM_TOKENS=24                           reply length in tokens
+#
+# One lock per stub model, as with one real model instance: calls on it never overlap.
+import json, os, sys, threading, time, types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import numpy as np
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server")
+
+def _ms(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default))) / 1000.0
+
+# ── Whisper ─────────────────────────────────────────────────────────────────
+class _Segment:
+    def __init__(self, text: str):
+        self.text = text
+
+class _Info:
+    def __init__(self, language: str, duration: float):
+        self.language, self.language_probability, self.duration = language, 1.0, duration
+
+class StubWhisperModel:
+    """faster_whisper.WhisperModel look-alike: the text says how long the clip was."""
+    def __init__(self, *args, **kwargs):
+        self.fixed_s = _ms("BENCH_STT_MS", 40)
+        self.rtf = float(os.getenv("BENCH_STT_RTF", "0.05"))
+        self.per_extra_clip_s = _ms("BENCH_STT_BATCH_MS", 10)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _text(audio: np.ndarray) -> str:
+        if not len(audio) or float(np.abs(audio).max()) < 1e-4:
+            return ""
+        return f"Hello there, this clip was {len(audio) / 16000:.1f} seconds long. What do you sell?"
+
+    def transcribe(self, audio, language: Optional[str] = None, **kwargs):
+        audio = np.asarray(audio, dtype="float32")
+        with self._lock:
+            time.sleep(self.fixed_s + self.rtf * len(audio) / 16000)
+        return iter([_Segment(self._text(audio))]), _Info(language or "en", len(audio) / 16000)
+
+    def transcribe_batch(self, audios: List[np.ndarray], languages: List[Optional[str]]) -> List[str]:
+        seconds = max(len(a) for a in audios) / 16000  # clips are padded to one length and run side by side
+        with self._lock:
+            time.sleep(self.fixed_s + self.per_extra_clip_s * (len(audios) - 1) + self.rtf * seconds)
+        return [self._text(a) for a in audios]
+
+# ── XTTS ────────────────────────────────────────────────────────────────────
+class _Synthesizer:
+    output_sample_rate = 24000  # no `tts_model`, so inference.get_xtts() is None: the plain tts() path
+
+class StubTTS:
+    """TTS.api.TTS look-alike: a quiet tone as long as the text would take to say."""
+    def __init__(self, *args, **kwargs):
+        self.synthesizer = _Synthesizer()
+        self.fixed_s = _ms("BENCH_TTS_MS", 60)
+        self.per_char_s = _ms("BENCH_TTS_MS_PER_CHAR", 2)
+        self.cps = float(os.getenv("BENCH_TTS_SPEECH_CPS", "14"))
+        self._lock = threading.Lock()
+
+    def tts(self, text: str, speaker_wav=None, language=None, speed: float = 1.0, **kwargs):
+        sr = self.synthesizer.output_sample_rate
+        n = int(sr * len(text) / self.cps / max(0.25, speed))
+        with self._lock:
+            time.sleep(self.fixed_s + self.per_char_s * len(text))
+        return (0.1 * np.sin(np.arange(n, dtype="float32") * (2 * np.pi * 220 / sr))).astype("float32")
+
+def install():
+    """Register the stubs under the real module names; call before server/inference.py loads a model."""
+    fw = types.ModuleType("faster_whisper")
+    fw.WhisperModel = StubWhisperModel
+    tts_pkg, tts_api = types.ModuleType("TTS"), types.ModuleType("TTS.api")
+    tts_api.TTS = StubTTS
+    tts_pkg.api = tts_api
+    sys.modules.update({"faster_whisper": fw, "TTS": tts_pkg, "TTS.api": tts_api})
+    # the batched decode goes through ctranslate2 internals; route it to the stub's batch cost model
+    if SERVER not in sys.path: sys.path.insert(0, SERVER)
+    import inference
+    inference.whisper_transcribe_batch = lambda model, audios, langs: model.transcribe_batch(audios, langs)
+
+# ── Ollama ──────────────────────────────────────────────────────────────────
+WORDS = ("Ah, traveler. I have rope, lanterns and dried fish. The road north is closed since the storm, "
+         "so mind the river path. Anything else?").split()
+
+class _OllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    counter = 0
+    counter_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._json(200, {"models": [{"name": "stub"}]} if self.path == "/api/tags" else {"error": "not found"})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if self.path not in ("/api/chat", "/api/generate"):
+            return self._json(404, {"error": "not found"})
+        if "messages" not in body and "prompt" not in body:  # preload / keep_alive request
+            return self._json(200, {"model": body.get("model"), "done": True})
+        with _OllamaHandler.counter_lock:
+            _OllamaHandler.counter += 1
+            n = _OllamaHandler.counter
+        ntok = int(os.getenv("BENCH_LLM_TOKENS", "24"))
+        # a different reply each time so TTS has to synthesize (not the audio cache)
+        tokens = [f"{WORDS[(n + i) % len(WORDS)]} " for i in range(ntok - 1)] + [f"#{n}."]
+        prompt_chars = len(json.dumps(body.get("messages") or body.get("prompt")))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(_ms("BENCH_LLM_TTFT_MS", 150))
+        token_s = _ms("BENCH_LLM_TOKEN_MS", 15)
+        try:
+            for i, tok in enumerate(tokens):
+                if i: time.sleep(token_s)
+                chunk = {"message": {"role": "assistant", "content": tok}} if self.path == "/api/chat" else {"response": tok}
+                self._chunk(dict(chunk, done=False))
+            self._chunk({"done": True, "prompt_eval_count": prompt_chars // 4, "eval_count": len(tokens)})
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):  # the server aborted generation (disconnect, barge-in)
+            self.close_connection = True
+
+    def _chunk(self, obj):
+        data = json.dumps(obj).encode("utf-8") + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _json(self, status: int, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_ollama(port: int = 0) -> ThreadingHTTPServer:
+    """Stub Ollama on 127.0.0.1 in a daemon thread; the bound port is server.server_port."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _OllamaHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-ollama", daemon=True).start()
+    return server
+
+def main():
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("what", choices=("app", "ollama"))
+    ap.add_argument("--port", type=int, default=8790)
+    args = ap.parse_args()
+    if args.what == "ollama":
+        print(f"[stub_models] ollama on 127.0.0.1:{start_ollama(args.port).server_port}")
+        threading.Event().wait()
+    install()
+    os.chdir(SERVER)  # main mounts ./ui
+    import uvicorn, main as app_main
+    uvicorn.run(app_main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/audio.py — in-memory audio helpers (no temp files on the hot path)
+import io, struct
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+WHISPER_SR = 16000
+
+def resample(audio: np.ndarray, sr_in: int, sr_out: int) -> np.ndarray:
+    """Linear-interpolation resampler; plenty for speech going into Whisper."""
+    if sr_in == sr_out or audio.size == 0:
+        return audio
+    if sr_in % sr_out == 0:  # 48k/32k -> 16k: box-filter decimation, no float64 temporaries
+        k = sr_in // sr_out
+        n = audio.shape[0] // k
+        return audio[:n * k].reshape(n, k).mean(axis=1, dtype=np.float32)
+    n_out = int(round(audio.shape[0] * sr_out / sr_in))
+    x_out = np.arange(n_out, dtype=np.float64) * (sr_in / sr_out)
+    return np.interp(x_out, np.arange(audio.shape[0]), audio).astype(np.float32)
+
+def pcm_params(content_type: Optional[str]) -> Optional[Tuple[str, int, int]]:
+    """("<i2" | ">i2", rate, channels) for raw PCM media types, None for containers.
+
+    `audio/pcm` (and `audio/x-raw`) is little-endian s16, `audio/L16` is big-endian as in RFC 2586;
+    `rate=` and `channels=` parameters default to 16000 and 1.
+    """
+    if not content_type:
+        return None
+    kind, *params = [p.strip() for p in content_type.split(";")]
+    kind = kind.lower()
+    if kind not in ("audio/pcm", "audio/x-raw", "audio/l16"):
+        return None
+    opts = dict(p.split("=", 1) for p in params if "=" in p)
+    return (">i2" if kind == "audio/l16" else "<i2", int(opts.get("rate", WHISPER_SR)), int(opts.get("channels", 1)))
+
+def decode_audio(data: bytes, sr: int = WHISPER_SR, content_type: Optional[str] = None) -> np.ndarray:
+    """Decode an uploaded clip straight from bytes into mono float32 at `sr`.
+
+    Raw PCM (see pcm_params) is read in place; WAV/FLAC/Ogg (Vorbis or Opus) go through
+    libsndfile; anything it can't parse (mp3, webm, ...) falls back to faster-whisper's PyAV
+    decoder, which also reads from a file-like object.
+    """
+    raw = pcm_params(content_type)
+    if raw is not None:
+        dtype, sr_in, channels = raw
+        pcm = np.frombuffer(data, dtype=dtype, count=len(data) // 2)
+        pcm = pcm[:pcm.shape[0] // channels * channels].reshape(-1, channels)
+        audio = (pcm[:, 0] if channels == 1 else pcm.mean(axis=1)).astype(np.float32) / 32768.0
+        return resample(audio, sr_in, sr)
+    try:
+        audio, sr_in = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+    except Exception:
+        from faster_whisper.audio import decode_audio as av_decode
+        return av_decode(io.BytesIO(data), sampling_rate=sr)
+    audio = audio[:, 0] if audio.shape[1] == 1 else audio.mean(axis=1, dtype=np.float32)
+    return resample(audio, sr_in, sr)
+
+def wav_header(n_samples: int, sr: int, channels: int = 1, bits: int = 16) -> bytes:
+    block = channels * bits // 8
+    data_len = n_samples * block
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_len, b"WAVE", b"fmt ", 16, 1, channels,
+                       sr, sr * block, block, bits, b"data", data_len)
+
+def encode_wav_segments(segments: Iterable[Tuple[Optional[np.ndarray], int]], sr: int) -> bytes:
+    """Encode (audio, trailing_silence_samples) pairs as one PCM_16 WAV.
+
+    The output is allocated once (header + samples) and each segment is converted into its slice
+    in place; silences are the zero-initialised gaps, so no per-pause arrays and no concatenate.
+    """
+    segments = [(a, max(0, int(pad))) for a, pad in segments]
+    total = sum((0 if a is None else a.shape[0]) + pad for a, pad in segments)
+    out = bytearray(44 + 2 * total)
+    out[:44] = wav_header(total, sr)
+    pcm = np.frombuffer(out, dtype="<i2", offset=44)
+    longest = max([0 if a is None else a.shape[0] for a, _ in segments] or [0])
+    scratch = np.empty(longest, dtype=np.float32)
+    pos = 0
+    for audio, pad in segments:
+        if audio is not None and audio.shape[0]:
+            n = audio.shape[0]
+            tmp = scratch[:n]
+            np.clip(audio, -1.0, 1.0, out=tmp)
+            tmp *= 32767.0
+            np.rint(tmp, out=tmp)
+            pcm[pos:pos + n] = tmp  # float32 -> int16 cast straight into the output buffer
+            pos += n
+        pos += pad
+    return bytes(out)
+
+def encode_wav(audio: np.ndarray, sr: int) -> bytes:
+    return encode_wav_segments([(audio, 0)], sr)
+
+# ── reply encodings ─────────────────────────────────────────────────────────
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)  # input rates libopus accepts
+
+def wav_pcm16(wav: bytes) -> Tuple[np.ndarray, int]:
+    """int16 samples and rate of a mono PCM_16 WAV; a view for the 44-byte header we write."""
+    if wav[:4] == b"RIFF" and wav[36:40] == b"data" and struct.unpack_from("<HHI", wav, 20)[:2] == (1, 1):
+        return np.frombuffer(wav, dtype="<i2", offset=44), struct.unpack_from("<I", wav, 24)[0]
+    audio, sr = sf.read(io.BytesIO(wav), dtype="int16", always_2d=True)
+    return audio[:, 0], sr
+
+def resample_pcm16(pcm: np.ndarray, sr_in: int, sr_out: int) -> np.ndarray:
+    if sr_in == sr_out or pcm.size == 0:
+        return pcm
+    audio = resample(pcm.astype(np.float32), sr_in, sr_out)
+    return np.clip(np.rint(audio), -32768, 32767).astype("<i2")
+
+def encode_ogg_opus(pcm: np.ndarray, sr: int, bitrate: int) -> bytes:
+    """Mono int16 -> Ogg/Opus via PyAV (installed with faster-whisper); `sr` must be in OPUS_RATES."""
+    import av
+    if pcm.size == 0:
+        pcm = np.zeros(sr // 50, dtype="<i2")  # one 20 ms frame: an empty stream is not a valid file
+    buf = io.BytesIO()
+    with av.open(buf, mode="w", format="ogg") as out:
+        stream = out.add_stream("libopus", rate=sr)
+        stream.bit_rate = bitrate
+        stream.layout = "mono"
+        frame = av.AudioFrame.from_ndarray(np.ascontiguousarray(pcm, dtype="<i2").reshape(1, -1),
+                                           format="s16", layout="mono")
+        frame.sample_rate = sr
+        for packet in stream.encode(frame): out.mux(packet)
+        for packet in stream.encode(None): out.mux(packet)  # flush the encoder's look-ahead
+    return buf.getvalue()
@@ -0,0 +1,148 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/audio_cache.py — content-addressed cache for synthesized audio
+import os, hashlib, struct, threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+class AudioCache:
+    """Synthesized audio keyed by what determines it (text, voice content hash, language, rate).
+
+    Two tiers: an in-memory LRU bounded in bytes, then files under `root/<k[:2]>/<k>.bin`
+    (bounded too; the least recently read files are pruned first). Values are raw bytes;
+    `get_array`/`put_array` store float32 samples behind a 4-byte sample-rate header.
+    Counters are kept per `kind` so whole-reply and per-part hit rates can be told apart.
+    """
+    def __init__(self, root: Optional[str], max_mem_bytes: int, max_disk_bytes: int):
+        self.root = root
+        self.max_mem_bytes = max_mem_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._mem_bytes = 0
+        self._disk_bytes: Optional[int] = None  # scanned lazily on first store
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def make_key(*fields) -> str:
+        return hashlib.sha256("\x1f".join(str(f) for f in fields).encode("utf-8")).hexdigest()
+
+    def _count(self, kind: str, what: str):
+        counters = self.stats.setdefault(kind, {"mem_hits": 0, "disk_hits": 0, "misses": 0})
+        counters[what] += 1
+
+    # ── bytes ──
+    def get(self, key: str, kind: str = "audio") -> Optional[bytes]:
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self._count(kind, "mem_hits")
+                return data
+        data = self._read_disk(key)
+        with self._lock:
+            if data is None:
+                self._count(kind, "misses")
+                return None
+            self._count(kind, "disk_hits")
+            self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._remember(key, data)
+        self._write_disk(key, data)
+
+    # ── float32 arrays ──
+    def get_array(self, key: str, kind: str = "audio") -> Optional[Tuple[np.ndarray, int]]:
+        data = self.get(key, kind)
+        if data is None:
+            return None
+        (sr,) = struct.unpack_from("<I", data)
+        return np.frombuffer(data, dtype="<f4", offset=4), sr  # read-only view, no copy
+
+    def put_array(self, key: str, audio: np.ndarray, sr: int):
+        self.put(key, struct.pack("<I", sr) + np.ascontiguousarray(audio, dtype="<f4").tobytes())
+
+    # ── tiers ──
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.max_mem_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None: self._mem_bytes -= len(old)
+        self._mem[key] = data
+        self._mem_bytes += len(data)
+        while self._mem_bytes > self.max_mem_bytes:
+            _, evicted = self._mem.popitem(last=False)
+            self._mem_bytes -= len(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.bin")
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        if not self.root:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # mtime doubles as "last used" for pruning
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, data: bytes):
+        if not self.root or self.max_disk_bytes <= 0:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[audio_cache] could not write {path}: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._scan())
+            else:
+                self._disk_bytes += len(data)
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._prune_disk()
+
+    def _scan(self):
+        for sub in os.listdir(self.root):
+            d = os.path.join(self.root, sub)
+            if not os.path.isdir(d): continue
+            for name in os.listdir(d):
+                if not name.endswith(".bin"): continue
+                p = os.path.join(d, name)
+                try: st = os.stat(p)
+                except OSError: continue
+                yield p, st.st_size, st.st_mtime
+
+    def _prune_disk(self):
+        files = sorted(self._scan(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_disk_bytes * 0.9)
+        for path, size, _ in files:
+            if total <= target: break
+            try:
+                os.remove(path); total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {"mem_entries": len(self._mem), "mem_bytes": self._mem_bytes,
+                    "disk_bytes": self._disk_bytes, "by_kind": {k: dict(v) for k, v in self.stats.items()}}
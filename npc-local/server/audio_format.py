@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/audio_format.py — reply audio formats (WAV, raw PCM, Ogg/Opus) and response negotiation
+import json, uuid
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+
+from fastapi import HTTPException
+
+from audio import OPUS_RATES, encode_ogg_opus, resample_pcm16, wav_header, wav_pcm16
+
+# format name -> media types that select it in an Accept header (the first is the one we send)
+FORMATS: Dict[str, Tuple[str, ...]] = {
+    "wav": ("audio/wav", "audio/x-wav", "audio/wave"),
+    "opus": ("audio/ogg", "audio/opus"),
+    "pcm": ("audio/pcm", "audio/x-raw"),  # s16le
+    "l16": ("audio/l16",),                # s16be (RFC 2586)
+}
+MIN_RATE, MAX_RATE = 8000, 48000
+MIN_BITRATE, MAX_BITRATE = 6000, 510000  # libopus limits
+
+class AudioFormat:
+    """What the client gets back: `name` in FORMATS, `sample_rate` 0 = as synthesized, Opus `bitrate` in bit/s."""
+    __slots__ = ("name", "sample_rate", "bitrate")
+
+    def __init__(self, name: str = "wav", sample_rate: int = 0, bitrate: int = 24000):
+        name = (name or "wav").lower()
+        if name not in FORMATS:
+            raise HTTPException(400, f"audio_format must be one of {', '.join(FORMATS)}")
+        if sample_rate and not MIN_RATE <= sample_rate <= MAX_RATE:
+            raise HTTPException(400, f"sample_rate must be 0 or {MIN_RATE}..{MAX_RATE}")
+        if name == "opus" and sample_rate and sample_rate not in OPUS_RATES:
+            raise HTTPException(400, f"Opus sample_rate must be one of {', '.join(map(str, OPUS_RATES))}")
+        if not MIN_BITRATE <= bitrate <= MAX_BITRATE:
+            raise HTTPException(400, f"bitrate must be {MIN_BITRATE}..{MAX_BITRATE} bit/s")
+        self.name, self.sample_rate, self.bitrate = name, sample_rate, bitrate
+
+    @property
+    def passthrough(self) -> bool:
+        """The synthesized WAV can be sent as is."""
+        return self.name == "wav" and not self.sample_rate
+
+    def replace(self, name: Optional[str] = None, sample_rate: Optional[int] = None, bitrate: Optional[int] = None):
+        return AudioFormat(name or self.name, self.sample_rate if sample_rate is None else sample_rate,
+                           bitrate or self.bitrate)
+
+def parse_accept(accept: Optional[str]) -> List[Tuple[str, float]]:
+    """[(media range, q)] in header order; parameters other than q are dropped."""
+    out = []
+    for item in (accept or "").split(","):
+        kind, *params = [p.strip() for p in item.split(";")]
+        if not kind: continue
+        q = 1.0
+        for p in params:
+            if p.lower().startswith("q="):
+                try: q = float(p[2:])
+                except ValueError: q = 0.0
+        out.append((kind.lower(), q))
+    return out
+
+def best_match(accept: Optional[str], offers: Sequence[str]) -> Optional[str]:
+    """The offer the Accept header ranks highest (most specific range decides its q; ties go to
+    offer order), or None without an Accept header or when nothing offered is acceptable."""
+    ranges = parse_accept(accept)
+    if not ranges:
+        return None
+    best, best_q = None, 0.0
+    for offer in offers:
+        major = offer.split("/")[0]
+        q, specificity = 0.0, -1
+        for kind, kq in ranges:
+            s = 2 if kind == offer else 1 if kind == f"{major}/*" else 0 if kind == "*/*" else -1
+            if s > specificity: q, specificity = kq, s
+        if q > best_q: best, best_q = offer, q
+    return best
+
+def negotiate(accept: Optional[str], default: AudioFormat, audio_format: Optional[str] = None,
+              sample_rate: Optional[int] = None, bitrate: Optional[int] = None) -> AudioFormat:
+    """An explicit `audio_format` wins; otherwise the best audio type in Accept, with the default
+    first so `audio/*` or `*/*` keep it."""
+    if not audio_format:
+        offers = [m for name in [default.name] + [n for n in FORMATS if n != default.name] for m in FORMATS[name]]
+        match = best_match(accept, offers)
+        audio_format = next((n for n, types in FORMATS.items() if match in types), None)
+    return default.replace(audio_format, sample_rate, bitrate)
+
+def encode(wav: bytes, fmt: AudioFormat) -> Tuple[bytes, str]:
+    """Mono PCM_16 WAV from the TTS path -> (body, Content-Type) in `fmt`."""
+    if fmt.passthrough:
+        return wav, "audio/wav"
+    pcm, sr = wav_pcm16(wav)
+    out_sr = fmt.sample_rate or sr
+    if fmt.name == "opus" and out_sr not in OPUS_RATES:
+        out_sr = min((r for r in OPUS_RATES if r >= out_sr), default=OPUS_RATES[-1])
+    pcm = resample_pcm16(pcm, sr, out_sr)
+    if fmt.name == "opus":
+        return encode_ogg_opus(pcm, out_sr, fmt.bitrate), "audio/ogg; codecs=opus"
+    if fmt.name == "wav":
+        return wav_header(pcm.shape[0], out_sr) + pcm.tobytes(), "audio/wav"
+    if fmt.name == "l16":
+        return pcm.astype(">i2").tobytes(), f"audio/L16; rate={out_sr}; channels=1"
+    return pcm.tobytes(), f"audio/pcm; rate={out_sr}; channels=1"
+
+def multipart(meta: Dict, audio: bytes, media_type: str) -> Tuple[bytes, str]:
+    """multipart/mixed body: a JSON part with the texts, then the audio part as raw bytes."""
+    boundary = uuid.uuid4().hex
+    body = b"".join((
+        f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode("ascii"),
+        json.dumps(meta).encode("utf-8"),
+        f"\r\n--{boundary}\r\nContent-Type: {media_type}\r\nContent-Length: {len(audio)}\r\n\r\n".encode("ascii"),
+        audio,
+        f"\r\n--{boundary}--\r\n".encode("ascii"),
+    ))
+    return body, f"multipart/mixed; boundary={boundary}"
+
+def header_text(text: str) -> str:
+    """Percent-encoded UTF-8, safe for a response header (X-Transcript, X-Reply-Text)."""
+    return quote(text, safe=" ,.;:!?'()")
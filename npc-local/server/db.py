@@ -1,11 +1,22 @@
 # server/db.py
 import os, datetime, uuid
 from typing import Optional
-from sqlalchemy import create_engine, Integer, String, Text, ForeignKey, DateTime
+from sqlalchemy import create_engine, event, inspect, text, Float, Integer, String, Text, ForeignKey, DateTime, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker
 
 DB_PATH = os.getenv("DB_PATH", "/data/npcs.db")
 engine = create_engine(f"sqlite:///{DB_PATH}", future=True)
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    # WAL: readers never block the writer; NORMAL is durable across app crashes in WAL mode
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache per connection
+    cur.close()
 SessionLocal = sessionmaker(engine, expire_on_commit=False, future=True)
 
 class Base(DeclarativeBase):
@@ -22,22 +33,27 @@ class NPC(Base):
     voice_ref: Mapped[Optional[str]] = mapped_column(String(512), default=None) # filename in /app/voices or absolute
     voice_path: Mapped[Optional[str]] = mapped_column(String(512), default=None) # stored per-NPC under /data/voices/{id}/voice.wav
     api_key: Mapped[Optional[str]] = mapped_column(String(64), default=None)
+    stt_model: Mapped[Optional[str]] = mapped_column(String(64), default=None)  # Whisper model for its players (WHISPER_MODELS)
+    retention_days: Mapped[Optional[float]] = mapped_column(Float, default=None)  # compact older history (None = HISTORY_RETENTION_DAYS, 0 = never)
     created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow)
 
     sessions: Mapped[list["ChatSession"]] = relationship(back_populates="npc", cascade="all, delete-orphan")
 
 class ChatSession(Base):
     __tablename__ = "chat_session"
+    __table_args__ = (Index("uq_chat_session_npc_session", "npc_id", "session_id", unique=True),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     npc_id: Mapped[int] = mapped_column(ForeignKey("npc.id", ondelete="CASCADE"))
     session_id: Mapped[str] = mapped_column(String(120), index=True)
     created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow)
+    compacted: Mapped[Optional[int]] = mapped_column(Integer, default=0)  # user/assistant messages moved to message_archive
 
     npc: Mapped["NPC"] = relationship(back_populates="sessions")
     messages: Mapped[list["Message"]] = relationship(back_populates="session", cascade="all, delete-orphan")
 
 class Message(Base):
     __tablename__ = "message"
+    __table_args__ = (Index("ix_message_session_created", "chat_session_id", "created_at"),)
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     chat_session_id: Mapped[int] = mapped_column(ForeignKey("chat_session.id", ondelete="CASCADE"))
     role: Mapped[str] = mapped_column(String(16))  # "system" | "user" | "assistant"
@@ -46,8 +62,40 @@ class Message(Base):
 
     session: Mapped["ChatSession"] = relationship(back_populates="messages")
 
+class MessageArchive(Base):
+    """Messages compacted out of `message` by the retention job (see retention.py), in their original order."""
+    __tablename__ = "message_archive"
+    __table_args__ = (Index("ix_message_archive_session", "chat_session_id", "id"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    message_id: Mapped[int] = mapped_column(Integer)  # its id in `message`
+    chat_session_id: Mapped[int] = mapped_column(ForeignKey("chat_session.id", ondelete="CASCADE"))
+    role: Mapped[str] = mapped_column(String(16))
+    content: Mapped[str] = mapped_column(Text)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+class ChatScratch(Base):
+    """/chat and /persona sessions when CHAT_SESSION_STORE=sqlite (see session_store.py)."""
+    __tablename__ = "chat_scratch"
+    session_id: Mapped[str] = mapped_column(String(120), primary_key=True)
+    data: Mapped[str] = mapped_column(Text)  # JSON list of {"role", "content"}
+    version: Mapped[int] = mapped_column(Integer, default=1)
+    updated_at: Mapped[float] = mapped_column(Float, index=True)  # unix time
+
 def init_db():
     Base.metadata.create_all(engine)
+    # create_all skips existing tables, so add columns (nullable) and indexes introduced later to older databases
+    for table in Base.metadata.sorted_tables:
+        have = {c["name"] for c in inspect(engine).get_columns(table.name)}
+        for col in table.columns:
+            if col.name in have: continue
+            try:  # another worker may have just added it
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(engine.dialect)}"))
+            except Exception as e: print(f"[init_db] could not add {table.name}.{col.name}: {e}")
+    for table in (ChatSession.__table__, Message.__table__):
+        for index in table.indexes:
+            try: index.create(engine, checkfirst=True)
+            except Exception as e: print(f"[init_db] could not create {index.name}: {e}")
 
 def new_api_key() -> str:
     return uuid.uuid4().hex
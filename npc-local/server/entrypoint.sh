@@ -30,5 +30,18 @@ export CONTEXT_TOKENS=${CONTEXT_TOKENS:-8192}
 export LLM_MAX_TOKENS=${LLM_MAX_TOKENS:-120}
 export LLM_THREADS=${LLM_THREADS:-0} # 0=auto in Ollama
 
+# Optional: MODEL_HOST_PROCS model-host processes own Whisper/XTTS and API workers stay thin, so
+# UVICORN_WORKERS can follow the core count while model memory stays constant (see model_host.py)
+if [ "${MODEL_HOST_PROCS:-0}" -gt 0 ]; then
+  MODEL_HOST=""
+  for i in $(seq 1 "$MODEL_HOST_PROCS"); do
+    sock="/tmp/npc-models-$i.sock"
+    python model_host.py "$sock" &
+    MODEL_HOST="${MODEL_HOST:+$MODEL_HOST,}$sock"
+  done
+  export MODEL_HOST
+  echo "[entrypoint] $MODEL_HOST_PROCS model host(s): $MODEL_HOST"
+fi
+
 # Boot the API
 exec uvicorn main:app --host 0.0.0.0 --port 8000 --workers ${UVICORN_WORKERS:-1}
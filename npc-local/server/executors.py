@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/executors.py — bounded per-model executors (keep blocking inference off the event loop)
+import asyncio, threading, time, weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+
+from metrics import POOL_REJECTED, QUEUE_WAIT_SECONDS, REGISTRY
+
+_pools: "weakref.WeakSet[InferencePool]" = weakref.WeakSet()
+
+class InferencePool:
+    """A fixed number of worker threads for one model plus a bounded wait queue.
+
+    - admission: when `workers + max_queue` jobs are already pending the call fails fast with
+      503 + Retry-After instead of piling up behind a slow model;
+    - timeouts: a job still waiting in the queue when its deadline passes (or when the request
+      is cancelled) is dropped before it ever runs; a job already running finishes in its thread
+      and keeps its slot until then, so backpressure reflects real model load.
+    """
+    def __init__(self, name: str, workers: int, max_queue: int, timeout_s: float, retry_after_s: int = 2):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.timeout_s = timeout_s
+        self.retry_after_s = retry_after_s
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{name}-pool")
+        self._lock = threading.Lock()
+        self._pending = 0  # queued + running
+        self._slots: Optional[asyncio.Semaphore] = None  # concurrency for async jobs (see spawn)
+        _pools.add(self)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def queued(self) -> int:
+        return max(0, self._pending - self.workers)
+
+    def _admit(self):
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                POOL_REJECTED.inc(pool=self.name)
+                raise HTTPException(503, f"{self.name} is overloaded, retry later",
+                                    headers={"Retry-After": str(self.retry_after_s)})
+            self._pending += 1
+
+    def _release(self, _fut=None):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, fn: Callable, *args, **kwargs) -> "asyncio.Future":
+        """Admit and enqueue `fn`; returns an awaitable whose cancellation drops the job if still queued."""
+        self._admit()
+        queued_at = time.perf_counter()
+
+        def job():
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued_at, pool=self.name)
+            return fn(*args, **kwargs)
+        try:
+            fut = self._pool.submit(job)
+        except BaseException:
+            self._release()
+            raise
+        fut.add_done_callback(self._release)  # fires on completion *or* successful cancel
+        return asyncio.wrap_future(fut)
+
+    def spawn(self, fn: Callable[..., Awaitable], *args, timeout: Optional[float] = None, **kwargs) -> "asyncio.Task":
+        """Admit an *async* job (e.g. streamed HTTP to the LLM) and start it as a task.
+
+        Same admission and deadline rules as `submit`, but the concurrency limit is a semaphore
+        instead of threads. Cancelling the task cancels the job wherever it is.
+        """
+        self._admit()
+
+        async def guarded():
+            try:
+                return await asyncio.wait_for(self._in_slot(fn, *args, **kwargs), timeout or self.timeout_s)
+            except asyncio.TimeoutError:
+                raise HTTPException(504, f"{self.name} timed out")
+        try:
+            task = asyncio.ensure_future(guarded())
+        except BaseException:
+            self._release()
+            raise
+        task.add_done_callback(self._release)  # also when cancelled before its first step
+        return task
+
+    async def _in_slot(self, fn, *args, **kwargs):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        queued_at = time.perf_counter()
+        async with self._slots:
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - queued_at, pool=self.name)
+            return await fn(*args, **kwargs)
+
+    async def run_async(self, fn: Callable[..., Awaitable], *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        return await self.spawn(fn, *args, timeout=timeout, **kwargs)
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        fut = self.submit(fn, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(fut, timeout or self.timeout_s)
+        except asyncio.TimeoutError:
+            raise HTTPException(504, f"{self.name} timed out")
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+@REGISTRY.collector
+def _pool_depth():
+    pools = list(_pools)
+    yield ("npc_pool_pending", "gauge", "Jobs admitted to a pool (queued + running)",
+           [("npc_pool_pending", {"pool": p.name}, p.pending) for p in pools])
+    yield ("npc_pool_queued", "gauge", "Jobs waiting for a pool worker",
+           [("npc_pool_queued", {"pool": p.name}, p.queued) for p in pools])
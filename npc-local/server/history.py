@@ -0,0 +1,221 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/history.py — NPC conversation history: ring buffers in front, batched writes behind
+import datetime, threading
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from db import NPC, ChatSession, Message, MessageArchive
+
+TURNS = ("user", "assistant")
+
+class HistoryStore:
+    """Recent turns per chat session served from memory, persisted write-behind.
+
+    - `session_pk` maps (npc_id, session_id) to the chat_session row, creating it (plus its
+      system message) in a single commit the first time; with rings the mapping is cached, in an
+      LRU of the same `max_sessions`;
+    - `recent` returns the last `max_messages` user/assistant turns from a per-session ring
+      buffer, loading it from SQLite only on first use (or after LRU eviction); `window` also
+      returns how many user/assistant messages the session has in total (incl. compacted ones);
+    - `page` and `export_npc` read the persisted history in id order, a bounded chunk at a time;
+    - `append` updates the ring and queues the row; a writer thread inserts queued rows in one
+      transaction every `flush_interval_s` or as soon as `flush_batch` rows are waiting.
+
+    Rings are per process: with several API workers, whose requests for one session land on any of
+    them, use `max_sessions=0`. Every turn is then read from the database and nothing is cached
+    here that another worker could make stale (its turns, a deleted NPC's session ids).
+    """
+    def __init__(self, session_factory: Callable[[], Session], max_messages: int, max_sessions: int = 2048,
+                 flush_interval_s: float = 0.05, flush_batch: int = 256):
+        self._session_factory = session_factory
+        self.max_messages = max(0, max_messages)
+        self.max_sessions = max(0, max_sessions)
+        self.flush_interval_s = flush_interval_s
+        self.flush_batch = max(1, flush_batch)
+        self._rings: "OrderedDict[int, Deque[Tuple[str, str]]]" = OrderedDict()
+        self._totals: Dict[int, int] = {}  # chat_pk -> user/assistant messages ever, for ringed sessions
+        self._pks: "OrderedDict[Tuple[int, str], int]" = OrderedDict()
+        self._pending: List[Dict] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()  # one writer transaction at a time
+        self._writer: Optional[threading.Thread] = None
+        self._closed = False
+
+    # ── sessions ──
+    def session_pk(self, db: Session, npc: NPC, session_id: str, create: bool = True) -> Optional[int]:
+        with self._lock:
+            pk = self._pks.get((npc.id, session_id))
+            if pk is not None:
+                self._pks.move_to_end((npc.id, session_id))
+                return pk
+        row = db.query(ChatSession.id).filter_by(npc_id=npc.id, session_id=session_id).first()
+        if row is None:
+            if not create:
+                return None
+            chat = ChatSession(npc_id=npc.id, session_id=session_id)
+            try:
+                db.add(chat); db.flush()
+                # ensure system message exists in persistent history
+                db.add(Message(chat_session_id=chat.id, role="system", content=npc.persona))
+                db.commit()
+                pk = chat.id
+            except IntegrityError:  # another request created it first
+                db.rollback()
+                pk = db.query(ChatSession.id).filter_by(npc_id=npc.id, session_id=session_id).scalar()
+        else:
+            pk = row[0]
+        if self.max_sessions > 0:
+            with self._lock:
+                self._pks[(npc.id, session_id)] = pk
+                while len(self._pks) > self.max_sessions:
+                    self._pks.popitem(last=False)
+        return pk
+
+    # ── reads ──
+    def recent(self, db: Session, chat_pk: int) -> List[Tuple[str, str]]:
+        return self.window(db, chat_pk)[1]
+
+    def window(self, db: Session, chat_pk: int) -> Tuple[int, List[Tuple[str, str]]]:
+        """(total user/assistant messages in the session, the last `max_messages` of them)."""
+        with self._lock:
+            ring = self._rings.get(chat_pk)
+            if ring is not None:
+                self._rings.move_to_end(chat_pk)
+                return self._totals[chat_pk], list(ring)
+        self.flush()  # the DB must include anything still queued for this session
+        turns = Message.chat_session_id == chat_pk, Message.role.in_(TURNS)
+        total = (db.query(func.count(Message.id)).filter(*turns).scalar() or 0) + \
+                (db.query(ChatSession.compacted).filter_by(id=chat_pk).scalar() or 0)  # totals stay put across retention
+        rows = db.query(Message.role, Message.content).filter(*turns) \
+                 .order_by(Message.created_at.desc(), Message.id.desc()).limit(self.max_messages).all()
+        ring = deque(reversed([(r.role, r.content) for r in rows]), maxlen=self.max_messages)
+        with self._lock:
+            if self.max_sessions > 0:
+                if chat_pk in self._rings:  # loaded concurrently; that one may already have newer turns
+                    ring = self._rings[chat_pk]
+                else:
+                    self._rings[chat_pk] = ring
+                    self._totals[chat_pk] = total
+                self._rings.move_to_end(chat_pk)
+                total = self._totals[chat_pk]
+                while len(self._rings) > self.max_sessions:
+                    evicted, _ = self._rings.popitem(last=False)
+                    self._totals.pop(evicted, None)
+            return total, list(ring)
+
+    def page(self, db: Session, chat_pk: int, cursor: Optional[int] = None, limit: int = 200,
+             newest_first: bool = False, archived: bool = False) -> Tuple[List[Dict], Optional[int]]:
+        """Keyset page of a session's messages (or of its archive): those after `cursor` in id order,
+        or before it when `newest_first`. Returns them and the cursor of the next page (None at the end)."""
+        self.flush()
+        table = MessageArchive if archived else Message
+        q = db.query(table).filter(table.chat_session_id == chat_pk)
+        if cursor is not None: q = q.filter(table.id < cursor if newest_first else table.id > cursor)
+        rows = q.order_by(table.id.desc() if newest_first else table.id.asc()).limit(limit + 1).all()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        return [_item(m) for m in rows], (rows[-1].id if more else None)
+
+    def export_npc(self, npc_id: int, session_id: Optional[str] = None, chunk: int = 1000) -> Iterator[Dict]:
+        """Every message of an NPC, session by session, archived ones first. Each chunk is its own
+        short read, so an export never holds a transaction open while the client downloads."""
+        self.flush()
+        sessions = select(ChatSession.id, ChatSession.session_id).where(ChatSession.npc_id == npc_id)
+        if session_id is not None: sessions = sessions.where(ChatSession.session_id == session_id)
+        with self._session_factory() as db:
+            chats = db.execute(sessions.order_by(ChatSession.id)).all()
+        for chat_pk, sid in chats:
+            for table in (MessageArchive, Message):
+                last = 0
+                while True:
+                    with self._session_factory() as db:
+                        rows = db.query(table).filter(table.chat_session_id == chat_pk, table.id > last) \
+                                 .order_by(table.id).limit(chunk).all()
+                    for m in rows:
+                        yield {"session_id": sid, **_item(m), "archived": table is MessageArchive}
+                    if len(rows) < chunk: break
+                    last = rows[-1].id
+
+    # ── writes ──
+    def append(self, chat_pk: int, role: str, content: str):
+        row = {"chat_session_id": chat_pk, "role": role, "content": content,
+               "created_at": datetime.datetime.utcnow()}
+        with self._lock:
+            ring = self._rings.get(chat_pk)
+            if ring is not None:
+                ring.append((role, content))
+                self._totals[chat_pk] += 1
+            self._pending.append(row)
+            if len(self._pending) >= self.flush_batch: self._wake.notify()
+        self._ensure_writer()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return
+            db = self._session_factory()
+            try:
+                db.execute(insert(Message), rows)
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                with self._lock:  # keep them for the next attempt, in order
+                    self._pending[:0] = rows
+                print(f"[history] flush of {len(rows)} messages failed: {e}")
+            finally:
+                db.close()
+
+    def delete_npc(self, db: Session, npc_id: int):
+        """Delete an NPC's sessions and messages with a few set-based statements (queued writes
+        first, so none land after the delete). The caller commits, together with the NPC row."""
+        self.flush(); self.forget_npc(npc_id)
+        pks = [pk for (pk,) in db.query(ChatSession.id).filter_by(npc_id=npc_id)]
+        for i in range(0, len(pks), 500):  # an id list: SQLite runs IN (subquery) deletes several times slower
+            chunk = pks[i:i + 500]
+            db.execute(delete(Message).where(Message.chat_session_id.in_(chunk)))
+            db.execute(delete(MessageArchive).where(MessageArchive.chat_session_id.in_(chunk)))
+        db.execute(delete(ChatSession).where(ChatSession.npc_id == npc_id))
+
+    def forget_npc(self, npc_id: int):
+        """Drop cached state for a deleted NPC (call after flush, before deleting its rows)."""
+        with self._lock:
+            pks = {pk for (nid, _), pk in self._pks.items() if nid == npc_id}
+            self._pks = OrderedDict((k, v) for k, v in self._pks.items() if k[0] != npc_id)
+            for pk in pks:
+                self._rings.pop(pk, None); self._totals.pop(pk, None)
+            self._pending = [r for r in self._pending if r["chat_session_id"] not in pks]
+
+    def _ensure_writer(self):
+        if self._writer is None and not self._closed:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+                    self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                if len(self._pending) < self.flush_batch and not self._closed:
+                    self._wake.wait(self.flush_interval_s)
+                closed = self._closed
+            self.flush()
+            if closed: return
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        if self._writer is not None:
+            self._writer.join(timeout=5)
+        self.flush()
+
+def _item(m) -> Dict:
+    return {"id": m.id, "role": m.role, "content": m.content, "at": m.created_at.isoformat()}
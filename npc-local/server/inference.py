@@ -0,0 +1,231 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/inference.py — the models (Whisper, XTTS) and everything that runs next to them
+#
+# main.py talks to this module through a small interface — transcribe, stt_model_names,
+# synthesize_ssml, warm_speaker_latents, load, warm, summary — either in-process (the default) or through
+# model_host.py, which imports it in one separate process shared by all API workers.
+import os, shutil, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from speaker_cache import SpeakerLatentCache
+from ssml import compile_ssml
+from audio import WHISPER_SR, encode_wav_segments
+from audio_cache import AudioCache, normalize_text
+from stt_batcher import whisper_transcribe_one, whisper_transcribe_batch
+from stt_models import WhisperModels, parse_routes
+from metrics import REGISTRY, TTS_PART_SECONDS, TTS_RTF
+
+# ── Config ──────────────────────────────────────────────────────────────────
+WHISPER_SIZE = os.getenv("WHISPER_SIZE", "small")
+WHISPER_COMPUTE = os.getenv("WHISPER_COMPUTE", "int8")
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", "8"))            # 1 = no batching
+WHISPER_BATCH_WINDOW_MS = float(os.getenv("WHISPER_BATCH_WINDOW_MS", "30"))  # wait this long for a batch to fill
+# More Whisper models next to WHISPER_SIZE ("size" or "size:compute"), picked per clip: the request's
+# stt_model, else the NPC's, else WHISPER_LANG_MODELS by language hint, else WHISPER_SHORT_MODEL for
+# clips up to WHISPER_SHORT_S; loaded on first use, least recently used unloaded over WHISPER_MEMORY_MB
+WHISPER_MODELS = [m.strip() for m in os.getenv("WHISPER_MODELS", "").split(",") if m.strip()]  # selectable as well
+WHISPER_LANG_MODELS = parse_routes(os.getenv("WHISPER_LANG_MODELS", ""))  # e.g. "de=medium,ja=medium:float16"
+WHISPER_SHORT_MODEL = os.getenv("WHISPER_SHORT_MODEL", "")                # e.g. "base"
+WHISPER_SHORT_S = float(os.getenv("WHISPER_SHORT_S", "2.0"))
+WHISPER_MEMORY_MB = int(os.getenv("WHISPER_MEMORY_MB", "0"))              # estimated sizes; 0 = no limit
+
+TTS_GLOBAL_RATE = float(os.getenv("TTS_GLOBAL_RATE", "1.0"))
+SSML_MERGE_BREAK_MS = int(os.getenv("SSML_MERGE_BREAK_MS", "0"))  # breaks up to this long become a comma (one model call)
+TTS_SEGMENT_THREADS = int(os.getenv("TTS_SEGMENT_THREADS", "1"))  # >1: overlap part cache lookups (model calls stay serial)
+
+VOICES_STORAGE = os.getenv("VOICES_STORAGE", "/data/voices")  # per-NPC saved voices (latents go to _latents/)
+SPEAKER_CACHE_SIZE = int(os.getenv("SPEAKER_CACHE_SIZE", "32"))  # voices whose XTTS latents stay in memory
+
+# Synthesized-audio cache (repeated lines skip XTTS): memory LRU + disk tier, sizes in MB (0 = off)
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "/data/tts_cache")
+AUDIO_CACHE_MB = int(os.getenv("AUDIO_CACHE_MB", "256"))
+AUDIO_CACHE_DISK_MB = int(os.getenv("AUDIO_CACHE_DISK_MB", "2048"))
+
+# ── Models (lazy/robust) ────────────────────────────────────────────────────
+# faster_whisper / TTS / torch are imported on first use so the app (and /healthz) comes up at
+# once; main's warm-up loads them in the background.
+_tts = None
+_tts_lock = threading.Lock()
+# XTTS keeps per-call state on the model (the GPT prefix embedding), so inferences on one model
+# instance never overlap; threads still overlap everything around them (cache, latents, encoding)
+_tts_infer_lock = threading.Lock()
+_segment_pool = ThreadPoolExecutor(TTS_SEGMENT_THREADS, thread_name_prefix="tts-part") if TTS_SEGMENT_THREADS > 1 else None
+TTS_MODEL_NAME = "tts_models/multilingual/multi-dataset/xtts_v2"
+
+def _load_whisper(size: str, compute: str):
+    from faster_whisper import WhisperModel
+    return WhisperModel(size, device="auto", compute_type=compute)
+
+# concurrent clips for one model within WHISPER_BATCH_WINDOW_MS are decoded as one batch
+whisper_models = WhisperModels(_load_whisper,
+                               lambda model, audio, lang: whisper_transcribe_one(model, audio, lang),
+                               lambda model, audios, langs: whisper_transcribe_batch(model, audios, langs),
+                               WHISPER_SIZE, WHISPER_MODELS, WHISPER_LANG_MODELS, WHISPER_SHORT_MODEL,
+                               WHISPER_SHORT_S, WHISPER_MEMORY_MB, WHISPER_COMPUTE,
+                               max_batch=WHISPER_BATCH_SIZE, window_ms=WHISPER_BATCH_WINDOW_MS)
+
+def get_whisper():
+    """The default model (warm-up)."""
+    return whisper_models.get()
+
+def get_tts():
+    global _tts
+    if _tts is None:
+        with _tts_lock:  # one load even if several requests (or the warm-up) ask at once
+            if _tts is None:
+                _tts = _load_tts()
+    return _tts
+
+def _load_tts():
+    os.environ.setdefault("COQUI_TOS_AGREED", "1")
+    from TTS.api import TTS
+    try:
+        import torch
+        use_gpu = torch.cuda.is_available()
+    except Exception:
+        use_gpu = False
+    try:
+        return TTS(model_name=TTS_MODEL_NAME, gpu=use_gpu)
+    except Exception:
+        base = os.getenv("TTS_HOME", "/root/.local/share/tts")
+        broken = os.path.join(base, "tts", "tts_models--multilingual--multi-dataset--xtts_v2")
+        shutil.rmtree(broken, ignore_errors=True)
+        return TTS(model_name=TTS_MODEL_NAME, gpu=use_gpu)
+
+def get_xtts():
+    """The underlying Xtts model if it supports precomputed speaker latents, else None."""
+    model = getattr(getattr(get_tts(), "synthesizer", None), "tts_model", None)
+    return model if hasattr(model, "get_conditioning_latents") else None
+
+def _compute_speaker_latents(path: str):
+    model = get_xtts()
+    cfg = model.config
+    return model.get_conditioning_latents(
+        audio_path=[path], gpt_cond_len=cfg.gpt_cond_len, gpt_cond_chunk_len=cfg.gpt_cond_chunk_len,
+        max_ref_length=cfg.max_ref_len, sound_norm_refs=cfg.sound_norm_refs)
+
+# XTTS speaker conditioning, computed once per voice file content (memory LRU + VOICES_STORAGE/_latents)
+speaker_latents = SpeakerLatentCache(_compute_speaker_latents, os.path.join(VOICES_STORAGE, "_latents"),
+                                     SPEAKER_CACHE_SIZE, device=lambda: get_xtts().device)
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR if AUDIO_CACHE_DISK_MB > 0 else None,
+                         AUDIO_CACHE_MB * 1024 * 1024, AUDIO_CACHE_DISK_MB * 1024 * 1024)
+
+def warm_speaker_latents(path: Optional[str]):
+    """Background task after a voice upload/change so the first reply doesn't pay for conditioning."""
+    try:
+        if path and os.path.exists(path) and get_xtts() is not None:
+            speaker_latents.get(path)
+    except Exception as e:
+        print(f"[warm_speaker_latents] {path}: {e}")
+
+def tts_segment(plain: str, rate: float, speaker_wav: str, language: str) -> Tuple[np.ndarray, int]:
+    """One text part -> (float32 audio, sample rate), straight from the model (no temp WAV)."""
+    t = time.perf_counter()
+    audio, sr = _tts_segment(plain, rate, speaker_wav, language)
+    elapsed = time.perf_counter() - t
+    TTS_PART_SECONDS.observe(elapsed)
+    if len(audio): TTS_RTF.observe(elapsed / (len(audio) / sr))
+    return audio, sr
+
+def _tts_segment(plain: str, rate: float, speaker_wav: str, language: str) -> Tuple[np.ndarray, int]:
+    xtts = get_xtts()
+    if xtts is not None:
+        gpt_cond_latent, speaker_embedding = speaker_latents.get(speaker_wav)
+        cfg = xtts.config
+        with _tts_infer_lock:
+            out = xtts.inference(plain, language, gpt_cond_latent, speaker_embedding, speed=rate,
+                                 temperature=cfg.temperature, length_penalty=cfg.length_penalty,
+                                 repetition_penalty=cfg.repetition_penalty, top_k=cfg.top_k, top_p=cfg.top_p,
+                                 enable_text_splitting=True)
+        return np.asarray(out["wav"], dtype="float32"), cfg.audio.output_sample_rate
+    tts = get_tts()
+    with _tts_infer_lock:
+        wav = tts.tts(text=plain, speaker_wav=speaker_wav, language=language, speed=rate)
+    return np.asarray(wav, dtype="float32"), tts.synthesizer.output_sample_rate
+
+def tts_segment_cached(plain: str, rate: float, speaker_wav: str, voice_hash: str, language: str) -> Tuple[np.ndarray, int]:
+    key = audio_cache.make_key("part", TTS_MODEL_NAME, voice_hash, language, rate, normalize_text(plain))
+    hit = audio_cache.get_array(key, "part")
+    if hit is not None:
+        return hit
+    audio, sr = tts_segment(plain, rate, speaker_wav, language)
+    audio_cache.put_array(key, audio, sr)
+    return audio, sr
+
+def synthesize_ssml(text_or_ssml: str, speaker_wav: str, language: str="en") -> bytes:
+    # whole-reply hit first (barks, greetings, the "Okay." fallback), then per SSML part
+    voice_hash = speaker_latents.voice_hash(speaker_wav)
+    reply_key = audio_cache.make_key("reply", TTS_MODEL_NAME, voice_hash, language, TTS_GLOBAL_RATE,
+                                     SSML_MERGE_BREAK_MS, normalize_text(text_or_ssml))  # every setting compile_ssml uses
+    wav = audio_cache.get(reply_key, "reply")
+    if wav is not None:
+        return wav
+    parts = compile_ssml(text_or_ssml, TTS_GLOBAL_RATE, SSML_MERGE_BREAK_MS)
+    # one job per distinct (text, rate): a repeated line in the reply is synthesized once
+    jobs = list(dict.fromkeys((p.text, p.rate) for p in parts))
+    if _segment_pool is not None and len(jobs) > 1:
+        futures = [_segment_pool.submit(tts_segment_cached, t, r, speaker_wav, voice_hash, language) for t, r in jobs]
+        done = dict(zip(jobs, (f.result() for f in futures)))
+    else:
+        done = {(t, r): tts_segment_cached(t, r, speaker_wav, voice_hash, language) for t, r in jobs}
+    sr = next(iter(done.values()))[1] if done else 24000
+    segments = [(done[(p.text, p.rate)][0], p.pause_ms) for p in parts] or [(None, 200)]
+    # pauses are kept in ms because the model's sample rate is only known after synthesis;
+    # they are zero gaps in the preallocated output buffer, so silences never get their own arrays
+    wav = encode_wav_segments([(a, int((ms/1000.0)*sr)) for a, ms in segments], sr)
+    audio_cache.put(reply_key, wav)
+    return wav
+
+# ── Interface used by main.py (and served by model_host.py) ─────────────────
+def transcribe(audio: np.ndarray, lang_hint: Optional[str], model: Optional[str] = None,
+               npc_model: Optional[str] = None) -> str:
+    """float32 mono @16 kHz -> text (decoding happens in the API worker). `model` is the request's
+    choice of Whisper model (400 if unknown), `npc_model` the NPC's (ignored if unknown)."""
+    return whisper_models.transcribe(audio, lang_hint, model, npc_model)
+
+def stt_model_names() -> List[str]:
+    return whisper_models.names
+
+def load(component: str):
+    {"stt": get_whisper, "tts": get_tts}[component]()
+
+def warm(component: str, voice: Optional[str] = None):
+    """One dummy inference so kernels, allocators and caches are primed before the first request."""
+    if component == "stt":
+        # VAD would skip pure silence, so decode one second with it off to run the encoder and decoder
+        segments, _ = get_whisper().transcribe(np.zeros(WHISPER_SR, dtype="float32"), language="en",
+                                               vad_filter=False, without_timestamps=True)
+        for _ in segments: pass
+    elif component == "tts":
+        if voice is None:
+            print("[warmup] no reference voice; XTTS loaded without a dummy inference")
+            return
+        tts_segment("Hello there.", TTS_GLOBAL_RATE, voice, "en")  # also caches that voice's latents
+
+def summary() -> Dict:
+    return {"audio": audio_cache.summary(),
+            "stt_models": whisper_models.summary()}
+
+def metrics_snapshot() -> List:
+    return []  # same process: already in metrics.REGISTRY
+
+_CACHE_RESULT = {"mem_hits": "mem_hit", "disk_hits": "disk_hit", "misses": "miss"}
+
+@REGISTRY.collector
+def _inference_metrics():
+    yield ("npc_audio_cache_lookups", "counter", "Synthesized-audio cache lookups by kind and tier",
+           [("npc_audio_cache_lookups_total", {"kind": kind, "result": _CACHE_RESULT[result]}, n)
+            for kind, counters in list(audio_cache.stats.items()) for result, n in counters.items()])
+    batches, clips = whisper_models.batch_totals()
+    yield ("npc_stt_batches", "counter", "Whisper decode calls made by the batchers",
+           [("npc_stt_batches_total", {}, batches)])
+    yield ("npc_stt_batched_clips", "counter", "Clips decoded through the batchers",
+           [("npc_stt_batched_clips_total", {}, clips)])
+    yield ("npc_stt_model_loaded_mb", "gauge", "Estimated memory of each loaded Whisper model (0 = not loaded)",
+           [("npc_stt_model_loaded_mb", {"model": name}, m["est_mb"] if m["loaded"] else 0)
+            for name, m in whisper_models.summary()["models"].items()])
@@ -1,29 +1,45 @@
 # SPDX-License-Identifier: MIT
 # Copyright (c) 2025 <Reza Jari>
 # # server/main.py
-import os, io, re, base64, tempfile, shutil, datetime
+import os, re, json, base64, asyncio, time
+from contextlib import aclosing
 from typing import List, Dict, Optional, Tuple
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header, Depends
+from fastapi import (FastAPI, UploadFile, File, Form, HTTPException, Header, Depends, BackgroundTasks, Request,
+                     WebSocket, WebSocketDisconnect, WebSocketException)
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import numpy as np
-import soundfile as sf
-from faster_whisper import WhisperModel
-from TTS.api import TTS
-import requests
 from slugify import slugify
+import numpy as np
 
 # NEW: DB
 from sqlalchemy.orm import Session
-from db import init_db, SessionLocal, NPC, ChatSession, Message, new_api_key
+from db import engine, init_db, SessionLocal, NPC, new_api_key
+from audio import WHISPER_SR, decode_audio, encode_wav_segments, resample
+from audio_format import AudioFormat, best_match, encode as encode_audio, header_text, multipart, negotiate
+from executors import InferencePool
+from history import HistoryStore
+from metrics import (REGISTRY, BARGE_INS, HTTPMetricsMiddleware, LLM_FALLBACKS, LLM_REQUESTS, LLM_TOKENS,
+                     SHORT_CIRCUITS, STT_RTF, VOICE_PACK_HITS, VOICE_SESSIONS, RequestTimer, render)
+from ollama_client import FALLBACK_REPLY, OllamaClient
+from prerender import PrerenderJobs
+from prompting import PromptBuilder
+from retention import HistoryRetention
+from session_store import make_session_store
+from vad import Endpointer, voiced_ms
+from voice_pack import VoicePacks
+from warmup import Warmup
 
 KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "-1")  # keep model warm (-1 forever, "5m", etc)
 # ── Config ──────────────────────────────────────────────────────────────────
 LLM_MODEL = os.getenv("LLM_MODEL", "gpt-oss:20b")
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")  # comma list = several backends, least busy first
+OLLAMA_AFFINITY_SLACK = int(os.getenv("OLLAMA_AFFINITY_SLACK", "2"))  # a session stays on its backend unless that has this many more calls in flight (-1 = no affinity)
+OLLAMA_HEALTH_INTERVAL_S = float(os.getenv("OLLAMA_HEALTH_INTERVAL_S", "5"))  # with several backends; 0 = passive only
+OLLAMA_RETRY_DOWN_S = float(os.getenv("OLLAMA_RETRY_DOWN_S", "30"))  # passive only: a down backend gets a live call again after this
 
 CTX = int(os.getenv("CONTEXT_TOKENS", "8192"))
 LLM_TEMP     = float(os.getenv("LLM_TEMPERATURE", "0.7"))
@@ -31,41 +47,131 @@ LLM_THREADS  = int(os.getenv("LLM_THREADS", "0"))      # 0 = auto
 LLM_MAXTOK   = int(os.getenv("LLM_MAX_TOKENS", "200")) # never 0
 
 HIST_MAX_TURNS = int(os.getenv("HIST_MAX_TURNS", "10"))
-
-WHISPER_SIZE = os.getenv("WHISPER_SIZE", "small")
-WHISPER_COMPUTE = os.getenv("WHISPER_COMPUTE", "int8")
+HIST_DROP_BLOCK_TURNS = int(os.getenv("HIST_DROP_BLOCK_TURNS", str(max(1, HIST_MAX_TURNS // 2))))  # history leaves the prompt this many turns at a time
+PROMPT_RESERVE_TOKENS = int(os.getenv("PROMPT_RESERVE_TOKENS", "64"))      # headroom under CONTEXT_TOKENS - LLM_MAX_TOKENS
+PROMPT_SUMMARY = os.getenv("PROMPT_SUMMARY", "0").lower() in ("1", "true", "yes")  # replace dropped history by a rolling summary
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))  # set by entrypoint.sh; per-process caches are off by default with several
+# rings are per process and uvicorn routes requests at random: with several workers every turn reads the DB
+HISTORY_CACHE_SESSIONS = int(os.getenv("HISTORY_CACHE_SESSIONS", "0" if UVICORN_WORKERS > 1 else "2048"))  # sessions with an in-memory ring (0 = off)
+HISTORY_FLUSH_MS = float(os.getenv("HISTORY_FLUSH_MS", "50"))              # write-behind interval
+HISTORY_FLUSH_BATCH = int(os.getenv("HISTORY_FLUSH_BATCH", "256"))         # ...or flush as soon as this many wait
+HISTORY_PAGE_LIMIT = int(os.getenv("HISTORY_PAGE_LIMIT", "200"))           # page of GET /npcs/{id}/history given after/before but no limit
+HISTORY_PAGE_MAX = 1000
+
+# Retention: NPC messages older than this (per NPC: retention_days) leave the hot table; the prompt window always stays.
+# archive = moved to message_archive | summarize = same, plus an LLM summary left in their place
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "0"))  # 0 = keep everything in `message`
+HISTORY_RETENTION = os.getenv("HISTORY_RETENTION", "archive").lower()
+HISTORY_RETENTION_INTERVAL_S = float(os.getenv("HISTORY_RETENTION_INTERVAL_S", "3600"))  # 0 = never run
+HISTORY_RETENTION_BATCH = int(os.getenv("HISTORY_RETENTION_BATCH", "500"))  # rows per transaction
+
+# /chat and /persona sessions: memory (this worker, LRU+TTL) or sqlite (shared by all workers, survives restarts)
+CHAT_SESSION_STORE = os.getenv("CHAT_SESSION_STORE", "sqlite" if UVICORN_WORKERS > 1 else "memory")
+CHAT_SESSION_MAX = int(os.getenv("CHAT_SESSION_MAX", "10000"))
+CHAT_SESSION_TTL_S = float(os.getenv("CHAT_SESSION_TTL_S", "86400"))  # idle sessions expire (0 = never)
+
+# streaming replies: cut the LLM output into chunks of at least/most this many spoken chars
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "24"))
+STREAM_MAX_CHARS = int(os.getenv("STREAM_MAX_CHARS", "240"))
+
+# Reply audio: wav | opus (Ogg) | pcm (s16le) | l16 (s16be); per request via Accept or the audio_format field
+REPLY_AUDIO_FORMAT = os.getenv("REPLY_AUDIO_FORMAT", "wav")
+REPLY_SAMPLE_RATE = int(os.getenv("REPLY_SAMPLE_RATE", "0"))  # 0 = as synthesized (24 kHz)
+OPUS_BITRATE = int(os.getenv("OPUS_BITRATE", "24000"))
+
+# Voice sessions (WebSocket): server-side endpointing of streamed microphone audio
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", "30"))
+VAD_START_MS = int(os.getenv("VAD_START_MS", "120"))              # this much speech starts an utterance (and barges in)
+VAD_END_SILENCE_MS = int(os.getenv("VAD_END_SILENCE_MS", "600"))  # this much silence ends it
+VAD_MIN_DBFS = float(os.getenv("VAD_MIN_DBFS", "-45"))            # quieter frames are never speech
+VAD_SNR_DB = float(os.getenv("VAD_SNR_DB", "10"))                 # ... nor frames less than this above the noise floor
+VAD_NOISE_RISE_DB_S = float(os.getenv("VAD_NOISE_RISE_DB_S", "2"))  # the floor creeps up this fast through steady noise
+VAD_MAX_UTTERANCE_S = float(os.getenv("VAD_MAX_UTTERANCE_S", "15"))
+
+# Accidental push-to-talk: an upload without speech (checked before Whisper) or an empty/filler transcript
+# skips LLM, DB and TTS. SILENCE_REPLY: silence (200 ms of it) | clip (SILENCE_CLIP_TEXT in the NPC's
+# voice; cached after the first time) | 204 | off (full reply as before)
+SILENCE_MIN_SPEECH_MS = int(os.getenv("SILENCE_MIN_SPEECH_MS", "150"))  # voiced audio needed to run STT (0 = no pre-check)
+SILENCE_REPLY = os.getenv("SILENCE_REPLY", "silence").lower()
+STT_SILENCE_CHECK = os.getenv("STT_SILENCE_CHECK", "0") == "1"  # the pre-check on /stt and /stt_json too ("" for no speech)
+SILENCE_CLIP_TEXT = os.getenv("SILENCE_CLIP_TEXT", "Hm?")
+SILENCE_FILLERS = {w.strip().lower() for w in os.getenv(
+    "SILENCE_FILLERS", "uh,uhm,um,umm,hm,hmm,mm,mmm,mhm,ah,eh,er,erm").split(",") if w.strip()}
 
 TTS_LANGUAGE = os.getenv("TTS_LANGUAGE", "en")
-TTS_GLOBAL_RATE = float(os.getenv("TTS_GLOBAL_RATE", "1.0"))
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", "8"))  # see inference.py
+
+# Whisper/XTTS run in this process (default) or in model_host.py processes shared by all API workers
+MODEL_HOST = os.getenv("MODEL_HOST", "")  # comma list of Unix socket paths; entrypoint.sh sets it from MODEL_HOST_PROCS
+MODEL_HOST_AUTHKEY = os.getenv("MODEL_HOST_AUTHKEY", "")
+
+# Inference executors: worker threads per model, bounded wait queue (503 + Retry-After beyond it)
+# (STT workers mostly wait on the batcher, so by default there is one per batch slot)
+STT_WORKERS = int(os.getenv("STT_WORKERS", str(max(1, WHISPER_BATCH_SIZE))))
+STT_QUEUE_MAX = int(os.getenv("STT_QUEUE_MAX", "8"))
+LLM_WORKERS, LLM_QUEUE_MAX = int(os.getenv("LLM_WORKERS", "4")), int(os.getenv("LLM_QUEUE_MAX", "16"))
+TTS_WORKERS, TTS_QUEUE_MAX = int(os.getenv("TTS_WORKERS", "1")), int(os.getenv("TTS_QUEUE_MAX", "8"))
+STT_TIMEOUT_S = float(os.getenv("STT_TIMEOUT_S", "60"))
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "180"))
+TTS_TIMEOUT_S = float(os.getenv("TTS_TIMEOUT_S", "120"))
+RETRY_AFTER_S = int(os.getenv("RETRY_AFTER_S", "2"))
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "32"))          # keep-alive connections to Ollama
+DISCONNECT_POLL_S = float(os.getenv("DISCONNECT_POLL_S", "0.25"))  # how often a waiting reply checks its client
+
+# Warm-up after startup: components loaded in parallel, each with one dummy inference ("none" = all lazy)
+WARMUP = [c.strip() for c in os.getenv("WARMUP", "stt,tts").split(",") if c.strip() and c.strip() != "none"]
+WARMUP_VOICE = os.getenv("WARMUP_VOICE", "")  # reference wav for the TTS dummy inference (default: first in VOICES_DIR)
 
 # VOICES: user-mountable library + per-NPC storage
 VOICES_DIR = os.getenv("VOICES_DIR", os.path.join(os.path.dirname(__file__), "voices"))
-VOICES_STORAGE = os.getenv("VOICES_STORAGE", "/data/voices")  # per-NPC saved voices
-
-# ── Models (lazy/robust) ────────────────────────────────────────────────────
-whisper = WhisperModel(WHISPER_SIZE, device="auto", compute_type=WHISPER_COMPUTE)
-_tts = None
-
-def get_tts():
-    global _tts
-    if _tts is None:
-        os.environ.setdefault("COQUI_TOS_AGREED", "1")
-        try:
-            import torch
-            use_gpu = torch.cuda.is_available()
-        except Exception:
-            use_gpu = False
-        try:
-            _tts = TTS(model_name="tts_models/multilingual/multi-dataset/xtts_v2", gpu=use_gpu)
-        except Exception:
-            base = os.getenv("TTS_HOME", "/root/.local/share/tts")
-            broken = os.path.join(base, "tts", "tts_models--multilingual--multi-dataset--xtts_v2")
-            shutil.rmtree(broken, ignore_errors=True)
-            _tts = TTS(model_name="tts_models/multilingual/multi-dataset/xtts_v2", gpu=use_gpu)
-    return _tts
-
-# ── Sessions (in-mem; still used for quick chat), DB stores long-term ───────
-sessions: Dict[str, List[Dict[str, str]]] = {}
+VOICES_STORAGE = os.getenv("VOICES_STORAGE", "/data/voices")  # per-NPC saved voices (and voice packs)
+
+# Pre-rendered lines: 0 = render through the server's TTS (behind live traffic), N = own process pool
+PRERENDER_PROCS = int(os.getenv("PRERENDER_PROCS", "0"))  # each process loads its own XTTS
+PRERENDER_MAX_LINES = int(os.getenv("PRERENDER_MAX_LINES", "2000"))  # per job
+
+# ── Models ──────────────────────────────────────────────────────────────────
+# `models` is the inference.py interface: the module itself, or a client for the model host(s)
+if MODEL_HOST:
+    from model_host import ModelHostClient
+    models = ModelHostClient(MODEL_HOST.split(","), MODEL_HOST_AUTHKEY.encode() or None,
+                             timeout_s=max(STT_TIMEOUT_S, TTS_TIMEOUT_S), retry_after_s=RETRY_AFTER_S)
+else:
+    import inference as models
+
+# Blocking model calls never run on the event loop; each model gets its own bounded pool
+REPLY_AUDIO = AudioFormat(REPLY_AUDIO_FORMAT, REPLY_SAMPLE_RATE, OPUS_BITRATE)
+
+STT_POOL = InferencePool("stt", STT_WORKERS, STT_QUEUE_MAX, STT_TIMEOUT_S, RETRY_AFTER_S)
+LLM_POOL = InferencePool("llm", LLM_WORKERS, LLM_QUEUE_MAX, LLM_TIMEOUT_S, RETRY_AFTER_S)
+TTS_POOL = InferencePool("tts", TTS_WORKERS, TTS_QUEUE_MAX, TTS_TIMEOUT_S, RETRY_AFTER_S)
+
+# Fixed NPC lines rendered ahead of time, served from VOICES_STORAGE/{id}/lines.pack without a model call
+packs = VoicePacks(VOICES_STORAGE)
+prerender = PrerenderJobs(packs, lambda text, voice, lang: TTS_POOL.run(models.synthesize_ssml, text, voice, lang),
+                          PRERENDER_PROCS, RETRY_AFTER_S)
+
+ollama = OllamaClient(OLLAMA_URL, LLM_MODEL, {
+    "num_ctx": CTX,
+    "num_predict": max(8, LLM_MAXTOK),
+    "temperature": LLM_TEMP,
+    "num_thread": LLM_THREADS,
+}, keep_alive=KEEP_ALIVE, timeout_s=LLM_TIMEOUT_S, max_connections=OLLAMA_POOL_SIZE,
+   affinity_slack=OLLAMA_AFFINITY_SLACK, health_interval_s=OLLAMA_HEALTH_INTERVAL_S,
+   retry_down_s=OLLAMA_RETRY_DOWN_S)
+
+# Prompts: token budget = CONTEXT_TOKENS - LLM_MAX_TOKENS - reserve; history drops in blocks so
+# consecutive turns share their prefix (and Ollama's KV cache)
+prompts = PromptBuilder(CTX, max(8, LLM_MAXTOK), HIST_MAX_TURNS * 2, HIST_DROP_BLOCK_TURNS * 2,
+                        PROMPT_RESERVE_TOKENS, PROMPT_SUMMARY)
+
+# NPC conversation history: ring buffer per session (a prompt window plus one drop block), batched writes
+history = HistoryStore(SessionLocal, prompts.history_capacity(), HISTORY_CACHE_SESSIONS,
+                       HISTORY_FLUSH_MS / 1000.0, HISTORY_FLUSH_BATCH)
+retention = HistoryRetention(SessionLocal, history, HISTORY_RETENTION_DAYS, HISTORY_RETENTION, HISTORY_RETENTION_BATCH)
+
+# ── Sessions of /chat and /persona (NPC conversations live in `history`) ────
+chat_sessions = make_session_store(CHAT_SESSION_STORE, engine, CHAT_SESSION_MAX, CHAT_SESSION_TTL_S)
 
 def prune_history(hist: List[Dict[str,str]]) -> List[Dict[str,str]]:
     if not hist:
@@ -73,16 +179,31 @@ def prune_history(hist: List[Dict[str,str]]) -> List[Dict[str,str]]:
     system = hist[0] if hist and hist[0].get("role") == "system" else None
     turns = [m for m in hist if m.get("role") != "system"]
     if HIST_MAX_TURNS > 0:
-        turns = turns[-(HIST_MAX_TURNS * 2):]
+        turns = turns[prompts.window_start(len(turns)):]  # whole blocks at a time, see PromptBuilder
     return ([system] + turns) if system else turns
 
+# ── Warm-up ─────────────────────────────────────────────────────────────────
+def _warmup_voice() -> Optional[str]:
+    if WARMUP_VOICE: return resolve_voice_file_from_library(WARMUP_VOICE)
+    try: names = sorted(n for n in os.listdir(VOICES_DIR) if n.lower().endswith(".wav"))
+    except OSError: return None
+    return os.path.join(VOICES_DIR, names[0]) if names else None
+
+warmup = Warmup({
+    "stt": {"load": lambda: models.load("stt"), "warm": lambda: models.warm("stt")},
+    "tts": {"load": lambda: models.load("tts"), "warm": lambda: models.warm("tts", _warmup_voice())},
+    "llm": {"load": None, "warm": ollama.preload},  # keep_alive ping: model resident in Ollama
+}, WARMUP)
+
 # ── App ─────────────────────────────────────────────────────────────────────
 app = FastAPI(title="Local NPC Voice Server", version="3.0")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True,
-    allow_methods=["*"], allow_headers=["*"]
+    allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(HTTPMetricsMiddleware)
 
 # optional ultra-simple UI (Step 5 will drop a tiny index.html)
 if os.path.isdir(os.path.join(os.path.dirname(__file__), "ui")):
@@ -90,107 +211,242 @@ if os.path.isdir(os.path.join(os.path.dirname(__file__), "ui")):
 
 # NEW: DB startup
 @app.on_event("startup")
-def _startup():
+async def _startup():
     init_db()
+    ollama.start_health_checks()
+    app.state.warmup_task = asyncio.create_task(warmup.run())
+    if HISTORY_RETENTION_INTERVAL_S > 0: app.state.retention_task = asyncio.create_task(_retention_loop())
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if getattr(app.state, "warmup_task", None): app.state.warmup_task.cancel()
+    if getattr(app.state, "retention_task", None): app.state.retention_task.cancel()
+    prerender.shutdown()
+    for pool in (STT_POOL, LLM_POOL, TTS_POOL): pool.shutdown()
+    await ollama.aclose()
+    history.close()
 
 # ── Helpers ─────────────────────────────────────────────────────────────────
-def stt_transcribe(audio_bytes: bytes, lang_hint: Optional[str]) -> str:
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as tmp:
-        tmp.write(audio_bytes); tmp.flush()
-        segments, _ = whisper.transcribe(tmp.name, language=lang_hint, vad_filter=True, without_timestamps=True)
-        return "".join(seg.text for seg in segments).strip()
-
-def _messages_to_prompt(messages: List[Dict[str, str]]) -> str:
-    """Simple ChatML-ish prompt as a fallback for /api/generate."""
-    out = []
-    for m in messages:
-        role = m.get("role","user")
-        content = m.get("content","")
-        out.append(f"<|im_start|>{role}\n{content}\n<|im_end|>")
-    out.append("<|im_start|>assistant\n")  # leave assistant open
-    return "\n".join(out)
-
-def ollama_chat(messages: List[Dict[str, str]]) -> str:
-    # primary: /api/chat
-    payload = {
-        "model": LLM_MODEL,
-        "messages": messages,
-        "stream": False,
-        "options": {
-            "num_ctx": CTX,
-            "num_predict": max(8, LLM_MAXTOK),
-            "temperature": LLM_TEMP,
-            "num_thread": LLM_THREADS,
-            "keep_alive": KEEP_ALIVE,
-        }
-    }
+def stt_transcribe(audio_bytes: bytes, lang_hint: Optional[str], endpoint: str = "stt",
+                   content_type: Optional[str] = None, model: Optional[str] = None,
+                   npc_model: Optional[str] = None, speech_check: bool = False) -> Optional[str]:
+    # float32 @16 kHz, never touches disk; decoded in the API worker (raw PCM by its content type)
+    audio = decode_audio(audio_bytes, content_type=content_type)
+    if speech_check and SILENCE_MIN_SPEECH_MS and voiced_ms(audio, WHISPER_SR, VAD_FRAME_MS, VAD_MIN_DBFS, VAD_SNR_DB) < SILENCE_MIN_SPEECH_MS:
+        SHORT_CIRCUITS.inc(endpoint=endpoint, reason="no_speech")
+        return None  # no speech: Whisper never runs
+    return stt_transcribe_audio(audio, lang_hint, endpoint, model, npc_model)
+
+def stt_transcribe_audio(audio: np.ndarray, lang_hint: Optional[str], endpoint: str = "stt",
+                         model: Optional[str] = None, npc_model: Optional[str] = None) -> str:
+    # model: the request's stt_model, npc_model: the NPC's (see WhisperModels.route)
+    t = time.perf_counter()
+    text = models.transcribe(audio, lang_hint, model, npc_model)
+    if len(audio): STT_RTF.observe((time.perf_counter() - t) / (len(audio) / WHISPER_SR), endpoint=endpoint)
+    return text
+
+async def transcribe_upload(rt: RequestTimer, audio_bytes: bytes, lang_hint: Optional[str],
+                            content_type: Optional[str] = None, model: Optional[str] = None,
+                            npc_model: Optional[str] = None,
+                            speech_check: bool = SILENCE_REPLY != "off") -> Optional[str]:
+    """The transcript, or None when `speech_check` found no speech in the upload (by default only
+    when a turn without speech gets a SILENCE_REPLY; with SILENCE_REPLY=off Whisper always runs)."""
+    rt.bytes("in", len(audio_bytes))
+    with rt.stage("stt"):
+        return await STT_POOL.run(stt_transcribe, audio_bytes, lang_hint, rt.endpoint, content_type, model, npc_model,
+                                  speech_check)
+
+async def check_stt_model(name: Optional[str]):
+    if name and name not in await run_in_threadpool(models.stt_model_names):
+        raise HTTPException(400, f"Unknown stt_model {name!r}; see WHISPER_MODELS")
+
+async def synthesize_reply(rt: RequestTimer, text: str, speaker_wav: str, language: str,
+                           fmt: AudioFormat = REPLY_AUDIO, npc_id: Optional[int] = None) -> Tuple[bytes, str]:
+    """Spoken reply as (body, Content-Type) in `fmt`; the TTS path itself always produces WAV.
+    A line the NPC's voice pack has (same text, language and voice) comes from the pack."""
+    # off the loop: the lookup stats the pack and the voice file, and may (re)load or hash them
+    wav = await run_in_threadpool(packs.lookup, npc_id, speaker_wav, text, language) if npc_id is not None else None
+    if wav is not None:
+        VOICE_PACK_HITS.inc()
+    else:
+        with rt.stage("tts"):
+            wav = await TTS_POOL.run(models.synthesize_ssml, text, speaker_wav, language)
+    if fmt.passthrough:
+        body, media_type = wav, "audio/wav"
+    else:
+        with rt.stage("encode"):
+            body, media_type = await run_in_threadpool(encode_audio, wav, fmt)
+    rt.bytes("out", len(body))
+    return body, media_type
+
+_NON_WORD = re.compile(r"[^\w\s']+")
+_SILENT_WAV = encode_wav_segments([(None, 24000 // 5)], 24000)  # 200 ms
+
+def silence_reason(text: Optional[str]) -> Optional[str]:
+    """Why a turn would get no LLM reply: "no_speech", "empty" or "filler"; None for a real turn."""
+    if text is None: return "no_speech"
+    words = _NON_WORD.sub(" ", text.lower()).split()
+    if words and " ".join(words) not in SILENCE_FILLERS and not all(w in SILENCE_FILLERS for w in words):
+        return None
+    return "filler" if words else "empty"
+
+def short_circuit_reason(rt: RequestTimer, text: Optional[str]) -> Optional[str]:
+    """silence_reason, counted in npc_short_circuits_total ("no_speech" already is, by stt_transcribe)."""
+    reason = silence_reason(text)
+    if reason in ("empty", "filler"): SHORT_CIRCUITS.inc(endpoint=rt.endpoint, reason=reason)
+    return reason
+
+async def short_circuit(rt: RequestTimer, user_text: Optional[str], speaker_wav: str, language: str,
+                        fmt: AudioFormat, npc_id: int) -> Optional[Tuple[str, str, Optional[bytes], str]]:
+    """The cheap answer to a turn without speech: (reason, reply text, audio or None for 204,
+    media type); None means run the full reply."""
+    if SILENCE_REPLY == "off": return None
+    reason = short_circuit_reason(rt, user_text)
+    if reason is None: return None
+    if SILENCE_REPLY == "204": return reason, "", None, ""
+    if SILENCE_REPLY == "clip":
+        return (reason, SILENCE_CLIP_TEXT) + await synthesize_reply(rt, SILENCE_CLIP_TEXT, speaker_wav, language, fmt, npc_id)
+    if fmt.passthrough: return reason, "", _SILENT_WAV, "audio/wav"
+    return (reason, "") + await run_in_threadpool(encode_audio, _SILENT_WAV, fmt)
+
+def observe_llm(rt: Optional[RequestTimer], messages: List[Dict[str, str]], stats: Dict, seconds: float):
+    prompts.record_eval(messages, stats.get("prompt_eval_count"))
+    if rt is not None:
+        rt.observe("llm", seconds)
+        if "ttft_s" in stats: rt.observe("llm_ttft", stats["ttft_s"])
+    if stats.get("api"): LLM_REQUESTS.inc(api=stats["api"])
+    for kind in stats.get("fallbacks", ()): LLM_FALLBACKS.inc(kind=kind)
+    for kind in ("prompt_eval", "eval"):
+        if f"{kind}_count" in stats: LLM_TOKENS.inc(stats[f"{kind}_count"], kind=kind)
+
+def llm_affinity(key: str) -> Optional[str]:
+    """Session key for Ollama backend affinity (its prompt prefix is cached there)."""
+    return key if key and OLLAMA_AFFINITY_SLACK >= 0 else None
+
+async def ollama_chat(messages: List[Dict[str, str]], request: Optional[Request] = None,
+                      rt: Optional[RequestTimer] = None, session_key: str = "") -> str:
+    """Admitted through LLM_POOL; cancelled (and the Ollama generation aborted) if the HTTP
+    client disconnects before the reply is ready."""
+    _start_summary_jobs()
+    stats: Dict = {}
+    t = time.perf_counter()
+    task = LLM_POOL.spawn(ollama.chat, messages, None, stats, llm_affinity(session_key))
+    if request is not None:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_S)
+            if done: break
+            if await request.is_disconnected():
+                task.cancel()
+                raise HTTPException(499, "Client disconnected")
+    reply = await task
+    observe_llm(rt, messages, stats, time.perf_counter() - t)
+    return reply
+
+_summary_tasks: set = set()
+
+async def _llm_summary(previous: Optional[str], turns: List[Tuple[str, str]]) -> Optional[str]:
+    """None if the LLM is busy, slow or down: callers retry later."""
     try:
-        r = requests.post(f"{OLLAMA_URL}/api/chat", json=payload, timeout=180)
-        r.raise_for_status()
-        data = r.json()
-        text = (data.get("message") or {}).get("content") or data.get("response") or ""
-        if text and text.strip():
-            return text
-    except Exception as e:
-        print(f"[ollama_chat] /api/chat error: {e}")
-
-    # fallback: /api/generate with a concatenated prompt (some models behave better)
-    prompt = _messages_to_prompt(messages)
-    gen_payload = {
-        "model": LLM_MODEL,
-        "prompt": prompt,
-        "stream": False,
-        "options": {
-            "num_ctx": CTX,
-            "num_predict": max(8, LLM_MAXTOK),
-            "temperature": LLM_TEMP,
-            "num_thread": LLM_THREADS,
-        }
-    }
+        lines = "\n".join(f"{role}: {content}" for role, content in turns)
+        text = await LLM_POOL.spawn(ollama.chat, [
+            {"role": "system", "content": "Summarize this conversation in at most three sentences. Keep names, "
+                                          "facts and promises. Reply with the summary only."},
+            {"role": "user", "content": (f"Summary so far: {previous}\n\n" if previous else "") + lines},
+        ])
+        return None if text == FALLBACK_REPLY else text
+    except HTTPException:
+        return None
+
+async def _summarize(key: str, upto: int, previous: Optional[str], dropped: List[Tuple[str, str]]):
+    text = None
     try:
-        r2 = requests.post(f"{OLLAMA_URL}/api/generate", json=gen_payload, timeout=180)
-        r2.raise_for_status()
-        data2 = r2.json()
-        text2 = data2.get("response","")
-        if text2 and text2.strip():
-            return text2
-    except Exception as e:
-        print(f"[ollama_chat] /api/generate error: {e}")
-
-    # last resort so TTS isn't silent
-    return "Okay."
-
-
-def ssml_to_parts(text_or_ssml: str) -> List[Tuple[str, float, int]]:
-    text = text_or_ssml
-    parts, current, rate_stack = [], [], [TTS_GLOBAL_RATE]
-    tokens = re.split(r'(<break[^>]*>|<prosody[^>]*>|</prosody>)', text)
-    def flush(p=0):
-        if current:
-            parts.append(("".join(current), rate_stack[-1], p)); current.clear()
-    for tok in tokens:
-        if tok.startswith("<break"):
-            m = re.search(r'time="([^"]+)"', tok); ms = 0
-            if m:
-                val = m.group(1).lower()
-                ms = int(float(val[:-2])) if val.endswith("ms") else (int(float(val[:-1])*1000) if val.endswith("s") else 0)
-            flush(ms)
-        elif tok.startswith("<prosody"):
-            m = re.search(r'rate="([^"]+)"', tok)
-            mapped = rate_stack[-1]
-            if m:
-                v = m.group(1).lower()
-                mapped = {"x-slow":0.6,"slow":0.8,"medium":1.0,"fast":1.2,"x-fast":1.4}.get(v, mapped)
-                if mapped == rate_stack[-1]:
-                    try: mapped = float(v)
-                    except: pass
-            rate_stack.append(mapped)
-        elif tok == "</prosody>":
-            if len(rate_stack) > 1: rate_stack.pop()
-        else:
-            current.append(tok)
-    flush()
-    return parts
+        text = await _llm_summary(previous, dropped)  # None: retried when the next turn still needs it
+    finally:
+        prompts.set_summary(key, upto, text)
+
+def _start_summary_jobs():
+    """Rolling summaries (PROMPT_SUMMARY=1) are made off the request path; until one is ready the
+    prompt keeps the previous summary, so the prefix changes at most once per drop block."""
+    for job in prompts.summary_jobs():
+        task = asyncio.create_task(_summarize(*job))
+        _summary_tasks.add(task); task.add_done_callback(_summary_tasks.discard)
+
+async def _retention_loop():
+    """Every HISTORY_RETENTION_INTERVAL_S, off the event loop; summaries go through LLM_POOL like any call."""
+    loop = asyncio.get_running_loop()
+    def summarize(previous, turns):
+        return asyncio.run_coroutine_threadsafe(_llm_summary(previous, turns), loop).result()
+    while True:
+        await asyncio.sleep(HISTORY_RETENTION_INTERVAL_S)
+        try:
+            run = await run_in_threadpool(retention.run_once, summarize)
+            if run["messages"]: print(f"[retention] {run['messages']} messages from {run['sessions']} sessions in {run['seconds']} s")
+        except Exception as e:
+            print(f"[retention] run failed: {e}")
+
+_SSML_TAG = re.compile(r'<break[^>]*>|<prosody[^>]*>|</prosody>')
+_SENTENCE_END = re.compile(r'[.!?…]+["\')\]]*(?=\s)')
+
+class SSMLSentenceSplitter:
+    """Cuts a growing LLM reply into speakable chunks for streaming TTS.
+
+    Chunks end on a sentence boundary or right after a <break/>, never inside a tag, and every
+    chunk is self-contained SSML: a <prosody> still open at the cut is closed at the end of the
+    chunk and re-opened at the start of the next one, so compile_ssml sees the same rates.
+    """
+    def __init__(self, min_chars: int = STREAM_MIN_CHARS, max_chars: int = STREAM_MAX_CHARS):
+        self.buf = ""
+        self.open_tags: List[str] = []  # <prosody ...> tags active at the start of buf
+        self.min_chars, self.max_chars = min_chars, max_chars
+
+    def feed(self, text: str) -> List[str]:
+        self.buf += text
+        out = []
+        while True:
+            cut = self._find_cut()
+            if cut is None: break
+            chunk = self._emit(cut)
+            if chunk: out.append(chunk)
+        return out
+
+    def flush(self) -> List[str]:
+        chunk = self._emit(len(self.buf))
+        return [chunk] if chunk else []
+
+    def _find_cut(self) -> Optional[int]:
+        # never cut after a '<' that hasn't been closed yet (tag still streaming in)
+        limit = len(self.buf)
+        lt = self.buf.rfind("<")
+        if lt > self.buf.rfind(">"): limit = lt
+        head = self.buf[:limit]
+        cuts = sorted([m.end() for m in _SENTENCE_END.finditer(head)] +
+                      [m.end() for m in _SSML_TAG.finditer(head) if m.group(0).startswith("<break")])
+        for cut in cuts:
+            if len(_SSML_TAG.sub("", head[:cut]).strip()) >= self.min_chars:
+                # a <break/> right after the sentence belongs to it (compile_ssml drops leading pauses)
+                rest = self.buf[cut:].lstrip()
+                if rest.startswith("<break"):
+                    end = rest.find(">")
+                    if end < 0: return None  # wait for the rest of the tag
+                    return len(self.buf) - len(rest) + end + 1
+                if "<break".startswith(rest): return None  # includes "": peek at the next token first
+                return cut
+        # run-on text: cut at the last comma/space outside a tag once it gets too long
+        if len(_SSML_TAG.sub("", head).strip()) >= self.max_chars:
+            plain_ws = [i + 1 for i, ch in enumerate(head) if ch in ", " and head.rfind("<", 0, i) <= head.rfind(">", 0, i)]
+            if plain_ws: return plain_ws[-1]
+        return None
+
+    def _emit(self, cut: int) -> str:
+        raw, self.buf = self.buf[:cut], self.buf[cut:].lstrip()
+        stack = list(self.open_tags)
+        for m in _SSML_TAG.finditer(raw):
+            tag = m.group(0)
+            if tag.startswith("<prosody"): stack.append(tag)
+            elif tag == "</prosody>" and stack: stack.pop()
+        chunk = "".join(self.open_tags) + raw.strip() + "</prosody>" * len(stack)
+        self.open_tags = stack
+        return chunk if _SSML_TAG.sub("", raw).strip() or "<break" in raw else ""
 
 def resolve_voice_file_from_library(voice_ref: Optional[str]) -> Optional[str]:
     if not voice_ref: return None
@@ -203,28 +459,21 @@ def npc_saved_voice_path(npc_id: int) -> str:
     os.makedirs(os.path.join(VOICES_STORAGE, str(npc_id)), exist_ok=True)
     return os.path.join(VOICES_STORAGE, str(npc_id), "voice.wav")
 
-def synthesize_ssml(text_or_ssml: str, speaker_wav: str, language: str="en") -> bytes:
-    tts = get_tts()
-    parts = ssml_to_parts(text_or_ssml)
-    waves, sr = [], 24000
-    for plain, rate, pause_ms in parts:
-        if plain.strip():
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as fout:
-                tts.tts_to_file(text=plain, file_path=fout.name, speaker_wav=speaker_wav, language=language, speed=rate)
-                audio, sr = sf.read(fout.name, dtype="float32")
-                waves.append(audio)
-        if pause_ms > 0:
-            waves.append(np.zeros(int((pause_ms/1000.0)*sr), dtype="float32"))
-    if not waves:
-        waves = [np.zeros(int(0.2*sr), dtype="float32")]
-    audio = np.concatenate(waves)
-    with io.BytesIO() as buf:
-        sf.write(buf, audio, sr, format="WAV", subtype="PCM_16")
-        return buf.getvalue()
-
 def b64wav(wav_bytes: bytes) -> str:
     return base64.b64encode(wav_bytes).decode("ascii")
 
+def reply_audio_format(
+    accept: Optional[str] = Header(default=None),
+    audio_format: Optional[str] = Form(None),  # wav | opus | pcm | l16 (else negotiated from Accept)
+    sample_rate: Optional[int] = Form(None),
+    bitrate: Optional[int] = Form(None),       # Opus, bit/s
+) -> AudioFormat:
+    return negotiate(accept, REPLY_AUDIO, audio_format, sample_rate, bitrate)
+
+def reply_container(accept: Optional[str]) -> str:
+    """/reply body: JSON with base64 audio (default) or multipart/mixed with the raw audio part."""
+    return best_match(accept, ("application/json", "multipart/mixed")) or "application/json"
+
 # NEW: DB helpers / deps
 def get_db():
     db = SessionLocal()
@@ -240,16 +489,6 @@ def check_api_key(npc: NPC, x_api_key: Optional[str]):
     if npc.api_key and x_api_key != npc.api_key:
         raise HTTPException(401, "Invalid or missing API key")
 
-def get_or_create_session(db: Session, npc: NPC, session_id: str) -> ChatSession:
-    s = db.query(ChatSession).filter_by(npc_id=npc.id, session_id=session_id).first()
-    if s: return s
-    s = ChatSession(npc_id=npc.id, session_id=session_id)
-    db.add(s); db.commit(); db.refresh(s)
-    # ensure system message exists in persistent history
-    db.add(Message(chat_session_id=s.id, role="system", content=npc.persona))
-    db.commit()
-    return s
-
 # ── Schemas ─────────────────────────────────────────────────────────────────
 class ChatRequest(BaseModel):
     session_id: str
@@ -261,6 +500,11 @@ class TTSRequest(BaseModel):
     voice_ref: Optional[str] = None
     language: str = TTS_LANGUAGE
 
+class PrerenderRequest(BaseModel):
+    lines: List[str]                # text or SSML, exactly as it will be requested later
+    language: Optional[str] = None  # default: the NPC's
+    replace: bool = False           # drop pack lines this job doesn't list
+
 class PersonaRequest(BaseModel):
     session_id: str
     persona: str
@@ -268,12 +512,67 @@ class PersonaRequest(BaseModel):
 class STTBase64Request(BaseModel):
     audio_b64: str
     lang: str = "en"
+    content_type: Optional[str] = None  # e.g. "audio/pcm; rate=16000" for raw samples; containers are sniffed
+    stt_model: Optional[str] = None     # one of WHISPER_SIZE / WHISPER_MODELS (default: routed)
 
 # ── Base routes kept ────────────────────────────────────────────────────────
 @app.get("/healthz")
 def healthz():
     return {"ok": True}
 
+@app.get("/readyz")
+def readyz():
+    report = warmup.report()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
+
+@app.get("/cachez")
+def cachez():
+    return {**models.summary(), "prompt": prompts.summary_stats(), "chat_sessions": chat_sessions.stats(),
+            "llm_backends": ollama.summary(), "history_retention": retention.stats()}
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus text format: this worker's metrics plus those of each model host."""
+    return Response(render([(REGISTRY.snapshot(), {})] + models.metrics_snapshot()),
+                    media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@REGISTRY.collector
+def _prompt_metrics():
+    s = prompts.summary_stats()
+    yield ("npc_prompt_tokens_est", "counter", "Estimated prompt tokens sent to the LLM",
+           [("npc_prompt_tokens_est_total", {}, s["prompt_tokens_est"])])
+    yield ("npc_prompt_shared_prefix_tokens_est", "counter",
+           "Estimated prompt tokens identical to the session's previous prompt (reusable KV cache)",
+           [("npc_prompt_shared_prefix_tokens_est_total", {}, s["shared_prefix_tokens_est"])])
+    yield ("npc_prompt_eval_tokens_saved_est", "counter",
+           "Estimated prompt tokens Ollama did not have to evaluate",
+           [("npc_prompt_eval_tokens_saved_est_total", {}, s["prompt_eval_tokens_saved_est"])])
+
+@REGISTRY.collector
+def _llm_backend_metrics():
+    backends = ollama.summary()
+    yield ("npc_llm_backend_up", "gauge", "Ollama backend healthy (1) or marked down (0)",
+           [("npc_llm_backend_up", {"backend": b["url"]}, int(b["healthy"])) for b in backends])
+    yield ("npc_llm_backend_in_flight", "gauge", "LLM calls in flight per Ollama backend (this worker)",
+           [("npc_llm_backend_in_flight", {"backend": b["url"]}, b["in_flight"]) for b in backends])
+    yield ("npc_llm_backend_requests", "counter", "LLM calls sent to each Ollama backend",
+           [("npc_llm_backend_requests_total", {"backend": b["url"]}, b["requests"]) for b in backends])
+    yield ("npc_llm_backend_failures", "counter", "Calls or health checks that found an Ollama backend down",
+           [("npc_llm_backend_failures_total", {"backend": b["url"]}, b["failures"]) for b in backends])
+
+@REGISTRY.collector
+def _chat_session_metrics():
+    s = chat_sessions.stats()
+    yield ("npc_chat_sessions", "gauge", "Sessions in the /chat store (sqlite: all workers)",
+           [("npc_chat_sessions", {"backend": s["backend"]}, s["sessions"])])
+    yield ("npc_chat_session_bytes_est", "gauge", "Estimated size of the /chat session store",
+           [("npc_chat_session_bytes_est", {"backend": s["backend"]}, s["bytes_est"])])
+    yield ("npc_chat_session_drops", "counter", "Sessions dropped from the /chat store: evicted (size cap) or expired (TTL)",
+           [("npc_chat_session_drops_total", {"reason": "evicted"}, s["evictions"]),
+            ("npc_chat_session_drops_total", {"reason": "expired"}, s["expirations"])])
+    yield ("npc_chat_session_conflicts", "counter", "Session writes recomputed because another turn wrote first",
+           [("npc_chat_session_conflicts_total", {}, s["conflicts"])])
+
 @app.get("/gpuz")
 def gpuz():
     info = {"whisper_compute": os.getenv("WHISPER_COMPUTE", "int8")}
@@ -288,41 +587,61 @@ def gpuz():
         info["torch_error"] = str(e)
     return info
 
-# Personas (legacy, session-scoped, in-memory)
+# Personas (legacy, session-scoped, see CHAT_SESSION_STORE)
 @app.post("/persona")
 def set_persona(req: PersonaRequest):
-    s = sessions.setdefault(req.session_id, [])
-    if s and s[0].get("role") == "system": s[0]["content"] = req.persona
-    else: s.insert(0, {"role":"system", "content": req.persona})
+    system = {"role": "system", "content": req.persona}
+    chat_sessions.update(req.session_id, lambda s: [system] + (s[1:] if s and s[0].get("role") == "system" else s))
     return {"ok": True}
 
 @app.get("/persona")
 def get_persona(session_id: str):
-    s = sessions.get(session_id, [])
+    s = chat_sessions.get(session_id)
     sysmsg = s[0]["content"] if s and s[0].get("role") == "system" else None
     return {"session_id": session_id, "persona": sysmsg}
 
 @app.post("/stt")
-async def stt_endpoint(file: UploadFile = File(...), lang: str = Form(default="en")):
-    audio_bytes = await file.read()
-    return {"text": stt_transcribe(audio_bytes, lang_hint=lang)}
+async def stt_endpoint(request: Request, file: Optional[UploadFile] = File(None), lang: str = Form(default="en"),
+                       stt_model: Optional[str] = Form(None)):
+    """multipart upload, or the audio itself as the request body (Content-Type audio/*, ?lang=&stt_model=)."""
+    rt = RequestTimer("stt")
+    if file is not None:
+        data, content_type = await file.read(), file.content_type
+    else:
+        data, content_type = await request.body(), request.headers.get("content-type")
+        lang = request.query_params.get("lang", lang)
+        stt_model = request.query_params.get("stt_model", stt_model)
+        if not data: raise HTTPException(400, "No audio: send a multipart 'file' or the audio as the body")
+    text = await transcribe_upload(rt, data, lang, content_type, stt_model, speech_check=STT_SILENCE_CHECK)
+    return JSONResponse({"text": text or ""}, headers=rt.headers())
 
 @app.post("/stt_json")
 async def stt_json(req: STTBase64Request):
-    return {"text": stt_transcribe(base64.b64decode(req.audio_b64), lang_hint=req.lang)}
+    rt = RequestTimer("stt_json")
+    text = await transcribe_upload(rt, base64.b64decode(req.audio_b64), req.lang, req.content_type, req.stt_model,
+                                   speech_check=STT_SILENCE_CHECK)
+    return JSONResponse({"text": text or ""}, headers=rt.headers())
 
 @app.post("/chat")
-async def chat_endpoint(req: ChatRequest):
-    s = sessions.setdefault(req.session_id, [])
-    s.extend(req.messages)
-    s[:] = prune_history(s)
-    reply = ollama_chat(s)
-    s.append({"role":"assistant","content":reply})
-    return {"reply": reply}
+async def chat_endpoint(req: ChatRequest, request: Request):
+    s = await run_in_threadpool(chat_sessions.append, req.session_id, req.messages, prune_history)
+    system = s[0]["content"] if s and s[0].get("role") == "system" else None
+    turns = [(m.get("role", "user"), m.get("content", "")) for m in s if m.get("role") != "system"]
+    rt = RequestTimer("chat")
+    reply = await ollama_chat(prompts.build(f"chat:{req.session_id}", system, turns, len(turns)), request, rt,
+                              f"chat:{req.session_id}")
+    await run_in_threadpool(chat_sessions.append, req.session_id, [{"role": "assistant", "content": reply}])
+    return JSONResponse({"reply": reply}, headers=rt.headers())
 
 # ── NPC MANAGEMENT ──────────────────────────────────────────────────────────
+def _schedule_voice_warmup(background: BackgroundTasks, npc: NPC):
+    try: path = resolve_npc_voice(npc)
+    except HTTPException: return  # no usable voice yet; replies will report it
+    background.add_task(models.warm_speaker_latents, path)
+
 @app.post("/npcs")
 async def create_npc(
+    background: BackgroundTasks,
     name: str = Form(...),
     persona: str = Form(...),          # system prompt / roleplay
     tone: Optional[str] = Form(None),  # notes like "sarcastic, short replies"
@@ -330,12 +649,16 @@ async def create_npc(
     voice_ref: Optional[str] = Form(None),   # filename under /app/voices
     voice_wav: Optional[UploadFile] = File(None),  # uploaded voice sample
     issue_api_key: int = Form(0),
+    stt_model: Optional[str] = Form(None),   # Whisper model for its players (one of WHISPER_SIZE / WHISPER_MODELS)
+    retention_days: Optional[float] = Form(None),  # compact history older than this (default HISTORY_RETENTION_DAYS, 0 = never)
     db: Session = Depends(get_db)
 ):
     slug = slugify(name)
     if db.query(NPC).filter_by(slug=slug).first():
         raise HTTPException(400, "Name already used (slug exists). Pick another name.")
-    npc = NPC(name=name, slug=slug, persona=persona, tone=tone, language=language)
+    await check_stt_model(stt_model)
+    npc = NPC(name=name, slug=slug, persona=persona, tone=tone, language=language, stt_model=stt_model or None,
+              retention_days=retention_days)
     if issue_api_key: npc.api_key = new_api_key()
 
     # prefer uploaded voice; else store library reference
@@ -350,15 +673,18 @@ async def create_npc(
         npc.voice_ref = voice_ref
 
     db.add(npc); db.commit(); db.refresh(npc)
+    _schedule_voice_warmup(background, npc)
     base = f"/npcs/{npc.id}"
     return {
         "id": npc.id, "name": npc.name, "slug": npc.slug, "language": npc.language, "tone": npc.tone,
         "api_key": npc.api_key, "voice_ref": npc.voice_ref, "voice_path": npc.voice_path,
-        "persona_preview": npc.persona[:180],
+        "stt_model": npc.stt_model, "retention_days": npc.retention_days, "persona_preview": npc.persona[:180],
         "endpoints": {
             "reply_json": f"{base}/reply",
             "reply_wav": f"{base}/reply.wav",
-            "history": f"{base}/history?session_id=YOUR_SESSION_ID"
+            "reply_stream": f"{base}/reply.stream",
+            "history": f"{base}/history?session_id=YOUR_SESSION_ID",
+            "export": f"{base}/history.ndjson"
         }
     }
 
@@ -372,12 +698,13 @@ def get_npc(npc_id: int, db: Session = Depends(get_db)):
     npc = require_npc(db, npc_id)
     return {
         "id": npc.id, "name": npc.name, "slug": npc.slug, "language": npc.language, "tone": npc.tone,
-        "voice_ref": npc.voice_ref, "voice_path": npc.voice_path,
-        "has_api_key": bool(npc.api_key), "persona": npc.persona
+        "voice_ref": npc.voice_ref, "voice_path": npc.voice_path, "stt_model": npc.stt_model,
+        "retention_days": npc.retention_days, "has_api_key": bool(npc.api_key), "persona": npc.persona
     }
 
 @app.patch("/npcs/{npc_id}")
 async def patch_npc(
+    background: BackgroundTasks,
     npc_id: int,
     name: Optional[str] = Form(None),
     persona: Optional[str] = Form(None),
@@ -386,6 +713,8 @@ async def patch_npc(
     voice_ref: Optional[str] = Form(None),
     voice_wav: Optional[UploadFile] = File(None),
     rotate_api_key: int = Form(0),
+    stt_model: Optional[str] = Form(None),  # "" = routed again
+    retention_days: Optional[float] = Form(None),  # -1 = HISTORY_RETENTION_DAYS again
     db: Session = Depends(get_db),
     x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")
 ):
@@ -394,6 +723,10 @@ async def patch_npc(
     if persona is not None: npc.persona = persona
     if tone is not None: npc.tone = tone
     if language is not None: npc.language = language
+    if stt_model is not None:
+        await check_stt_model(stt_model)
+        npc.stt_model = stt_model or None
+    if retention_days is not None: npc.retention_days = None if retention_days < 0 else retention_days
     if rotate_api_key: npc.api_key = new_api_key()
 
     if voice_wav is not None:
@@ -405,25 +738,23 @@ async def patch_npc(
         npc.voice_ref = voice_ref
 
     db.add(npc); db.commit(); db.refresh(npc)
+    if voice_wav is not None or voice_ref is not None:
+        _schedule_voice_warmup(background, npc)
     return {"ok": True, "api_key": npc.api_key}
 
 # ── NPC chat/reply endpoints ────────────────────────────────────────────────
-def build_messages_for_npc(npc: NPC, db: Session, session_id: str, user_text: str) -> List[Dict[str,str]]:
-    chat = get_or_create_session(db, npc, session_id)
-    db.add(Message(chat_session_id=chat.id, role="user", content=user_text)); db.commit()
-
-    # last N*2 turns (we keep system outside the table here)
-    q = db.query(Message).filter_by(chat_session_id=chat.id) \
-         .order_by(Message.created_at.desc()).limit(HIST_MAX_TURNS*2)
-    msgs = list(reversed(q.all()))
-
+def build_messages_for_npc(npc: NPC, db: Session, session_id: str, user_text: str) -> Tuple[int, List[Dict[str,str]]]:
+    """(chat_session pk, prompt messages); may hit SQLite, so handlers run it in the threadpool."""
+    chat_pk = history.session_pk(db, npc, session_id)
+    # recent turns incl. this one (we keep system outside the table here); memory after the first turn
+    total, turns = history.window(db, chat_pk)
+    history.append(chat_pk, "user", user_text)
+
+    # byte-identical every turn so Ollama can reuse the cached prefix
     system = npc.persona
     if npc.tone:
         system = f"{npc.persona}\n\nSpeak in a {npc.tone} tone."
-    messages = [{"role":"system","content": system}]
-    messages += [{"role":m.role, "content":m.content} for m in msgs if m.role in ("user","assistant")]
-    return messages
-
+    return chat_pk, prompts.build(f"npc:{chat_pk}", system, turns + [("user", user_text)], total + 1)
 
 def resolve_npc_voice(npc: NPC) -> str:
     # Prefer per-NPC saved voice; else refer to library reference
@@ -432,65 +763,419 @@ def resolve_npc_voice(npc: NPC) -> str:
     raise HTTPException(400, "This NPC has no voice configured. Upload a voice_wav or set voice_ref.")
 
 @app.get("/npcs/{npc_id}/history")
-def get_history(npc_id: int, session_id: str, db: Session = Depends(get_db)):
+def get_history(npc_id: int, session_id: str, response: Response, limit: Optional[int] = None,
+                after: Optional[int] = None, before: Optional[int] = None, order: str = "asc",
+                archived: int = 0, db: Session = Depends(get_db)):
+    """The whole session, as before paging existed, unless `limit`, `after` or `before` ask for one
+    page: oldest first (`after` = the previous page's X-Next-Cursor) or with order=desc newest
+    first (`before`). archived=1 reads what retention moved out."""
     npc = require_npc(db, npc_id)
-    chat = get_or_create_session(db, npc, session_id)
-    msgs = db.query(Message).filter_by(chat_session_id=chat.id).order_by(Message.created_at.asc()).all()
-    return [{"role": m.role, "content": m.content, "at": m.created_at.isoformat()} for m in msgs]
+    if order not in ("asc", "desc"): raise HTTPException(400, "order must be asc or desc")
+    chat_pk = history.session_pk(db, npc, session_id, create=False)
+    if chat_pk is None: return []
+    if limit is None and after is None and before is None:
+        items, cursor = [], None
+        while True:  # HISTORY_PAGE_MAX rows per query
+            page, cursor = history.page(db, chat_pk, cursor, HISTORY_PAGE_MAX, order == "desc", bool(archived))
+            items += page
+            if cursor is None: return items
+    items, cursor = history.page(db, chat_pk, before if order == "desc" else after,
+                                 max(1, min(limit or HISTORY_PAGE_LIMIT, HISTORY_PAGE_MAX)), order == "desc", bool(archived))
+    if cursor is not None: response.headers["X-Next-Cursor"] = str(cursor)
+    return items
+
+@app.get("/npcs/{npc_id}/history.ndjson")
+def export_history(
+    npc_id: int,
+    session_id: Optional[str] = None,  # default: every session of the NPC
+    db: Session = Depends(get_db),
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-Key"),
+):
+    """All messages, archived ones included, one JSON object per line, read in bounded chunks."""
+    npc = require_npc(db, npc_id); check_api_key(npc, x_api_key)
+    lines = (json.dumps(m, ensure_ascii=False) + "\n" for m in history.export_npc(npc.id, session_id))
+    return StreamingResponse(lines, media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="npc-{npc.id}-history.ndjson"'})
 
 @app.post("/npcs/{npc_id}/reply")
 async def npc_reply_json(
+    request: Request,
     npc_id: int,
     session_id: str = Form(...),
     lang: str = Form("en"),
     file: UploadFile = File(...),
+    stt_model: Optional[str] = Form(None),  # Whisper model for this clip (default: the NPC's, else routed)
     persona_override: Optional[str] = Form(None),
     voice_ref: Optional[str] = Form(None),
+    fmt: AudioFormat = Depends(reply_audio_format),
+    accept: Optional[str] = Header(default=None),
     db: Session = Depends(get_db),
     x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")
 ):
     npc = require_npc(db, npc_id); check_api_key(npc, x_api_key)
+    rt = RequestTimer("reply", npc.id)
 
-    user_text = stt_transcribe(await file.read(), lang_hint=lang)
-    # messages with persona/tone; override if given
-    if persona_override:
-        fake = NPC(id=npc.id, persona=persona_override, tone=npc.tone, language=npc.language,
-                   voice_ref=npc.voice_ref, voice_path=npc.voice_path)
-        messages = build_messages_for_npc(fake, db, session_id, user_text)
-    else:
-        messages = build_messages_for_npc(npc, db, session_id, user_text)
-
-    assistant = ollama_chat(messages)
-    chat = db.query(ChatSession).filter_by(npc_id=npc.id, session_id=session_id).first()
-    db.add(Message(chat_session_id=chat.id, role="assistant", content=assistant)); db.commit()
-
+    user_text = await transcribe_upload(rt, await file.read(), lang, file.content_type, stt_model, npc.stt_model)
     # voice resolution: per-call library override wins, else NPC saved voice/ref
     voice_path = resolve_voice_file_from_library(voice_ref) if voice_ref else resolve_npc_voice(npc)
-    wav = synthesize_ssml(assistant, speaker_wav=voice_path, language=lang or npc.language)
-    return {"transcript": user_text, "reply_text": assistant, "audio_b64": b64wav(wav)}
+    meta = {}
+    skip = await short_circuit(rt, user_text, voice_path, lang or npc.language, fmt, npc.id)
+    if skip is not None:  # nothing was said: no LLM, no history
+        meta["skipped"], assistant, audio, media_type = skip
+        if audio is None: return Response(status_code=204, headers=dict(rt.headers(), **{"X-Skipped": meta["skipped"]}))
+    else:
+        # messages with persona/tone; override if given
+        with rt.stage("db"):
+            if persona_override:
+                fake = NPC(id=npc.id, persona=persona_override, tone=npc.tone, language=npc.language,
+                           voice_ref=npc.voice_ref, voice_path=npc.voice_path)
+                chat_pk, messages = await run_in_threadpool(build_messages_for_npc, fake, db, session_id, user_text or "")
+            else:
+                chat_pk, messages = await run_in_threadpool(build_messages_for_npc, npc, db, session_id, user_text or "")
+
+        assistant = await ollama_chat(messages, request, rt, f"npc:{npc.id}:{session_id}")
+        history.append(chat_pk, "assistant", assistant)  # queued for the write-behind thread
+        audio, media_type = await synthesize_reply(rt, assistant, voice_path, lang or npc.language, fmt, npc.id)
+    meta.update(transcript=user_text or "", reply_text=assistant)
+    headers = dict(rt.headers(), Vary="Accept")
+    if reply_container(accept) == "multipart/mixed":  # texts + raw audio, no base64
+        body, content_type = multipart(meta, audio, media_type)
+        return Response(body, media_type=content_type, headers=headers)
+    return JSONResponse(dict(meta, audio_b64=b64wav(audio), audio_format=media_type), headers=headers)
 
 @app.post("/npcs/{npc_id}/reply.wav")
+@app.post("/npcs/{npc_id}/reply.audio")
 async def npc_reply_wav(
+    request: Request,
     npc_id: int,
     session_id: str = Form(...),
     lang: str = Form("en"),
     file: UploadFile = File(...),
+    stt_model: Optional[str] = Form(None),  # Whisper model for this clip (default: the NPC's, else routed)
+    fmt: AudioFormat = Depends(reply_audio_format),
     db: Session = Depends(get_db),
     x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")
 ):
     npc = require_npc(db, npc_id); check_api_key(npc, x_api_key)
+    rt = RequestTimer("reply.wav", npc.id)
 
-    user_text = stt_transcribe(await file.read(), lang_hint=lang)
-    if not user_text.strip():
-        user_text = "(silence)"
-    messages = build_messages_for_npc(npc, db, session_id, user_text)
-    assistant = ollama_chat(messages)
-    chat = db.query(ChatSession).filter_by(npc_id=npc.id, session_id=session_id).first()
-    db.add(Message(chat_session_id=chat.id, role="assistant", content=assistant)); db.commit()
-
+    user_text = await transcribe_upload(rt, await file.read(), lang, file.content_type, stt_model, npc.stt_model)
     voice_path = resolve_npc_voice(npc)
-    wav = synthesize_ssml(assistant, speaker_wav=voice_path, language=lang or npc.language)
-    return StreamingResponse(io.BytesIO(wav), media_type="audio/wav")
+    extra = {}
+    skip = await short_circuit(rt, user_text, voice_path, lang or npc.language, fmt, npc.id)
+    if skip is not None:  # nothing was said: no LLM, no history
+        extra["X-Skipped"], assistant, audio, media_type = skip
+        if audio is None: return Response(status_code=204, headers=dict(rt.headers(), **extra))
+        user_text = user_text or ""
+    else:
+        if not (user_text or "").strip():
+            user_text = "(silence)"
+        with rt.stage("db"):
+            chat_pk, messages = await run_in_threadpool(build_messages_for_npc, npc, db, session_id, user_text)
+        assistant = await ollama_chat(messages, request, rt, f"npc:{npc.id}:{session_id}")
+        history.append(chat_pk, "assistant", assistant)  # queued for the write-behind thread
+        audio, media_type = await synthesize_reply(rt, assistant, voice_path, lang or npc.language, fmt, npc.id)
+    # one body with Content-Length (not a stream: iterating a BytesIO would send it line by line)
+    return Response(audio, media_type=media_type, headers=dict(
+        rt.headers(), Vary="Accept", **extra, **{"X-Transcript": header_text(user_text), "X-Reply-Text": header_text(assistant)}))
+
+def _ndjson(event: str, **fields) -> bytes:
+    return (json.dumps({"event": event, **fields}) + "\n").encode("utf-8")
+
+def _start_reply_producer(messages: List[Dict[str, str]], rt: RequestTimer, session_key: str):
+    """Run the streamed LLM call as a task on the LLM pool, pushing sentence chunks onto an
+    asyncio queue (None marks the end). Admission happens here, before any response byte is sent."""
+    chunks: asyncio.Queue = asyncio.Queue()
+    reply: List[str] = []
+
+    async def produce():
+        splitter, stats, t = SSMLSentenceSplitter(), {}, time.perf_counter()
+        try:
+            async for piece in ollama.stream(messages, None, stats, llm_affinity(session_key)):
+                reply.append(piece)
+                for chunk in splitter.feed(piece): chunks.put_nowait(chunk)
+            for chunk in splitter.flush(): chunks.put_nowait(chunk)
+        finally:  # also on LLM_TIMEOUT_S or cancellation: what was generated is still accounted for
+            observe_llm(rt, messages, stats, time.perf_counter() - t)
+            chunks.put_nowait(None)
+
+    _start_summary_jobs()
+    producer = LLM_POOL.spawn(produce)
+    return chunks, reply, producer
+
+async def _reply_events(chunks: asyncio.Queue, reply: List[str], producer: asyncio.Task,
+                        chat_pk: int, user_text: str, speaker_wav: str, language: str,
+                        rt: RequestTimer, fmt: AudioFormat, npc_id: Optional[int] = None):
+    """LLM tokens -> sentence chunks -> TTS, pipelined: the LLM keeps streaming in its task
+    while earlier chunks are synthesized. Yields (event, fields, audio or None); the caller
+    frames them (NDJSON for reply.stream, WebSocket messages for the voice session) and must
+    close the generator (aclosing) so history is written when the client goes away."""
+    assistant = ""
+    try:
+        yield "transcript", {"text": user_text}, None
+        seq = 0
+        while True:
+            chunk = await chunks.get()
+            if chunk is None: break
+            yield "text", {"seq": seq, "text": chunk}, None
+            try:
+                audio, media_type = await synthesize_reply(rt, chunk, speaker_wav, language, fmt, npc_id)
+            except HTTPException as e:  # headers are gone; report in-band and stop
+                yield "error", {"status": e.status_code, "detail": e.detail}, None
+                return
+            yield "audio", {"seq": seq, "format": media_type}, audio
+            seq += 1
+        try:
+            await producer
+        except HTTPException as e:  # LLM_TIMEOUT_S passed mid-reply: the chunks so far were sent
+            yield "error", {"status": e.status_code, "detail": e.detail}, None
+            return
+        assistant = "".join(reply).strip()
+        # Server-Timing was sent with the headers (stt, db); the full breakdown comes here
+        yield "done", {"reply_text": assistant, "server_timing": rt.server_timing()}, None
+    finally:
+        # also runs on client disconnect or barge-in: cancelling the producer closes the Ollama
+        # stream, which aborts generation there; whatever was generated so far is kept
+        producer.cancel()
+        assistant = assistant or "".join(reply).strip()
+        if assistant:
+            history.append(chat_pk, "assistant", assistant)
+
+async def _stream_reply_events(*args):
+    async with aclosing(_reply_events(*args)) as events:
+        async for event, fields, audio in events:
+            if audio is not None: fields["audio_b64"] = b64wav(audio)
+            yield _ndjson(event, **fields)
+
+@app.post("/npcs/{npc_id}/reply.stream")
+async def npc_reply_stream(
+    npc_id: int,
+    session_id: str = Form(...),
+    lang: str = Form("en"),
+    file: UploadFile = File(...),
+    stt_model: Optional[str] = Form(None),  # Whisper model for this clip (default: the NPC's, else routed)
+    persona_override: Optional[str] = Form(None),
+    voice_ref: Optional[str] = Form(None),
+    fmt: AudioFormat = Depends(reply_audio_format),
+    db: Session = Depends(get_db),
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")
+):
+    npc = require_npc(db, npc_id); check_api_key(npc, x_api_key)
+    rt = RequestTimer("reply.stream", npc.id)
+    # resolve the voice up front: once streaming starts we can no longer answer 400
+    voice_path = resolve_voice_file_from_library(voice_ref) if voice_ref else resolve_npc_voice(npc)
+
+    user_text = await transcribe_upload(rt, await file.read(), lang, file.content_type, stt_model, npc.stt_model)
+    skip = await short_circuit(rt, user_text, voice_path, lang or npc.language, fmt, npc.id)
+    if skip is not None:  # nothing was said: the same events, in one body, without LLM or history
+        reason, assistant, audio, media_type = skip
+        if audio is None: return Response(status_code=204, headers=dict(rt.headers(), **{"X-Skipped": reason}))
+        body = [_ndjson("transcript", text=user_text or "")]
+        if assistant: body.append(_ndjson("text", seq=0, text=assistant))
+        body.append(_ndjson("audio", seq=0, format=media_type, audio_b64=b64wav(audio)))
+        body.append(_ndjson("done", reply_text=assistant, skipped=reason, server_timing=rt.server_timing()))
+        return Response(b"".join(body), media_type="application/x-ndjson", headers=rt.headers())
+    user_text = user_text or ""
+    with rt.stage("db"):
+        if persona_override:
+            fake = NPC(id=npc.id, persona=persona_override, tone=npc.tone, language=npc.language,
+                       voice_ref=npc.voice_ref, voice_path=npc.voice_path)
+            chat_pk, messages = await run_in_threadpool(build_messages_for_npc, fake, db, session_id, user_text)
+        else:
+            chat_pk, messages = await run_in_threadpool(build_messages_for_npc, npc, db, session_id, user_text)
+
+    chunks, reply, producer = _start_reply_producer(messages, rt, f"npc:{npc.id}:{session_id}")
+    events = _stream_reply_events(chunks, reply, producer, chat_pk, user_text, voice_path,
+                                  lang or npc.language, rt, fmt, npc.id)
+    return StreamingResponse(events, media_type="application/x-ndjson", headers=rt.headers())
+
+# ── Voice packs (pre-rendered lines) ────────────────────────────────────────
+@app.post("/npcs/{npc_id}/prerender", status_code=202)
+async def prerender_lines(
+    npc_id: int,
+    req: PrerenderRequest,
+    db: Session = Depends(get_db),
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")
+):
+    npc = require_npc(db, npc_id); check_api_key(npc, x_api_key)
+    lines = [line for line in req.lines if line.strip()]
+    if not lines: raise HTTPException(400, "No lines to render")
+    if len(lines) > PRERENDER_MAX_LINES: raise HTTPException(413, f"At most {PRERENDER_MAX_LINES} lines per job")
+    job = prerender.submit(npc.id, lines, req.language or npc.language, resolve_npc_voice(npc), req.replace)
+    return dict(job.as_dict(), status_url=f"/npcs/{npc.id}/prerender/{job.id}")
+
+@app.get("/npcs/{npc_id}/prerender/{job_id}")
+def prerender_status(npc_id: int, job_id: str, db: Session = Depends(get_db)):
+    npc = require_npc(db, npc_id)
+    status = prerender.status(npc.id, job_id)
+    if status is None: raise HTTPException(404, "Job not found")
+    pack = packs.get(npc.id)
+    return dict(status, pack=pack.summary() if pack else None)
+
+@app.post("/npcs/{npc_id}/say")
+async def npc_say(
+    npc_id: int,
+    text: str = Form(...),
+    lang: Optional[str] = Form(None),
+    fmt: AudioFormat = Depends(reply_audio_format),
+    db: Session = Depends(get_db),
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-Key")
+):
+    """A fixed line in the NPC's voice (no STT/LLM): from its voice pack when pre-rendered, else TTS."""
+    npc = require_npc(db, npc_id); check_api_key(npc, x_api_key)
+    rt = RequestTimer("say", npc.id)
+    audio, media_type = await synthesize_reply(rt, text, resolve_npc_voice(npc), lang or npc.language, fmt, npc.id)
+    return Response(audio, media_type=media_type, headers=dict(rt.headers(), Vary="Accept"))
+
+# ── Voice session (WebSocket) ───────────────────────────────────────────────
+_PCM_DTYPES = {"s16le": "<i2", "f32le": "<f4"}
+
+@app.websocket("/npcs/{npc_id}/session")
+async def npc_voice_session(
+    ws: WebSocket,
+    npc_id: int,
+    session_id: str,
+    lang: str = "en",
+    rate: int = WHISPER_SR,              # input sample rate
+    encoding: str = "s16le",             # input samples: s16le | f32le, mono
+    barge_in: bool = True,
+    audio_format: Optional[str] = None,  # reply audio, as for /reply
+    sample_rate: Optional[int] = None,
+    bitrate: Optional[int] = None,
+    stt_model: Optional[str] = None,     # Whisper model, as for /reply
+    api_key: Optional[str] = None,       # browsers can't set headers on a WebSocket
+    x_api_key: Optional[str] = Header(default=None, alias="X-API-Key"),
+):
+    """Full duplex: microphone PCM in (binary frames), replies out on the same socket.
+
+    The server finds utterances itself (vad.Endpointer), transcribes each one as soon as its
+    end is detected and runs the same persona/history/LLM/TTS pipeline as reply.stream. Events
+    are JSON text frames; every "audio" event is followed by one binary frame with its audio.
+    Speech that starts while a reply is still being generated or sent cancels it (barge-in).
+    """
+    db = SessionLocal()
+    try:
+        npc = db.get(NPC, npc_id)
+        if not npc: raise WebSocketException(1008, "NPC not found")
+        if npc.api_key and (x_api_key or api_key) != npc.api_key:
+            raise WebSocketException(1008, "Invalid or missing API key")
+        if encoding not in _PCM_DTYPES or not 8000 <= rate <= 96000:
+            raise WebSocketException(1003, "encoding must be s16le or f32le, rate 8000..96000")
+        try:
+            fmt = negotiate(None, REPLY_AUDIO, audio_format, sample_rate, bitrate)
+            voice_path = resolve_npc_voice(npc)
+            await check_stt_model(stt_model)
+        except HTTPException as e:
+            raise WebSocketException(1008, str(e.detail))
+    except WebSocketException:
+        db.close()
+        raise
+    dtype = np.dtype(_PCM_DTYPES[encoding])
+    endpointer = Endpointer(rate, VAD_FRAME_MS, VAD_START_MS, VAD_END_SILENCE_MS,
+                            max_utterance_s=VAD_MAX_UTTERANCE_S, min_dbfs=VAD_MIN_DBFS, snr_db=VAD_SNR_DB,
+                            noise_rise_db_s=VAD_NOISE_RISE_DB_S)
+    send_lock = asyncio.Lock()
+    turn_task: Optional[asyncio.Task] = None
+    turn_no = 0
+
+    async def _send(text: str, audio: Optional[bytes]):
+        async with send_lock:  # an event and its binary frame are never split by another message
+            await ws.send_text(text)
+            if audio is not None: await ws.send_bytes(audio)
+
+    async def send(event: str, audio: Optional[bytes] = None, **fields):
+        await asyncio.shield(_send(json.dumps({"event": event, **fields}), audio))
+
+    async def run_turn(turn: int, after: Optional[asyncio.Task], audio: Optional[np.ndarray], text: Optional[str]):
+        if after is not None: await asyncio.wait({after})  # barge_in=false: replies queue up
+        rt = RequestTimer("session", npc.id)
+        try:
+            if text is None:
+                with rt.stage("stt"):
+                    text = await STT_POOL.run(stt_transcribe_audio, resample(audio, rate, WHISPER_SR), lang, rt.endpoint,
+                                              stt_model, npc.stt_model)
+                # the endpointer already heard speech; an empty or filler transcript still gets no reply
+                reason = silence_reason(text)
+                if reason == "empty" or (reason and SILENCE_REPLY != "off"):  # with "off" a filler gets its reply
+                    SHORT_CIRCUITS.inc(endpoint=rt.endpoint, reason=reason)
+                    await send("transcript", turn=turn, text=text.strip(), skipped=reason)
+                    return
+            elif not text.strip():
+                await send("transcript", turn=turn, text="")
+                return
+            with rt.stage("db"):
+                chat_pk, messages = await run_in_threadpool(build_messages_for_npc, npc, db, session_id, text)
+            chunks, reply, producer = _start_reply_producer(messages, rt, f"npc:{npc.id}:{session_id}")
+            first_audio = True
+            async with aclosing(_reply_events(chunks, reply, producer, chat_pk, text, voice_path,
+                                              lang or npc.language, rt, fmt, npc.id)) as events:
+                async for event, fields, out in events:
+                    if out is not None:
+                        fields["bytes"] = len(out)
+                        if first_audio:  # end of speech -> first reply audio: what the player waits for
+                            rt.observe("first_audio", time.perf_counter() - rt.t0); first_audio = False
+                    await send(event, out, turn=turn, **fields)
+        except HTTPException as e:
+            await send("error", turn=turn, status=e.status_code, detail=e.detail)
+        except (WebSocketDisconnect, RuntimeError):  # socket closed under us; the receive loop ends the session
+            pass
+
+    async def cancel_turn(reason: str):
+        if turn_task is None or turn_task.done(): return
+        turn_task.cancel()
+        await asyncio.wait({turn_task})
+        if reason == "barge_in": BARGE_INS.inc()
+        await send("cancelled", turn=turn_no, reason=reason)
+
+    async def start_turn(audio: Optional[np.ndarray], text: Optional[str]):
+        nonlocal turn_task, turn_no
+        if barge_in: await cancel_turn("barge_in")
+        turn_no += 1
+        if audio is not None:
+            await send("speech_end", turn=turn_no, duration_s=round(audio.shape[0] / rate, 2))
+        turn_task = asyncio.create_task(run_turn(turn_no, None if barge_in else turn_task, audio, text))
+
+    await ws.accept()
+    VOICE_SESSIONS.inc()
+    leftover = b""
+    try:
+        await send("ready", session_id=session_id, rate=rate, encoding=encoding, reply_format=fmt.name)
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect": break
+            if msg.get("bytes") is not None:
+                data = leftover + msg["bytes"]
+                usable = len(data) - len(data) % dtype.itemsize
+                leftover = data[usable:]
+                pcm = np.frombuffer(data, dtype=dtype, count=usable // dtype.itemsize)
+                audio = pcm.astype(np.float32) / 32768.0 if dtype.kind == "i" else pcm.astype(np.float32)
+                for kind, utterance in endpointer.feed(audio):
+                    if kind == "start":
+                        await send("speech_start", turn=turn_no + 1)
+                        if barge_in: await cancel_turn("barge_in")
+                    else:
+                        await start_turn(utterance, None)
+                continue
+            try: ctrl = json.loads(msg.get("text") or "{}")
+            except ValueError: ctrl = {}
+            kind = ctrl.get("type")
+            if kind == "end":        # push-to-talk released: this is the end of the utterance
+                utterance = endpointer.flush()
+                if utterance is not None: await start_turn(utterance, None)
+            elif kind == "text":     # typed line instead of speech
+                await start_turn(None, str(ctrl.get("text", "")))
+            elif kind == "cancel":   # stop the current reply (e.g. the player walked away)
+                await cancel_turn("client")
+            else:
+                await send("error", detail=f"unknown control message {ctrl!r}")
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if turn_task is not None and not turn_task.done():
+            turn_task.cancel()
+            await asyncio.wait({turn_task})
+        VOICE_SESSIONS.dec()
+        db.close()
 
 @app.delete("/npcs/{npc_id}")
 def delete_npc(
@@ -501,6 +1186,7 @@ def delete_npc(
     npc = require_npc(db, npc_id)
     check_api_key(npc, x_api_key)
 
+    prerender.forget_npc(npc.id); packs.remove(npc.id)
     # remove voice file/folder if present
     try:
         if npc.voice_path and os.path.exists(npc.voice_path):
@@ -510,12 +1196,8 @@ def delete_npc(
             except: pass
     except: pass
 
-    # delete chat history
-    sessions = db.query(ChatSession).filter_by(npc_id=npc.id).all()
-    for s in sessions:
-        db.query(Message).filter_by(chat_session_id=s.id).delete(synchronize_session=False)
-        db.delete(s)
-
-    db.delete(npc)
+    # chat history and the NPC in one transaction, as bulk deletes
+    history.delete_npc(db, npc.id)
+    db.query(NPC).filter_by(id=npc.id).delete(synchronize_session=False)
     db.commit()
     return {"ok": True}
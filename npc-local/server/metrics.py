@@ -0,0 +1,246 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/metrics.py — in-process counters/gauges/histograms, Prometheus text format, Server-Timing
+import bisect, re, threading, time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RATIO_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 4.0, 8.0)
+
+# A family as exchanged with model hosts: (name, type, help, [(sample_name, labels, value)])
+Family = Tuple[str, str, str, List[Tuple[str, Dict[str, str], float]]]
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_: str, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help_, tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...]) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def family(self) -> Family:
+        with self._lock:
+            return (self.name, self.kind, self.help,
+                    [(f"{self.name}_total", self._labels(k), v) for k, v in self._values.items()])
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try: yield
+        finally: self.dec(**labels)
+
+    def family(self) -> Family:
+        with self._lock:
+            return self.name, self.kind, self.help, [(self.name, self._labels(k), v) for k, v in self._values.items()]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = [[0] * len(self.buckets), 0.0, 0]  # per-bucket counts, sum, count
+            if i < len(self.buckets): v[0][i] += 1
+            v[1] += value; v[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - t, **labels)
+
+    def family(self) -> Family:
+        samples = []
+        with self._lock:
+            for key, (counts, total, n) in self._values.items():
+                labels, acc = self._labels(key), 0
+                for le, c in zip(self.buckets, counts):
+                    acc += c
+                    samples.append((f"{self.name}_bucket", dict(labels, le=_fmt(le)), acc))
+                samples.append((f"{self.name}_bucket", dict(labels, le="+Inf"), n))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, n))
+        return self.name, self.kind, self.help, samples
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Family]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_, labelnames=()) -> Counter:
+        return self.register(Counter(name, help_, labelnames))
+
+    def gauge(self, name, help_, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help_, labelnames))
+
+    def histogram(self, name, help_, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_, labelnames, buckets))
+
+    def collector(self, fn: Callable[[], Iterable[Family]]):
+        """`fn` is called at scrape time (for values that already live elsewhere, e.g. pool depth)."""
+        self._collectors.append(fn)
+        return fn
+
+    def snapshot(self) -> List[Family]:
+        fams = [m.family() for m in self._metrics]
+        for fn in self._collectors:
+            try: fams.extend(fn())
+            except Exception as e: print(f"[metrics] collector {getattr(fn, '__name__', fn)} failed: {e}")
+        return fams
+
+REGISTRY = Registry()
+
+def _fmt(v: float) -> str:
+    v = float(v)
+    if v != v: return "NaN"
+    if v in (float("inf"), float("-inf")): return "+Inf" if v > 0 else "-Inf"
+    return repr(v)
+
+def _esc(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render(sources: Iterable[Tuple[List[Family], Dict[str, str]]]) -> str:
+    """Prometheus text exposition (0.0.4) of several snapshots, each with extra labels
+    (e.g. this process with none, every model host with model_host="..."); same-named
+    families are merged so HELP/TYPE appear once."""
+    merged: Dict[str, Family] = {}
+    for fams, extra in sources:
+        for name, kind, help_, samples in fams:
+            if name not in merged: merged[name] = (name, kind, help_, [])
+            merged[name][3].extend((s, dict(labels, **extra), v) for s, labels, v in samples)
+    out = []
+    for name, kind, help_, samples in merged.values():
+        out.append(f"# HELP {name} {help_}")
+        out.append(f"# TYPE {name} {kind}")
+        for s, labels, v in samples:
+            lbl = ",".join(f'{k}="{_esc(val)}"' for k, val in labels.items())
+            out.append(f"{s}{{{lbl}}} {_fmt(v)}" if lbl else f"{s} {_fmt(v)}")
+    return "\n".join(out) + "\n"
+
+# ── the hot-path metrics (shared by main.py, inference.py, executors.py) ────
+STAGE_SECONDS = REGISTRY.histogram(
+    "npc_stage_seconds", "Time per reply stage (stt, db, llm_ttft, llm, tts) as seen by the request",
+    ("stage", "endpoint", "npc"))
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "npc_queue_wait_seconds", "Time a job waited in an inference pool before it started", ("pool",))
+HTTP_SECONDS = REGISTRY.histogram("npc_http_request_seconds", "HTTP request duration", ("endpoint", "status"))
+HTTP_IN_FLIGHT = REGISTRY.gauge("npc_http_requests_in_flight", "HTTP requests being served", ("endpoint",))
+BYTES = REGISTRY.counter("npc_bytes", "Audio/payload bytes received and sent", ("endpoint", "direction"))
+POOL_REJECTED = REGISTRY.counter("npc_pool_rejected", "Jobs refused with 503 because a pool was full", ("pool",))
+LLM_REQUESTS = REGISTRY.counter("npc_llm_requests", "LLM calls by the Ollama endpoint that answered", ("api",))
+LLM_FALLBACKS = REGISTRY.counter(
+    "npc_llm_fallbacks", "LLM fallbacks: 'failover' = next Ollama backend, 'generate' = /api/chat failed, "
+    "'okay' = canned last-resort reply", ("kind",))
+LLM_TOKENS = REGISTRY.counter("npc_llm_tokens", "Tokens reported by Ollama", ("kind",))
+TTS_PART_SECONDS = REGISTRY.histogram("npc_tts_part_seconds", "XTTS time per synthesized SSML part (cache misses)")
+TTS_RTF = REGISTRY.histogram("npc_tts_real_time_factor", "XTTS synthesis time / audio duration per part",
+                             buckets=RATIO_BUCKETS)
+VOICE_SESSIONS = REGISTRY.gauge("npc_voice_sessions", "Open WebSocket voice sessions")
+BARGE_INS = REGISTRY.counter("npc_barge_ins", "Replies cancelled because the player started talking again")
+SHORT_CIRCUITS = REGISTRY.counter("npc_short_circuits", "Turns without speech: no_speech skips Whisper, no_speech/empty/filler also skip LLM and TTS",
+                                  ("endpoint", "reason"))
+VOICE_PACK_HITS = REGISTRY.counter("npc_voice_pack_hits", "Lines served from a pre-rendered voice pack (no TTS call)")
+STT_MODEL_REQUESTS = REGISTRY.counter(
+    "npc_stt_model_requests", "Clips per Whisper model, why it was picked and whether it was already loaded (hit) or not (load)",
+    ("model", "route", "result"))
+STT_MODEL_SECONDS = REGISTRY.histogram("npc_stt_model_seconds", "Whisper time per clip (incl. batching wait) by model", ("model",))
+STT_MODEL_EVICTIONS = REGISTRY.counter("npc_stt_model_evictions", "Whisper models unloaded to stay under WHISPER_MEMORY_MB", ("model",))
+HISTORY_COMPACTED = REGISTRY.counter("npc_history_compacted", "NPC messages moved to message_archive by the retention job", ("mode",))
+STT_RTF = REGISTRY.histogram("npc_stt_real_time_factor", "STT time / audio duration per request", ("endpoint",),
+                             buckets=RATIO_BUCKETS)
+
+class RequestTimer:
+    """Stage timings of one request: each stage is observed into npc_stage_seconds and
+    summed per name for the Server-Timing response header."""
+    def __init__(self, endpoint: str, npc: Optional[int] = None):
+        self.endpoint, self.npc = endpoint, "-" if npc is None else str(npc)
+        self.t0 = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        t = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - t)
+
+    def observe(self, name: str, seconds: float):
+        STAGE_SECONDS.observe(seconds, stage=name, endpoint=self.endpoint, npc=self.npc)
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def bytes(self, direction: str, n: int):
+        BYTES.inc(n, endpoint=self.endpoint, direction=direction)
+
+    def server_timing(self) -> str:
+        stages = dict(self.stages, total=time.perf_counter() - self.t0)
+        return ", ".join(f"{name};dur={s * 1000:.1f}" for name, s in stages.items())
+
+    def headers(self) -> Dict[str, str]:
+        return {"Server-Timing": self.server_timing()}
+
+def endpoint_label(path: str) -> str:
+    """Route-like label with bounded cardinality: ids collapsed, static files grouped."""
+    if path.startswith("/ui"): return "/ui"
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+class HTTPMetricsMiddleware:
+    """ASGI middleware: in-flight gauge and duration histogram per endpoint. Plain ASGI (not
+    BaseHTTPMiddleware) so streamed responses count until their last byte is sent."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        endpoint, status, t = endpoint_label(scope["path"]), [500], time.perf_counter()
+
+        async def send_status(message):
+            if message["type"] == "http.response.start": status[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(endpoint=endpoint)
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+            HTTP_SECONDS.observe(time.perf_counter() - t, endpoint=endpoint, status=status[0])
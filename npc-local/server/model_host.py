@@ -0,0 +1,200 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/model_host.py — one process owns Whisper + XTTS; API workers call it over a Unix socket
+#
+#   python model_host.py /tmp/npc-models-1.sock          (entrypoint.sh starts MODEL_HOST_PROCS of these)
+#
+# Wire format: every message is a small JSON header frame followed by `nbuf` raw frames
+# (multiprocessing.connection length-prefixed send_bytes/recv_bytes). Audio only ever travels in
+# the raw frames: float32 PCM from the API worker for STT, WAV bytes back for TTS — no base64, no
+# JSON, and numpy reads the received frame in place.
+import json, os, sys, threading, time
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+
+def send_msg(conn: Connection, header: Dict, buffers: Sequence = ()):
+    conn.send_bytes(json.dumps(dict(header, nbuf=len(buffers))).encode("utf-8"))
+    for buf in buffers:
+        conn.send_bytes(buf)
+
+def recv_msg(conn: Connection) -> Tuple[Dict, List[bytes]]:
+    header = json.loads(conn.recv_bytes())
+    return header, [conn.recv_bytes() for _ in range(header.pop("nbuf", 0))]
+
+# ── host side ───────────────────────────────────────────────────────────────
+class ModelHost:
+    """Serves inference.py to any number of API worker connections, one thread per connection.
+
+    Model concurrency is bounded here (STT_WORKERS / TTS_WORKERS, same variables as in-process),
+    so it doesn't grow with the number of API workers; STT clips from all workers meet in the one
+    WhisperBatcher and are decoded together.
+    """
+    def __init__(self, address: str, authkey: Optional[bytes] = None):
+        import inference
+        self.inference = inference
+        self.address = address
+        self.authkey = authkey
+        self.limits = {
+            "stt": threading.BoundedSemaphore(int(os.getenv("STT_WORKERS", str(max(1, inference.WHISPER_BATCH_SIZE))))),
+            "tts": threading.BoundedSemaphore(int(os.getenv("TTS_WORKERS", "1"))),
+        }
+
+    def serve_forever(self):
+        if os.path.exists(self.address): os.remove(self.address)  # stale socket from a previous run
+        with Listener(self.address, family="AF_UNIX", authkey=self.authkey) as listener:
+            os.chmod(self.address, 0o600)
+            print(f"[model_host] pid {os.getpid()} serving on {self.address}")
+            while True:
+                try: conn = listener.accept()
+                except Exception as e:  # failed auth handshake etc.
+                    print(f"[model_host] accept failed: {e}"); continue
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn: Connection):
+        with conn:
+            while True:
+                try: header, buffers = recv_msg(conn)
+                except (EOFError, OSError): return
+                try:
+                    result, out = self._dispatch(header, buffers)
+                    send_msg(conn, {"ok": True, "result": result}, out)
+                except Exception as e:
+                    try: send_msg(conn, {"ok": False, "status": getattr(e, "status_code", 500),
+                                         "error": getattr(e, "detail", None) or f"{type(e).__name__}: {e}"})
+                    except OSError: return
+
+    def _dispatch(self, header: Dict, buffers: List[bytes]):
+        op, inf = header["op"], self.inference
+        if op == "transcribe":
+            audio = np.frombuffer(buffers[0], dtype="<f4")  # view on the received frame
+            with self.limits["stt"]:
+                return inf.transcribe(audio, header.get("lang"), header.get("model"), header.get("npc_model")), ()
+        if op == "stt_model_names":
+            return inf.stt_model_names(), ()
+        if op == "synthesize_ssml":
+            with self.limits["tts"]:
+                return None, (inf.synthesize_ssml(header["text"], header["speaker_wav"], header["language"]),)
+        if op == "warm_speaker_latents":
+            with self.limits["tts"]: inf.warm_speaker_latents(header.get("path"))
+            return None, ()
+        if op == "load":
+            inf.load(header["component"]); return None, ()
+        if op == "warm":
+            with self.limits[header["component"]]: inf.warm(header["component"], header.get("voice"))
+            return None, ()
+        if op == "summary":
+            return dict(inf.summary(), pid=os.getpid()), ()
+        if op == "metrics":
+            from metrics import REGISTRY
+            return REGISTRY.snapshot(), ()
+        raise ValueError(f"unknown op {op!r}")
+
+# ── API worker side ─────────────────────────────────────────────────────────
+class _Host:
+    def __init__(self, address: str):
+        self.address = address
+        self.idle: List[Connection] = []
+        self.outstanding = 0
+
+class ModelHostClient:
+    """Same interface as inference.py, executed by one of the model-host processes.
+
+    Calls block (run them on the STT/TTS pools as before). Each call borrows an idle connection
+    to the host with the fewest outstanding calls, or opens a new one, so concurrency is only
+    limited by the pools in front and the semaphores in the host.
+    """
+    def __init__(self, addresses: Sequence[str], authkey: Optional[bytes] = None,
+                 timeout_s: float = 120.0, connect_wait_s: float = 60.0, retry_after_s: int = 2):
+        self.hosts = [_Host(a.strip()) for a in addresses if a.strip()]
+        self.authkey = authkey
+        self.timeout_s = timeout_s
+        self.connect_wait_s = connect_wait_s
+        self.retry_after_s = retry_after_s
+        self._lock = threading.Lock()
+
+    def _unavailable(self, host: _Host, e: Exception) -> HTTPException:
+        return HTTPException(503, f"Model host {host.address} unavailable: {e}",
+                             headers={"Retry-After": str(self.retry_after_s)})
+
+    def _connect(self, host: _Host, wait_s: float) -> Connection:
+        deadline = time.monotonic() + wait_s
+        while True:
+            try: return Client(host.address, family="AF_UNIX", authkey=self.authkey)
+            except (FileNotFoundError, ConnectionRefusedError) as e:  # host still starting
+                if time.monotonic() >= deadline: raise self._unavailable(host, e)
+                time.sleep(0.2)
+
+    def _call(self, header: Dict, buffers: Sequence = (), host: Optional[_Host] = None,
+              wait_s: float = 0.0, timeout_s: Optional[float] = None):
+        with self._lock:
+            host = host or min(self.hosts, key=lambda h: h.outstanding)
+            host.outstanding += 1
+            conn = host.idle.pop() if host.idle else None
+        try:
+            if conn is None: conn = self._connect(host, wait_s)
+            try:
+                send_msg(conn, header, buffers)
+                if not conn.poll(timeout_s or self.timeout_s):
+                    conn.close(); conn = None
+                    raise HTTPException(504, f"model host {header['op']} timed out")
+                reply, out = recv_msg(conn)
+            except (EOFError, OSError) as e:  # host died or restarted; next call reconnects
+                if conn is not None: conn.close(); conn = None
+                raise self._unavailable(host, e)
+            if conn is not None:
+                with self._lock: host.idle.append(conn)
+            if not reply["ok"]:
+                raise HTTPException(reply.get("status", 500), reply.get("error", "model host error"))
+            return reply.get("result"), out
+        finally:
+            with self._lock: host.outstanding -= 1
+
+    # ── inference.py interface ──
+    def transcribe(self, audio: np.ndarray, lang_hint: Optional[str], model: Optional[str] = None,
+                   npc_model: Optional[str] = None) -> str:
+        return self._call({"op": "transcribe", "lang": lang_hint, "model": model, "npc_model": npc_model},
+                          (np.ascontiguousarray(audio, dtype="<f4"),))[0]
+
+    def stt_model_names(self) -> List[str]:
+        return self._call({"op": "stt_model_names"}, wait_s=self.connect_wait_s)[0]  # same config on every host
+
+    def synthesize_ssml(self, text_or_ssml: str, speaker_wav: str, language: str = "en") -> bytes:
+        return self._call({"op": "synthesize_ssml", "text": text_or_ssml, "speaker_wav": speaker_wav,
+                           "language": language})[1][0]
+
+    def warm_speaker_latents(self, path: Optional[str]):
+        for host in self.hosts:  # every host keeps its own latent LRU (the disk copy is shared)
+            try: self._call({"op": "warm_speaker_latents", "path": path}, host=host)
+            except Exception as e: print(f"[warm_speaker_latents] {host.address}: {e}")
+
+    def load(self, component: str):
+        for host in self.hosts:  # first call waits for freshly started hosts to listen
+            self._call({"op": "load", "component": component}, host=host, wait_s=self.connect_wait_s,
+                       timeout_s=max(self.timeout_s, 1800.0))  # first run may download the model
+
+    def warm(self, component: str, voice: Optional[str] = None):
+        for host in self.hosts:
+            self._call({"op": "warm", "component": component, "voice": voice}, host=host)
+
+    def summary(self) -> Dict:
+        out = {}
+        for host in self.hosts:
+            try: out[host.address] = self._call({"op": "summary"}, host=host)[0]
+            except Exception as e: out[host.address] = {"error": str(e)}
+        return {"model_hosts": out}
+
+    def metrics_snapshot(self) -> List:
+        """[(families, {"model_host": address})] for metrics.render; unreachable hosts are skipped."""
+        out = []
+        for host in self.hosts:
+            try: out.append((self._call({"op": "metrics"}, host=host, timeout_s=5.0)[0], {"model_host": host.address}))
+            except Exception as e: print(f"[metrics] {host.address}: {e}")
+        return out
+
+if __name__ == "__main__":
+    key = os.getenv("MODEL_HOST_AUTHKEY")
+    ModelHost(sys.argv[1] if len(sys.argv) > 1 else os.getenv("MODEL_HOST", "/tmp/npc-models.sock").split(",")[0],
+              key.encode() if key else None).serve_forever()
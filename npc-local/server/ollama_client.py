@@ -0,0 +1,239 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/ollama_client.py — pooled async Ollama client (streaming, cancellation, endpoint memory,
+# several backends with health checks, least-outstanding routing and session affinity)
+import asyncio, json, time, zlib
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set
+
+import httpx
+
+FALLBACK_REPLY = "Okay."  # last resort so TTS isn't silent
+
+def messages_to_prompt(messages: List[Dict[str, str]]) -> str:
+    """Simple ChatML-ish prompt as a fallback for /api/generate."""
+    out = []
+    for m in messages:
+        role = m.get("role","user")
+        content = m.get("content","")
+        out.append(f"<|im_start|>{role}\n{content}\n<|im_end|>")
+    out.append("<|im_start|>assistant\n")  # leave assistant open
+    return "\n".join(out)
+
+class OllamaBackend:
+    """One Ollama server: its connection pool and what routing needs to know about it."""
+    def __init__(self, url: str, timeout_s: float, max_connections: int):
+        self.url = url.strip().rstrip("/")
+        self.timeout_s, self.max_connections = timeout_s, max_connections
+        self.healthy = True
+        self.down_since = 0.0  # monotonic; a down backend gets one call again `retry_down_s` after this
+        self.in_flight = 0
+        self.requests = self.failures = 0
+        self.last_error: Optional[str] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                timeout=httpx.Timeout(self.timeout_s, connect=5.0),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections))
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def summary(self) -> Dict:
+        return {"url": self.url, "healthy": self.healthy, "in_flight": self.in_flight,
+                "requests": self.requests, "failures": self.failures, "last_error": self.last_error}
+
+def _backend_down(e: Exception) -> bool:
+    """Errors that say "this server", not "this request": worth the same call on another backend."""
+    if isinstance(e, httpx.TransportError): return True  # refused, reset, connect/read timeout
+    return isinstance(e, httpx.HTTPStatusError) and e.response.status_code in (502, 503, 504)
+
+class OllamaClient:
+    """One keep-alive connection pool per backend and process, every call streamed.
+
+    Streaming is what makes cancellation work: when the awaiting task is cancelled (client went
+    away, deadline passed) the response is closed, and Ollama aborts a generation whose
+    connection is gone instead of finishing it for nobody.
+
+    Per model we remember which endpoint produced text last time (`/api/chat` or the
+    `/api/generate` fallback) and try that one first, so a model that can't chat doesn't pay a
+    failed /api/chat round trip on every turn.
+
+    With several `base_urls` each call goes to the healthy backend with the fewest calls in
+    flight (from this process). A call with an `affinity` key (the session) prefers the backend
+    the key hashes to, which has that session's prompt prefix in its KV cache, unless that one
+    has more than `affinity_slack` calls in flight over the least busy; the hash is the same in
+    every worker and only moves keys of a backend that is down. A backend that refuses or drops
+    a call before any token was produced is marked down and the call goes to the next one;
+    `start_health_checks()` polls every backend's /api/tags and brings them back. Without health
+    checks a down backend is retried with one live call every `retry_down_s` (0 = never), which
+    fails over like any other if it's still down and brings the backend back if it answers.
+    """
+    def __init__(self, base_urls: Iterable[str], model: str, options: Dict, keep_alive: str = "-1",
+                 timeout_s: float = 180.0, max_connections: int = 32, affinity_slack: int = 2,
+                 health_interval_s: float = 5.0, health_timeout_s: float = 2.0, retry_down_s: float = 30.0):
+        if isinstance(base_urls, str): base_urls = base_urls.split(",")
+        self.backends = [OllamaBackend(u, timeout_s, max_connections) for u in base_urls if u.strip()]
+        self.model = model
+        self.options = options
+        self.keep_alive = keep_alive
+        self.timeout_s = timeout_s
+        self.affinity_slack = affinity_slack
+        self.health_interval_s, self.health_timeout_s = health_interval_s, health_timeout_s
+        self.retry_down_s = retry_down_s
+        self.preferred: Dict[str, str] = {}  # model -> "chat" | "generate"
+        self._rr = 0  # rotates the tie-break between equally busy backends
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def aclose(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for b in self.backends: await b.aclose()
+
+    async def preload(self):
+        """Load the model into each backend's memory (empty prompt, nothing generated) for `keep_alive`."""
+        async def one(b: OllamaBackend):
+            try:
+                r = await b.client.post("/api/generate", json={"model": self.model, "keep_alive": self.keep_alive})
+                r.raise_for_status()
+            except httpx.HTTPError as e:
+                self._mark_down(b, e)
+                raise
+        results = await asyncio.gather(*(one(b) for b in self.backends), return_exceptions=True)
+        if all(isinstance(r, Exception) for r in results): raise results[0]
+
+    # ── backends ──
+    def pick(self, affinity: Optional[str] = None, exclude: Set[OllamaBackend] = frozenset()) -> Optional[OllamaBackend]:
+        left = [b for b in self.backends if b not in exclude]
+        if self.retry_down_s > 0 and self._health_task is None:
+            now = time.monotonic()
+            for b in left:
+                if not b.healthy and now - b.down_since >= self.retry_down_s:
+                    b.down_since = now  # one call per interval, not all of them
+                    return b
+        pool = [b for b in left if b.healthy] or left  # all down: try them anyway
+        if not pool: return None
+        self._rr = (self._rr + 1) % len(pool)
+        least = min(pool[self._rr:] + pool[:self._rr], key=lambda b: b.in_flight)
+        if affinity is None or len(pool) == 1: return least
+        home = max(pool, key=lambda b: zlib.crc32(f"{b.url}\0{affinity}".encode("utf-8")))  # rendezvous hash
+        return home if home.in_flight <= least.in_flight + self.affinity_slack else least
+
+    def _mark_down(self, b: OllamaBackend, e: Exception):
+        b.failures += 1
+        b.last_error = f"{type(e).__name__}: {e}"
+        b.down_since = time.monotonic()
+        if b.healthy and len(self.backends) > 1:
+            b.healthy = False
+            print(f"[ollama] {b.url} marked down: {b.last_error}")
+
+    def start_health_checks(self):
+        if len(self.backends) > 1 and self.health_interval_s > 0 and self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(b) for b in self.backends))
+            await asyncio.sleep(self.health_interval_s)
+
+    async def _check(self, b: OllamaBackend):
+        try:
+            r = await b.client.get("/api/tags", timeout=self.health_timeout_s)
+            r.raise_for_status()
+        except httpx.HTTPError as e:
+            if b.healthy: self._mark_down(b, e)
+            return
+        self._mark_up(b)
+
+    def _mark_up(self, b: OllamaBackend):
+        if not b.healthy:
+            b.healthy = True
+            print(f"[ollama] {b.url} is back")
+
+    def summary(self) -> List[Dict]:
+        return [b.summary() for b in self.backends]
+
+    def _payload(self, endpoint: str, messages: List[Dict[str, str]]) -> Dict:
+        payload = {"model": self.model, "stream": True, "options": self.options, "keep_alive": self.keep_alive}
+        if endpoint == "chat": payload["messages"] = messages
+        else: payload["prompt"] = messages_to_prompt(messages)
+        return payload
+
+    async def _stream_endpoint(self, backend: OllamaBackend, endpoint: str, messages: List[Dict[str, str]],
+                               deadline: Optional[float], stats: Optional[Dict]) -> AsyncIterator[str]:
+        async with backend.client.stream("POST", f"/api/{endpoint}", json=self._payload(endpoint, messages)) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"/api/{endpoint} passed its deadline")
+                if not line: continue
+                data = json.loads(line)
+                if data.get("error"): raise RuntimeError(data["error"])
+                piece = (data.get("message") or {}).get("content") if endpoint == "chat" else data.get("response")
+                if piece: yield piece
+                if data.get("done"):
+                    if stats is not None:  # prompt_eval_count excludes prefix tokens Ollama had cached
+                        stats.update({k: data[k] for k in ("prompt_eval_count", "eval_count") if k in data})
+                    break
+
+    async def stream(self, messages: List[Dict[str, str]], timeout_s: Optional[float] = None,
+                     stats: Optional[Dict] = None, affinity: Optional[str] = None) -> AsyncIterator[str]:
+        """Yield reply tokens as Ollama produces them. Moves to another backend (a "failover") when
+        one is down, and falls back to the other endpoint (and finally FALLBACK_REPLY), only while
+        nothing has been produced yet. If `stats` is given it receives the token counts from
+        Ollama's final chunk, the time to the first token (`ttft_s`), the endpoint and backend
+        that answered (`api`, `backend`) and the `fallbacks` taken."""
+        stats = {} if stats is None else stats
+        t0 = time.monotonic()
+        deadline = t0 + timeout_s if timeout_s else None
+        first = self.preferred.get(self.model, "chat")
+        endpoints = [first, "generate" if first == "chat" else "chat"]
+        backend, tried = self.pick(affinity), set()
+        while endpoints and backend is not None:
+            endpoint, b = endpoints[0], backend
+            produced = False
+            b.in_flight += 1; b.requests += 1
+            try:
+                async for piece in self._stream_endpoint(b, endpoint, messages, deadline, stats):
+                    if not produced and piece.strip():
+                        produced = True
+                        stats["ttft_s"] = time.monotonic() - t0
+                    yield piece
+            except (httpx.HTTPError, ValueError, RuntimeError, TimeoutError) as e:
+                print(f"[ollama] {b.url}/api/{endpoint} error: {e}")
+                if produced: return
+                if isinstance(e, TimeoutError): break
+                if _backend_down(e):
+                    self._mark_down(b, e)
+                    tried.add(b)
+                    backend = self.pick(affinity, tried)
+                    if backend is not None: stats.setdefault("fallbacks", []).append("failover")
+                    continue  # same endpoint, next backend
+            finally:
+                b.in_flight -= 1
+            if produced:
+                self._mark_up(b)
+                self.preferred[self.model] = endpoint
+                stats["api"], stats["backend"] = endpoint, b.url
+                return
+            if endpoint == "chat" == first: stats.setdefault("fallbacks", []).append("generate")
+            endpoints.pop(0)
+        stats.setdefault("fallbacks", []).append("okay")
+        yield FALLBACK_REPLY
+
+    async def chat(self, messages: List[Dict[str, str]], timeout_s: Optional[float] = None,
+                   stats: Optional[Dict] = None, affinity: Optional[str] = None) -> str:
+        stats = {} if stats is None else stats
+        reply = "".join([piece async for piece in self.stream(messages, timeout_s, stats, affinity)])
+        if reply.strip():
+            return reply
+        if "okay" not in stats.get("fallbacks", ()): stats.setdefault("fallbacks", []).append("okay")
+        return FALLBACK_REPLY
@@ -0,0 +1,182 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/prerender.py — bulk pre-rendering of fixed NPC lines (quest text, barks) into voice packs
+import asyncio, json, os, shutil, time, uuid
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+
+from voice_pack import PackLock, PackWriter, VoicePacks, line_key
+
+KEEP_STATUS_FILES = 20  # finished jobs whose status stays readable, per NPC
+SAVE_INTERVAL_S = 0.5
+LOCK_POLL_S = 0.2  # waiting for a job of the same NPC in another worker
+
+def render_line(text: str, speaker_wav: str, language: str) -> bytes:
+    """Runs in a PRERENDER_PROCS worker process; its XTTS loads on the first line."""
+    import inference
+    return inference.synthesize_ssml(text, speaker_wav, language)
+
+class PrerenderJob:
+    def __init__(self, npc_id: int, lines: List[str], language: str, speaker_wav: str, replace: bool):
+        self.id = uuid.uuid4().hex[:16]
+        self.npc_id, self.lines, self.language = npc_id, lines, language
+        self.speaker_wav, self.replace = speaker_wav, replace
+        self.status = "queued"
+        self.rendered = self.reused = 0
+        self.failed: List[Dict] = []
+        self.error: Optional[str] = None
+        self.created, self.started, self.finished = time.time(), None, None
+        self.task: Optional[asyncio.Task] = None
+
+    def as_dict(self) -> Dict:
+        return {"job_id": self.id, "npc_id": self.npc_id, "status": self.status, "language": self.language,
+                "total": len(self.lines), "rendered": self.rendered, "reused": self.reused,
+                "failed": len(self.failed), "failures": self.failed[:20], "error": self.error,
+                "created": self.created, "started": self.started, "finished": self.finished}
+
+class PrerenderJobs:
+    """Prerender jobs of this API worker, run one at a time (a job already fills the TTS); across
+    workers, jobs for the same NPC take turns on a lock file next to its pack.
+
+    Lines go through `synthesize` (the server's own TTS path, one line at a time and behind live
+    traffic: a full pool means wait and retry) or, with `procs` > 0, through a process pool whose
+    workers each load their own XTTS. Lines the NPC's pack already has for the same voice are carried
+    over, not re-rendered; `replace` drops the pack lines the job doesn't list. Status is mirrored to
+    {root}/{npc_id}/prerender/{job_id}.json so every worker can answer for it.
+    """
+    def __init__(self, packs: VoicePacks, synthesize: Callable[[str, str, str], Awaitable[bytes]],
+                 procs: int = 0, retry_after_s: float = 2.0):
+        self.packs = packs
+        self._synthesize = synthesize
+        self._procs = ProcessPoolExecutor(procs, mp_context=mp.get_context("spawn")) if procs > 0 else None
+        self.concurrency = max(1, procs)
+        self.retry_after_s = retry_after_s
+        self._jobs: Dict[str, PrerenderJob] = {}  # queued/running; finished ones live in their status file
+        self._turn: Optional[asyncio.Lock] = None
+        self._saved_at: Dict[str, float] = {}
+
+    def submit(self, npc_id: int, lines: List[str], language: str, speaker_wav: str,
+               replace: bool = False) -> PrerenderJob:
+        job = PrerenderJob(npc_id, lines, language, speaker_wav, replace)
+        self._jobs[job.id] = job
+        self._save(job)
+        self._prune(npc_id)
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    def status(self, npc_id: int, job_id: str) -> Optional[Dict]:
+        if not job_id.isalnum(): return None  # it becomes a file name
+        job = self._jobs.get(job_id)
+        if job is not None and job.npc_id == npc_id:
+            return job.as_dict()
+        try:
+            with open(self._status_path(npc_id, job_id)) as f: return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def forget_npc(self, npc_id: int):
+        for job in [j for j in self._jobs.values() if j.npc_id == npc_id]:
+            del self._jobs[job.id]  # no status file is written for it any more
+            if job.task: job.task.cancel()
+        shutil.rmtree(self._status_dir(npc_id), ignore_errors=True)
+
+    def shutdown(self):
+        for job in list(self._jobs.values()):
+            if job.task: job.task.cancel()
+        if self._procs is not None: self._procs.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, job: PrerenderJob):
+        if self._turn is None: self._turn = asyncio.Lock()
+        writer, lock = None, PackLock(self.packs.path(job.npc_id))
+        try:
+            async with self._turn:
+                while not lock.try_acquire():
+                    await asyncio.sleep(LOCK_POLL_S)
+                job.status, job.started = "running", time.time()
+                self._save(job, force=True)
+                voice_hash = await asyncio.to_thread(self.packs.voice_hash, job.speaker_wav)
+                writer = PackWriter(self.packs.path(job.npc_id), voice_hash)
+                old = self.packs.get(job.npc_id)
+                if old is not None and old.voice_hash != voice_hash: old = None  # other voice: start over
+                if old is not None and not job.replace:
+                    for text, language, wav in old.lines(): writer.add(text, language, wav)
+                todo: Dict = {}  # line key -> text, so repeated lines render once
+                for text in job.lines:
+                    key = line_key(text, job.language)
+                    if key in writer or key in todo:
+                        job.reused += 1
+                    elif old is not None and key in old:
+                        writer.add(text, job.language, old.get(text, job.language)); job.reused += 1
+                    else:
+                        todo.setdefault(key, text)
+                slots = asyncio.Semaphore(self.concurrency)
+
+                async def render(text: str):
+                    async with slots:
+                        try:
+                            wav = await self._render(text, job.speaker_wav, job.language)
+                        except Exception as e:
+                            job.failed.append({"text": text[:120], "error": f"{type(e).__name__}: {e}"})
+                        else:
+                            writer.add(text, job.language, wav); job.rendered += 1
+                        self._save(job)
+
+                await asyncio.gather(*(render(t) for t in todo.values()))
+                await asyncio.to_thread(writer.commit)
+                writer = None
+                job.status = "failed" if todo and not job.rendered else "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as e:
+            job.status, job.error = "failed", f"{type(e).__name__}: {e}"
+        finally:
+            if writer is not None: writer.abort()
+            lock.release()
+            job.finished = time.time()
+            self._save(job, force=True)
+            self._jobs.pop(job.id, None)
+            self._saved_at.pop(job.id, None)
+
+    async def _render(self, text: str, speaker_wav: str, language: str) -> bytes:
+        while True:
+            try:
+                if self._procs is not None:
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(self._procs, render_line, text, speaker_wav, language)
+                return await self._synthesize(text, speaker_wav, language)
+            except HTTPException as e:
+                if e.status_code != 503: raise
+                await asyncio.sleep(self.retry_after_s)  # live replies first
+
+    # ── status files ────────────────────────────────────────────────────────
+    def _status_dir(self, npc_id: int) -> str:
+        return os.path.join(self.packs.root, str(npc_id), "prerender")
+
+    def _status_path(self, npc_id: int, job_id: str) -> str:
+        return os.path.join(self._status_dir(npc_id), f"{job_id}.json")
+
+    def _save(self, job: PrerenderJob, force: bool = False):
+        if job.id not in self._jobs: return  # forgotten (NPC deleted)
+        now = time.monotonic()
+        if not force and now - self._saved_at.get(job.id, 0.0) < SAVE_INTERVAL_S: return
+        self._saved_at[job.id] = now
+        path = self._status_path(job.npc_id, job.id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f: json.dump(job.as_dict(), f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"[prerender] status of {job.id}: {e}")
+
+    def _prune(self, npc_id: int):
+        d = self._status_dir(npc_id)
+        try: names = [n for n in os.listdir(d) if n.endswith(".json") and n[:-5] not in self._jobs]
+        except OSError: return
+        names.sort(key=lambda n: os.path.getmtime(os.path.join(d, n)))
+        for n in names[:-KEEP_STATUS_FILES]:
+            try: os.remove(os.path.join(d, n))
+            except OSError: pass
@@ -0,0 +1,138 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/prompting.py — token-budgeted, prefix-stable prompt construction
+import hashlib, threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+Turn = Tuple[str, str]  # (role, content)
+
+def estimate_tokens(text: str) -> int:
+    """~4 chars per token plus per-message chat-template overhead; no tokenizer needed."""
+    return (len(text) + 3) // 4 + 4
+
+def messages_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(m.get("content", "")) for m in messages)
+
+class PromptBuilder:
+    """Builds [system, (summary), history...] so consecutive turns share the longest prefix.
+
+    Ollama reuses its KV cache for the longest common prefix with the previous prompt, so the
+    persona/tone system message is emitted byte-identical every turn and history is dropped
+    from the front in whole blocks of `block` messages instead of one turn at a time: between
+    drops a prompt is the previous prompt plus the new turns. The window start is a function of
+    the session's total message count only, so every worker (and every restart) agrees on it.
+    If the window still exceeds the token budget (context minus reply minus reserve), more whole
+    blocks are dropped. Dropped history can be replaced by a rolling summary (see summary_jobs).
+    """
+    def __init__(self, ctx_tokens: int, reply_tokens: int, max_messages: int, block: int,
+                 reserve_tokens: int = 64, summaries: bool = False, max_keys: int = 4096):
+        self.budget = max(256, ctx_tokens - reply_tokens - reserve_tokens)
+        self.max_messages = max(1, max_messages)
+        self.block = max(1, min(block, self.max_messages))
+        self.summaries_enabled = summaries
+        self.max_keys = max_keys
+        self._summaries: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()  # key -> (covers [0, upto), text)
+        self._jobs: Dict[str, Tuple[int, Optional[str], List[Turn]]] = {}  # key -> (upto, previous, dropped)
+        self._running: set = set()
+        self._prev: "OrderedDict[str, List[Tuple[str, int]]]" = OrderedDict()  # key -> [(digest, tokens)]
+        self._lock = threading.Lock()
+        self.stats = {"turns": 0, "prompt_tokens_est": 0, "shared_prefix_tokens_est": 0,
+                      "evaluated_turns": 0, "evaluated_prompt_tokens_est": 0, "ollama_prompt_eval_tokens": 0,
+                      "last": {}}
+
+    def history_capacity(self) -> int:
+        """Messages a history ring must keep so a whole block is still there when it is dropped."""
+        return self.max_messages + self.block
+
+    def window_start(self, total: int) -> int:
+        if total <= self.max_messages:
+            return 0
+        return -(-(total - self.max_messages) // self.block) * self.block  # ceil to a block boundary
+
+    def build(self, key: str, system: Optional[str], turns: List[Turn], total: int) -> List[Dict[str, str]]:
+        """`turns` are the last len(turns) of `total` user/assistant messages of the session."""
+        first = total - len(turns)
+        start = max(self.window_start(total), first)
+        summary = self._summary(key, start, turns, first)
+        prefix = [{"role": "system", "content": system}] if system else []
+        if summary:
+            prefix.append({"role": "system", "content": f"Earlier in this conversation: {summary}"})
+        window = turns[start - first:]
+        fixed = messages_tokens(prefix)
+        sizes = [estimate_tokens(c) for _, c in window]
+        while len(window) > 1 and fixed + sum(sizes) > self.budget:
+            drop = min(self.block - start % self.block, len(window) - 1)  # back onto a block boundary
+            start += drop; window, sizes = window[drop:], sizes[drop:]
+        messages = prefix + [{"role": r, "content": c} for r, c in window]
+        self._record(key, messages)
+        return messages
+
+    # ── rolling summary of dropped history ──
+    def _summary(self, key: str, start: int, turns: List[Turn], first: int) -> Optional[str]:
+        if not self.summaries_enabled or start == 0:
+            return None
+        with self._lock:
+            upto, text = self._summaries.get(key, (0, None))
+            if upto < start and key not in self._jobs and key not in self._running:
+                # summarize what left the window since the last summary (whatever the ring still has)
+                dropped = turns[max(upto, first) - first:start - first]
+                if dropped:
+                    self._jobs[key] = (start, text, dropped)
+        return text  # the previous summary until the new one is ready: at most one prefix change per block
+
+    def summary_jobs(self) -> List[Tuple[str, int, Optional[str], List[Turn]]]:
+        """Pending (key, upto, previous_summary, dropped_turns) for the caller to run on the LLM."""
+        with self._lock:
+            jobs = [(k, *v) for k, v in self._jobs.items()]
+            self._running.update(self._jobs)
+            self._jobs.clear()
+            return jobs
+
+    def set_summary(self, key: str, upto: int, text: Optional[str]):
+        with self._lock:
+            self._running.discard(key)
+            if text:
+                self._summaries[key] = (upto, text.strip())
+                self._summaries.move_to_end(key)
+                while len(self._summaries) > self.max_keys:
+                    self._summaries.popitem(last=False)
+
+    # ── metrics ──
+    def _record(self, key: str, messages: List[Dict[str, str]]):
+        cur = [(hashlib.blake2b(f"{m['role']}\x1f{m['content']}".encode("utf-8"), digest_size=8).hexdigest(),
+                estimate_tokens(m["content"])) for m in messages]
+        with self._lock:
+            prev = self._prev.get(key, [])
+            shared = 0
+            for a, b in zip(prev, cur):
+                if a[0] != b[0]: break
+                shared += a[1]
+            self._prev[key] = cur
+            self._prev.move_to_end(key)
+            while len(self._prev) > self.max_keys:
+                self._prev.popitem(last=False)
+            total = sum(t for _, t in cur)
+            self.stats["turns"] += 1
+            self.stats["prompt_tokens_est"] += total
+            self.stats["shared_prefix_tokens_est"] += shared
+            self.stats["last"] = {"key": key, "prompt_tokens_est": total, "shared_prefix_tokens_est": shared,
+                                  "messages": len(messages)}
+
+    def record_eval(self, messages: List[Dict[str, str]], prompt_eval_count: Optional[int]):
+        """Ollama reports prompt tokens it actually evaluated; cached-prefix tokens are not in it."""
+        if prompt_eval_count is None:
+            return
+        with self._lock:
+            self.stats["evaluated_turns"] += 1
+            self.stats["evaluated_prompt_tokens_est"] += messages_tokens(messages)
+            self.stats["ollama_prompt_eval_tokens"] += prompt_eval_count
+
+    def summary_stats(self) -> Dict:
+        with self._lock:
+            s = dict(self.stats)
+        s["avg_shared_prefix_tokens_per_turn"] = s["shared_prefix_tokens_est"] / s["turns"] if s["turns"] else 0.0
+        s["prompt_eval_tokens_saved_est"] = max(0, s["evaluated_prompt_tokens_est"] - s["ollama_prompt_eval_tokens"])
+        s["avg_prompt_eval_tokens_saved_per_turn"] = (
+            s["prompt_eval_tokens_saved_est"] / s["evaluated_turns"] if s["evaluated_turns"] else 0.0)
+        return s
@@ -0,0 +1,115 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/retention.py — move old NPC history out of the hot `message` table (archive, optionally summarized)
+import datetime, threading, time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, exists, func, insert, update
+from sqlalchemy.orm import Session
+
+from db import NPC, ChatSession, Message, MessageArchive
+from history import TURNS, HistoryStore
+from metrics import HISTORY_COMPACTED
+
+MODES = ("archive", "summarize")
+SUMMARY_BATCH = 50  # messages per LLM summary, so the prompt fits the context
+
+Summarizer = Callable[[Optional[str], List[Tuple[str, str]]], Optional[str]]  # (previous summary, turns) -> text
+
+class HistoryRetention:
+    """Per NPC (`retention_days`, else `default_days`; 0 = keep everything), messages older than
+    that move from `message` to `message_archive`, `batch` rows per transaction. The newest
+    `history.max_messages` turns of a session always stay, so prompts see no difference, and the
+    session's `compacted` count keeps its turn total (and so its prompt window) where it was.
+
+    With mode "summarize", each batch also leaves one "summary" message in its place, written by
+    `summarize` from the previous summary and the moved turns (a batch is retried on the next run
+    if that returns None). Several workers may run this at once: a batch that somebody else
+    already moved is given up, not copied twice."""
+
+    def __init__(self, session_factory: Callable[[], Session], history: HistoryStore, default_days: float = 0.0,
+                 mode: str = "archive", batch: int = 500):
+        if mode not in MODES: raise ValueError(f"HISTORY_RETENTION must be archive or summarize, not {mode!r}")
+        self._session_factory, self.history = session_factory, history
+        self.default_days, self.mode = default_days, mode
+        self.batch = max(1, min(batch, SUMMARY_BATCH) if mode == "summarize" else batch)
+        self._lock = threading.Lock()  # one run at a time in this process
+        self.runs = self.moved = self.summaries = 0
+        self.last_run: Dict = {}
+
+    def run_once(self, summarize: Optional[Summarizer] = None) -> Dict:
+        with self._lock:
+            t0, moved, sessions = time.monotonic(), 0, 0
+            now = datetime.datetime.utcnow()
+            with self._session_factory() as db:
+                npcs = db.query(NPC.id, NPC.retention_days).all()
+            for npc_id, days in npcs:
+                days = self.default_days if days is None else days
+                if not days or days <= 0: continue
+                cutoff = now - datetime.timedelta(days=days)
+                for chat_pk in self._stale_sessions(npc_id, cutoff):
+                    n = self._compact(chat_pk, cutoff, summarize)
+                    moved += n; sessions += n > 0
+            self.runs += 1
+            self.last_run = {"at": now.isoformat(), "seconds": round(time.monotonic() - t0, 3),
+                             "sessions": sessions, "messages": moved}
+            return self.last_run
+
+    def _stale_sessions(self, npc_id: int, cutoff: datetime.datetime) -> List[int]:
+        old = exists().where(Message.chat_session_id == ChatSession.id, Message.role.in_(TURNS),
+                             Message.created_at < cutoff)
+        with self._session_factory() as db:
+            return [pk for (pk,) in db.query(ChatSession.id).filter(ChatSession.npc_id == npc_id, old)]
+
+    def _compact(self, chat_pk: int, cutoff: datetime.datetime, summarize: Optional[Summarizer]) -> int:
+        moved = 0
+        while True:
+            with self._session_factory() as db:
+                rows = db.query(Message.id, Message.role, Message.content, Message.created_at) \
+                         .filter(*self._movable(db, chat_pk, cutoff)).order_by(Message.id).limit(self.batch).all()
+            if not rows: return moved
+            text = None
+            if self.mode == "summarize":
+                turns = [(r.role, r.content) for r in rows if r.role in TURNS]
+                if not turns: return moved  # only an earlier summary left
+                previous = " ".join(r.content for r in rows if r.role == "summary") or None
+                text = summarize(previous, turns) if summarize else None
+                if not text: return moved  # LLM unavailable: these stay until the next run
+            if not self._move(chat_pk, cutoff, rows, text): return moved
+            moved += len(rows)
+            if len(rows) < self.batch: return moved
+
+    def _movable(self, db: Session, chat_pk: int, cutoff: datetime.datetime) -> list:
+        cond = [Message.chat_session_id == chat_pk, Message.role != "system", Message.created_at < cutoff]
+        keep = self.history.max_messages
+        if keep > 0:  # the prompt window always stays
+            first_kept = db.query(Message.id).filter(Message.chat_session_id == chat_pk, Message.role.in_(TURNS)) \
+                           .order_by(Message.id.desc()).offset(keep - 1).limit(1).scalar()
+            cond.append(Message.id < (first_kept or 0))
+        return cond
+
+    def _move(self, chat_pk: int, cutoff: datetime.datetime, rows, text: Optional[str]) -> bool:
+        first, last = rows[0], rows[-1]
+        with self._session_factory() as db:
+            res = db.execute(delete(Message).where(
+                Message.chat_session_id == chat_pk, Message.role != "system", Message.created_at < cutoff,
+                Message.id >= first.id, Message.id <= last.id))
+            if res.rowcount != len(rows):  # another worker compacted (part of) this batch meanwhile
+                db.rollback()
+                return False
+            db.execute(insert(MessageArchive), [{"message_id": r.id, "chat_session_id": chat_pk, "role": r.role,
+                                                 "content": r.content, "created_at": r.created_at} for r in rows])
+            if text:  # takes the place (id, time) of the last message it covers
+                db.add(Message(id=last.id, chat_session_id=chat_pk, role="summary", content=text.strip(),
+                               created_at=last.created_at))
+            turns = sum(r.role in TURNS for r in rows)
+            db.execute(update(ChatSession).where(ChatSession.id == chat_pk)
+                       .values(compacted=func.coalesce(ChatSession.compacted, 0) + turns))
+            db.commit()
+        self.moved += len(rows); self.summaries += bool(text)
+        HISTORY_COMPACTED.inc(len(rows), mode=self.mode)
+        return True
+
+    def stats(self) -> Dict:
+        return {"mode": self.mode, "default_days": self.default_days, "runs": self.runs,
+                "messages_archived": self.moved, "summaries": self.summaries, "last_run": self.last_run}
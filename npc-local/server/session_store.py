@@ -0,0 +1,149 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/session_store.py — /chat and /persona sessions: in-process LRU+TTL, or shared through SQLite
+import json, threading, time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func, insert, select, update
+
+from db import ChatScratch
+
+Messages = List[Dict[str, str]]
+MAX_RETRIES = 8  # compare-and-set attempts before a turn gives up (409)
+
+def _bytes(messages: Messages) -> int:
+    return sum(len(m.get("role", "")) + len(m.get("content", "")) + 64 for m in messages)  # + dict overhead, roughly
+
+class SessionStore(ABC):
+    """A message list per session id. `update` is the one write: the new list is computed from the
+    current one and stored only if nobody changed the session in between (else it is recomputed),
+    so concurrent turns on one session interleave instead of overwriting each other. Sessions
+    idle for `ttl_s` expire; beyond `max_sessions` the least recently used go first."""
+    backend = ""
+
+    def __init__(self, max_sessions: int = 10000, ttl_s: float = 86400.0):
+        self.max_sessions, self.ttl_s = max(1, max_sessions), ttl_s
+        self.evictions = self.expirations = self.conflicts = 0
+
+    @abstractmethod
+    def get(self, session_id: str) -> Messages: ...
+
+    @abstractmethod
+    def update(self, session_id: str, fn: Callable[[Messages], Messages]) -> Messages: ...
+
+    def append(self, session_id: str, messages: Messages,
+               prune: Optional[Callable[[Messages], Messages]] = None) -> Messages:
+        return self.update(session_id, lambda cur: (prune or list)(cur + list(messages)))
+
+    @abstractmethod
+    def stats(self) -> Dict: ...
+
+class MemorySessionStore(SessionStore):
+    """This process only: right for one API worker (or sticky routing)."""
+    backend = "memory"
+
+    def __init__(self, max_sessions: int = 10000, ttl_s: float = 86400.0):
+        super().__init__(max_sessions, ttl_s)
+        self._sessions: "OrderedDict[str, Tuple[float, Messages, int]]" = OrderedDict()  # id -> (last use, messages, bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _live(self, session_id: str, now: float) -> Messages:
+        entry = self._sessions.get(session_id)
+        if entry is None: return []
+        if self.ttl_s and now - entry[0] > self.ttl_s:
+            self._drop(session_id); self.expirations += 1
+            return []
+        return entry[1]
+
+    def _drop(self, session_id: str):
+        self._bytes -= self._sessions.pop(session_id)[2]
+
+    def get(self, session_id: str) -> Messages:
+        with self._lock:
+            return list(self._live(session_id, time.monotonic()))
+
+    def update(self, session_id: str, fn: Callable[[Messages], Messages]) -> Messages:
+        with self._lock:
+            now = time.monotonic()
+            new = fn(list(self._live(session_id, now)))
+            if session_id in self._sessions: self._drop(session_id)
+            size = _bytes(new)
+            self._sessions[session_id] = (now, new, size)
+            self._bytes += size
+            while len(self._sessions) > self.max_sessions:
+                self._drop(next(iter(self._sessions))); self.evictions += 1
+            while self.ttl_s and now - next(iter(self._sessions.values()))[0] > self.ttl_s:  # oldest first
+                self._drop(next(iter(self._sessions))); self.expirations += 1
+            return list(new)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"backend": self.backend, "sessions": len(self._sessions), "bytes_est": self._bytes,
+                    "evictions": self.evictions, "expirations": self.expirations, "conflicts": self.conflicts}
+
+class SQLiteSessionStore(SessionStore):
+    """The chat_scratch table next to the NPC data (DB_PATH): every API worker sees the same
+    sessions, and they survive restarts. Each row carries a version; a write only lands on the
+    version it was computed from. Expiry and the size cap are applied every `sweep_s`."""
+    backend = "sqlite"
+
+    def __init__(self, engine, max_sessions: int = 10000, ttl_s: float = 86400.0, sweep_s: float = 60.0):
+        super().__init__(max_sessions, ttl_s)
+        self.engine, self.sweep_s = engine, sweep_s
+        self._swept = 0.0
+
+    def _read(self, conn, session_id: str) -> Tuple[Messages, Optional[int]]:
+        row = conn.execute(select(ChatScratch.data, ChatScratch.version, ChatScratch.updated_at)
+                           .where(ChatScratch.session_id == session_id)).first()
+        if row is None: return [], None
+        if self.ttl_s and time.time() - row.updated_at > self.ttl_s: return [], row.version  # overwritten below
+        return json.loads(row.data), row.version
+
+    def get(self, session_id: str) -> Messages:
+        with self.engine.connect() as conn:
+            return self._read(conn, session_id)[0]
+
+    def update(self, session_id: str, fn: Callable[[Messages], Messages]) -> Messages:
+        for _ in range(MAX_RETRIES):
+            with self.engine.connect() as conn:
+                cur, version = self._read(conn, session_id)
+                new = fn(cur)
+                values = {"data": json.dumps(new, ensure_ascii=False), "updated_at": time.time()}
+                if version is None:
+                    res = conn.execute(insert(ChatScratch).prefix_with("OR IGNORE")
+                                       .values(session_id=session_id, version=1, **values))
+                else:
+                    res = conn.execute(update(ChatScratch)
+                                       .where(ChatScratch.session_id == session_id, ChatScratch.version == version)
+                                       .values(version=version + 1, **values))
+                conn.commit()
+            if res.rowcount == 1:
+                self._maybe_sweep()
+                return new
+            self.conflicts += 1  # another turn wrote first: recompute on top of it
+        raise HTTPException(409, "Session is being updated concurrently; retry")
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now - self._swept < self.sweep_s: return
+        self._swept = now
+        with self.engine.begin() as conn:
+            if self.ttl_s:
+                self.expirations += conn.execute(delete(ChatScratch).where(ChatScratch.updated_at < now - self.ttl_s)).rowcount
+            newest = select(ChatScratch.session_id).order_by(ChatScratch.updated_at.desc()).offset(self.max_sessions)
+            self.evictions += conn.execute(delete(ChatScratch).where(ChatScratch.session_id.in_(newest))).rowcount
+
+    def stats(self) -> Dict:
+        with self.engine.connect() as conn:
+            n, size = conn.execute(select(func.count(), func.coalesce(func.sum(func.length(ChatScratch.data)), 0))).one()
+        return {"backend": self.backend, "sessions": n, "bytes_est": size,  # all workers; counters are this one's
+                "evictions": self.evictions, "expirations": self.expirations, "conflicts": self.conflicts}
+
+def make_session_store(backend: str, engine, max_sessions: int, ttl_s: float) -> SessionStore:
+    if backend == "sqlite": return SQLiteSessionStore(engine, max_sessions, ttl_s)
+    if backend == "memory": return MemorySessionStore(max_sessions, ttl_s)
+    raise ValueError(f"CHAT_SESSION_STORE must be memory or sqlite, not {backend!r}")
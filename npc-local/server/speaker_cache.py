@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/speaker_cache.py
+import os, hashlib, threading
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple, Any
+
+Latents = Tuple[Any, Any]  # (gpt_cond_latent, speaker_embedding) torch tensors
+
+def file_sha256(path: str, chunk: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class SpeakerLatentCache:
+    """XTTS conditioning latents per reference voice.
+
+    Entries are keyed by the sha256 of the voice file's *content*, so re-uploading a voice
+    (same path, new bytes) misses naturally and the old entry just ages out of the LRU.
+    Layers: in-memory LRU -> `{storage_dir}/{hash}.pt` -> `compute(path)`.
+    """
+    def __init__(self, compute: Callable[[str], Latents], storage_dir: str, max_items: int = 32,
+                 device: Callable[[], Any] = lambda: "cpu"):
+        self._compute = compute
+        self._device = device  # where latents loaded from disk should live (the model's device)
+        self.storage_dir = storage_dir
+        self.max_items = max(1, max_items)
+        self._mem: "OrderedDict[str, Latents]" = OrderedDict()
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}  # path -> (mtime_ns, size, sha256) of its current file
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+    def voice_hash(self, path: str) -> str:
+        st = os.stat(path)
+        path = os.path.abspath(path)
+        memo = self._hashes.get(path)
+        if memo is not None and memo[:2] == (st.st_mtime_ns, st.st_size):
+            return memo[2]
+        digest = file_sha256(path)
+        self._hashes[path] = (st.st_mtime_ns, st.st_size, digest)  # a re-upload replaces the entry
+        return digest
+
+    def get(self, path: str) -> Latents:
+        key = self.voice_hash(path)
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return self._mem[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:  # one computation per voice even under concurrent first requests
+            with self._lock:
+                if key in self._mem:
+                    return self._mem[key]
+            latents = self._load(key)
+            if latents is None:
+                latents = self._compute(path)
+                self._save(key, latents)
+            with self._lock:
+                self._mem[key] = latents
+                while len(self._mem) > self.max_items:
+                    self._mem.popitem(last=False)
+                self._key_locks.pop(key, None)
+            return latents
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.storage_dir, f"{key}.pt")
+
+    def _load(self, key: str):
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            import torch
+            data = torch.load(path, map_location=self._device())
+            return data["gpt_cond_latent"], data["speaker_embedding"]
+        except Exception as e:
+            print(f"[speaker_cache] ignoring unreadable {path}: {e}")
+            return None
+
+    def _save(self, key: str, latents: Latents):
+        try:
+            import torch
+            os.makedirs(self.storage_dir, exist_ok=True)
+            tmp = self._disk_path(key) + ".tmp"
+            torch.save({"gpt_cond_latent": latents[0].detach().cpu(),
+                        "speaker_embedding": latents[1].detach().cpu()}, tmp)
+            os.replace(tmp, self._disk_path(key))
+        except Exception as e:
+            print(f"[speaker_cache] could not persist {key}: {e}")
@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/ssml.py — the SSML subset (<break>, <prosody rate>) compiled once into synthesis segments
+import re
+from functools import lru_cache
+from typing import List, NamedTuple, Tuple
+
+_TOKENS = re.compile(r'(<break[^>]*>|<prosody[^>]*>|</prosody>)')
+_TIME = re.compile(r'time="([^"]+)"')
+_RATE = re.compile(r'rate="([^"]+)"')
+RATE_NAMES = {"x-slow": 0.6, "slow": 0.8, "medium": 1.0, "fast": 1.2, "x-fast": 1.4}
+
+class Segment(NamedTuple):
+    text: str      # plain text for one model call
+    rate: float
+    pause_ms: int  # silence after it
+
+def _break_ms(tag: str) -> int:
+    m = _TIME.search(tag)
+    if not m: return 0
+    val = m.group(1).lower()
+    try:
+        if val.endswith("ms"): return max(0, int(float(val[:-2])))
+        if val.endswith("s"): return max(0, int(float(val[:-1]) * 1000))
+    except ValueError:
+        pass
+    return 0
+
+def _rate(tag: str, current: float) -> float:
+    m = _RATE.search(tag)
+    if not m: return current
+    v = m.group(1).lower()
+    if v in RATE_NAMES: return RATE_NAMES[v]
+    try: return float(v[:-1]) / 100.0 if v.endswith("%") else float(v)
+    except ValueError: return current
+
+@lru_cache(maxsize=4096)
+def compile_ssml(text: str, base_rate: float = 1.0, merge_break_ms: int = 0) -> Tuple[Segment, ...]:
+    """Segments to synthesize for `text`, fewest model calls first.
+
+    A part ends where the rate changes or at a <break>. Then neighbours are coalesced: text at
+    the same rate is joined across tags that don't change it (closing and reopening the same
+    <prosody>, zero-length breaks), consecutive breaks add up, whitespace between breaks is just
+    silence, and a break before any text is dropped. Breaks up to `merge_break_ms` between
+    same-rate text are folded into the text as a comma (one model call instead of two, XTTS
+    pauses there itself). Cached: the LLM repeats itself and the splitter re-sends markup.
+    """
+    raw: List[List] = []  # [text, rate, pause_ms]
+    current: List[str] = []
+    rate_stack = [base_rate]
+
+    def flush(pause_ms: int = 0):
+        raw.append(["".join(current), rate_stack[-1], pause_ms])
+        current.clear()
+
+    for tok in _TOKENS.split(text):
+        if tok.startswith("<break"):
+            flush(_break_ms(tok))
+        elif tok.startswith("<prosody"):
+            rate = _rate(tok, rate_stack[-1])
+            if current and rate != rate_stack[-1]: flush()
+            rate_stack.append(rate)
+        elif tok == "</prosody>":
+            if len(rate_stack) > 1:
+                if current and rate_stack[-2] != rate_stack[-1]: flush()
+                rate_stack.pop()
+        elif tok:
+            current.append(tok)
+    flush()
+
+    out: List[List] = []
+    for seg_text, rate, pause_ms in raw:
+        if not seg_text.strip():
+            if out: out[-1][2] += pause_ms  # silence only
+            continue
+        prev = out[-1] if out else None
+        if prev is not None and prev[1] == rate and prev[2] == 0:
+            prev[0], prev[2] = prev[0] + seg_text, pause_ms
+        elif prev is not None and prev[1] == rate and prev[2] <= merge_break_ms:
+            head = prev[0].rstrip()
+            prev[0], prev[2] = head + (", " if head[-1:].isalnum() else " ") + seg_text.lstrip(), pause_ms
+        else:
+            out.append([seg_text, rate, pause_ms])
+    return tuple(Segment(t.strip(), r, p) for t, r, p in out)
@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/stt_batcher.py — dynamic micro-batching in front of Whisper
+import math, queue, threading, time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+MAX_BATCH_SECONDS = 30.0  # one Whisper window; longer clips take the regular path
+
+TranscribeOne = Callable[[np.ndarray, Optional[str]], str]
+TranscribeBatch = Callable[[List[np.ndarray], List[Optional[str]]], List[str]]
+
+class WhisperBatcher:
+    """Collects clips from concurrent requests and decodes them together.
+
+    The first clip to arrive opens a window; the batch is closed after `window_ms` or as soon as
+    `max_batch` clips are waiting, then run in one call and each caller gets its own text back.
+    Callers block in `transcribe()` (they already sit on STT worker threads), so the STT pool
+    needs at least `max_batch` workers for batches to fill up.
+    """
+    def __init__(self, transcribe_one: TranscribeOne, transcribe_batch: TranscribeBatch,
+                 max_batch: int = 8, window_ms: float = 30.0):
+        self._one = transcribe_one
+        self._batch = transcribe_batch
+        self.max_batch = max(1, max_batch)
+        self.window_s = max(0.0, window_ms) / 1000.0
+        self._q: "queue.Queue[Tuple[np.ndarray, Optional[str], Future]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.batches = 0
+        self.clips = 0
+
+    def transcribe(self, audio: np.ndarray, language: Optional[str]) -> str:
+        if self.max_batch <= 1 or audio.shape[0] > MAX_BATCH_SECONDS * SAMPLE_RATE:
+            return self._one(audio, language)
+        self._ensure_thread()
+        fut: Future = Future()
+        self._q.put((audio, language, fut))
+        return fut.result()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name="whisper-batcher", daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._q.get()]
+            deadline = time.monotonic() + self.window_s
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try: batch.append(self._q.get(timeout=remaining))
+                except queue.Empty: break
+            self._run(batch)
+
+    def _run(self, batch):
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch: return
+        self.batches += 1; self.clips += len(batch)
+        try:
+            if len(batch) == 1:
+                texts = [self._one(batch[0][0], batch[0][1])]
+            else:
+                texts = self._batch([a for a, _, _ in batch], [lang for _, lang, _ in batch])
+        except Exception as e:
+            for _, _, fut in batch: fut.set_exception(e)
+            return
+        for (_, _, fut), text in zip(batch, texts):
+            fut.set_result(text)
+
+# ── faster-whisper backends ─────────────────────────────────────────────────
+def whisper_transcribe_one(model, audio: np.ndarray, language: Optional[str]) -> str:
+    segments, _ = model.transcribe(audio, language=language, vad_filter=True, without_timestamps=True)
+    return "".join(seg.text for seg in segments).strip()
+
+def whisper_transcribe_batch(model, audios: List[np.ndarray], languages: List[Optional[str]],
+                             beam_size: int = 5, no_speech_threshold: float = 0.6,
+                             log_prob_threshold: float = -1.0) -> List[str]:
+    """Decode up to 30 s clips as one CTranslate2 batch (mel features stacked on the batch axis).
+
+    Mirrors what `transcribe(vad_filter=True, without_timestamps=True)` does for a single short
+    clip: Silero VAD trims non-speech, unknown languages are detected (batched as well), and a
+    clip whose first window looks like silence yields "".
+    """
+    import ctranslate2
+    from faster_whisper.audio import pad_or_trim
+    from faster_whisper.tokenizer import Tokenizer
+    from faster_whisper.vad import get_speech_timestamps, collect_chunks
+
+    texts = [""] * len(audios)
+    idx, feats = [], []
+    for i, audio in enumerate(audios):
+        speech = get_speech_timestamps(audio)
+        if not speech: continue
+        audio = collect_chunks(audio, speech)
+        feats.append(pad_or_trim(model.feature_extractor(audio)))
+        idx.append(i)
+    if not idx:
+        return texts
+    features = ctranslate2.StorageView.from_array(np.ascontiguousarray(np.stack(feats).astype(np.float32)))
+
+    langs = [languages[i] for i in idx]
+    if model.model.is_multilingual and any(lang is None for lang in langs):
+        detected = model.model.detect_language(features)
+        langs = [lang or detected[j][0][0][2:-2] for j, lang in enumerate(langs)]
+    tokenizers = {lang: Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe",
+                                  language=lang or "en") for lang in set(langs)}
+    prompts = [list(tokenizers[lang].sot_sequence) + [tokenizers[lang].no_timestamps] for lang in langs]
+
+    results = model.model.generate(features, prompts, beam_size=beam_size, max_length=448,
+                                   suppress_blank=True, suppress_tokens=[-1],
+                                   return_scores=True, return_no_speech_prob=True)
+    for j, res in enumerate(results):
+        tokens = res.sequences_ids[0]
+        avg_logprob = res.scores[0] * len(tokens) / (len(tokens) + 1) if tokens else -math.inf
+        if res.no_speech_prob > no_speech_threshold and avg_logprob < log_prob_threshold:
+            continue
+        texts[idx[j]] = tokenizers[langs[j]].decode(tokens).strip()
+    return texts
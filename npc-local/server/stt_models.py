@@ -0,0 +1,163 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/stt_models.py — several Whisper models under one memory budget, picked per request
+import re, threading, time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+
+from metrics import STT_MODEL_EVICTIONS, STT_MODEL_REQUESTS, STT_MODEL_SECONDS
+from stt_batcher import SAMPLE_RATE, TranscribeBatch, TranscribeOne, WhisperBatcher
+
+COMPUTE_TYPES = {"int8": 1, "int8_float16": 1, "int8_bfloat16": 1, "int8_float32": 1,
+                 "float16": 2, "bfloat16": 2, "float32": 4, "default": 2}  # bytes per weight
+PARAMS_M = {"tiny": 39, "base": 74, "small": 244, "medium": 769, "large": 1550, "large-v1": 1550,
+            "large-v2": 1550, "large-v3": 1550, "large-v3-turbo": 809, "turbo": 809,
+            "distil-small": 166, "distil-medium": 394, "distil-large-v2": 756, "distil-large-v3": 756}
+RUNTIME_MB = 150  # mel filters, tokenizer, CTranslate2 buffers
+
+def parse_spec(spec: str, default_compute: str) -> Tuple[str, str]:
+    """"medium" or "medium:int8_float16" -> (size, compute type)."""
+    size, _, compute = spec.strip().rpartition(":")
+    if size and compute in COMPUTE_TYPES: return size, compute
+    return spec.strip(), default_compute
+
+def estimate_mb(size: str, compute: str) -> int:
+    """Rough resident size; a local path or an unknown repo counts as `small`."""
+    base = re.sub(r"\.en$", "", size.rstrip("/").rsplit("/", 1)[-1].replace("faster-whisper-", ""))
+    return int(PARAMS_M.get(base, PARAMS_M["small"]) * COMPUTE_TYPES.get(compute, 2) * 1.25) + RUNTIME_MB
+
+def parse_routes(value: str) -> Dict[str, str]:
+    """"de=medium,ja=medium:float16" -> {"de": "medium", "ja": "medium:float16"}."""
+    out = {}
+    for item in value.split(","):
+        lang, _, spec = item.partition("=")
+        if lang.strip() and spec.strip(): out[lang.strip().lower()] = spec.strip()
+    return out
+
+class _Model:
+    def __init__(self, name: str, size: str, compute: str, one: TranscribeOne, batch: TranscribeBatch,
+                 max_batch: int, window_ms: float):
+        self.name, self.size, self.compute = name, size, compute
+        self.mb = estimate_mb(size, compute)
+        self.model = None
+        self.active = 0         # requests between acquire and release; never evicted while > 0
+        self.last_used = 0.0
+        self.loads = 0
+        self.load_lock = threading.Lock()
+        # concurrent clips for the same model are decoded as one batch
+        self.batcher = WhisperBatcher(lambda audio, lang: one(self.model, audio, lang),
+                                      lambda audios, langs: batch(self.model, audios, langs),
+                                      max_batch=max_batch, window_ms=window_ms)
+
+class WhisperModels:
+    """Whisper models by name ("size" or "size:compute"), loaded on first use and evicted least
+    recently used first when loading one more would exceed `budget_mb` (0 = no limit).
+
+    Which model a clip gets: the request's own choice (400 if it isn't one of `names`), else the
+    NPC's, else `lang_models[lang]`, else `short_model` for clips up to `short_s` seconds, else
+    `default`. Models in use are never evicted, so a burst over the budget loads anyway and is
+    trimmed back once they are idle.
+    """
+    def __init__(self, load: Callable[[str, str], object], one: TranscribeOne, batch: TranscribeBatch,
+                 default: str, extra: Iterable[str] = (), lang_models: Optional[Dict[str, str]] = None,
+                 short_model: str = "", short_s: float = 0.0, budget_mb: int = 0,
+                 default_compute: str = "int8", max_batch: int = 8, window_ms: float = 30.0):
+        self._load = load
+        self.default = default
+        self.lang_models = lang_models or {}
+        self.short_model, self.short_s = short_model, short_s
+        self.budget_mb = budget_mb
+        self._models: "OrderedDict[str, _Model]" = OrderedDict()  # least recently used first
+        for name in [default, short_model, *self.lang_models.values(), *extra]:
+            if name and name not in self._models:
+                size, compute = parse_spec(name, default_compute)
+                self._models[name] = _Model(name, size, compute, one, batch, max_batch, window_ms)
+        self._lock = threading.Lock()
+
+    @property
+    def names(self):
+        return list(self._models)
+
+    def route(self, audio_s: float, language: Optional[str], model: Optional[str] = None,
+              npc_model: Optional[str] = None) -> Tuple[str, str]:
+        """(model name, why)."""
+        if model:
+            if model not in self._models:
+                raise HTTPException(400, f"Unknown stt_model {model!r}; available: {', '.join(self._models)}")
+            return model, "request"
+        if npc_model and npc_model in self._models: return npc_model, "npc"
+        lang_model = self.lang_models.get((language or "").lower())
+        if lang_model: return lang_model, "language"
+        if self.short_model and audio_s <= self.short_s: return self.short_model, "short"
+        return self.default, "default"
+
+    def transcribe(self, audio: np.ndarray, language: Optional[str], model: Optional[str] = None,
+                   npc_model: Optional[str] = None) -> str:
+        name, why = self.route(len(audio) / SAMPLE_RATE, language, model, npc_model)
+        entry, result = self._acquire(name)
+        STT_MODEL_REQUESTS.inc(model=name, route=why, result=result)
+        try:
+            with STT_MODEL_SECONDS.time(model=name):
+                return entry.batcher.transcribe(audio, language)
+        finally:
+            self._release(entry)
+
+    def get(self, name: Optional[str] = None):
+        """The loaded model itself (warm-up); counts as a use for the LRU."""
+        entry, _ = self._acquire(name or self.default)
+        self._release(entry)
+        return entry.model
+
+    def _acquire(self, name: str) -> Tuple[_Model, str]:
+        with self._lock:
+            entry = self._models[name]
+            entry.active += 1
+            self._models.move_to_end(name)
+        try:
+            if entry.model is not None: return entry, "hit"
+            with entry.load_lock:
+                if entry.model is not None: return entry, "hit"
+                self._make_room(entry)
+                t = time.perf_counter()
+                entry.model = self._load(entry.size, entry.compute)
+                entry.loads += 1
+                print(f"[stt_models] loaded {name} (~{entry.mb} MB) in {time.perf_counter() - t:.1f}s")
+                return entry, "load"
+        except BaseException:
+            self._release(entry)
+            raise
+
+    def _release(self, entry: _Model):
+        with self._lock:
+            entry.active -= 1
+            entry.last_used = time.monotonic()
+        if self.budget_mb and self.loaded_mb() > self.budget_mb:
+            self._make_room(None)
+
+    def _make_room(self, entry: Optional[_Model]):
+        """Drop idle models, least recently used first, until `entry` fits (or nothing is idle)."""
+        if not self.budget_mb: return
+        with self._lock:
+            need = entry.mb if entry is not None else 0
+            for other in list(self._models.values()):
+                if self.loaded_mb() + need <= self.budget_mb: break
+                if other is entry or other.model is None or other.active: continue
+                other.model = None  # CTranslate2 frees it with the last reference
+                STT_MODEL_EVICTIONS.inc(model=other.name)
+                print(f"[stt_models] evicted {other.name} (~{other.mb} MB) to stay under {self.budget_mb} MB")
+
+    def loaded_mb(self) -> int:
+        return sum(m.mb for m in self._models.values() if m.model is not None)
+
+    def summary(self) -> Dict:
+        return {"budget_mb": self.budget_mb, "loaded_mb": self.loaded_mb(),
+                "models": {m.name: {"loaded": m.model is not None, "est_mb": m.mb, "loads": m.loads,
+                                    "batches": m.batcher.batches, "clips": m.batcher.clips}
+                           for m in self._models.values()}}
+
+    def batch_totals(self) -> Tuple[int, int]:
+        return (sum(m.batcher.batches for m in self._models.values()),
+                sum(m.batcher.clips for m in self._models.values()))
@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/vad.py — incremental energy VAD and end-of-utterance detection for streamed microphone audio
+import math
+from collections import deque
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+def frame_dbfs(frame: np.ndarray) -> float:
+    """RMS level of float32 samples in [-1, 1], in dBFS (digital silence is about -100)."""
+    return 10.0 * math.log10(float(np.dot(frame, frame)) / max(1, frame.shape[0]) + 1e-10)
+
+def voiced_ms(audio: np.ndarray, sample_rate: int = 16000, frame_ms: int = 30, min_dbfs: float = -45.0,
+              snr_db: float = 10.0) -> float:
+    """How much of a whole clip is speech-like, in one vectorized pass (no per-frame Python).
+
+    Same test as the Endpointer: above `min_dbfs` and `snr_db` over the noise floor, here the clip's
+    10th-percentile frame level. The floor is capped at `min_dbfs + snr_db` so a clip that is speech
+    from start to end (no quiet frames to learn from) still counts; steady hum or hiss doesn't.
+    """
+    frame = max(1, sample_rate * frame_ms // 1000)
+    n = audio.shape[0] // frame
+    if n == 0: return 0.0
+    frames = np.asarray(audio[:n * frame], dtype=np.float32).reshape(n, frame)
+    db = 10.0 * np.log10(np.einsum("ij,ij->i", frames, frames) / frame + 1e-10)
+    floor = min(float(np.percentile(db, 10)), min_dbfs + snr_db)
+    return float(np.count_nonzero(db > max(min_dbfs, floor + snr_db))) * frame_ms
+
+class Endpointer:
+    """Finds utterances in a continuous stream of mono float32 audio.
+
+    Audio is cut into `frame_ms` frames; a frame is voiced when its level is above both `min_dbfs`
+    and the tracked noise floor + `snr_db`. The floor starts at the first frame's level (capped at
+    `min_dbfs + snr_db`, as in `voiced_ms`), follows unvoiced frames and creeps up by
+    `noise_rise_db_s` through voiced ones, so a steady fan or hum, from the start or not, raises
+    the bar within seconds instead of triggering. `start_ms` of consecutive voiced frames start
+    an utterance (plus `preroll_ms` from before, so the first syllable isn't clipped);
+    `end_silence_ms` of unvoiced frames, or `max_utterance_s`, end it. `feed()` returns events:
+    ("start", None) as soon as speech is confirmed and ("end", audio) with the utterance.
+    """
+    def __init__(self, sample_rate: int = 16000, frame_ms: int = 30, start_ms: int = 120,
+                 end_silence_ms: int = 600, preroll_ms: int = 300, max_utterance_s: float = 15.0,
+                 min_dbfs: float = -45.0, snr_db: float = 10.0, noise_rise_db_s: float = 2.0):
+        self.sample_rate = sample_rate
+        self.frame = max(1, sample_rate * frame_ms // 1000)
+        self.start_frames = max(1, -(-start_ms // frame_ms))
+        self.end_frames = max(1, -(-end_silence_ms // frame_ms))
+        self.keep_frames = min(self.end_frames, max(1, 200 // frame_ms))  # trailing silence kept (~200 ms)
+        self.max_frames = max(self.start_frames + 1, int(max_utterance_s * 1000 / frame_ms))
+        self.min_dbfs, self.snr_db = min_dbfs, snr_db
+        self.noise_rise = noise_rise_db_s * frame_ms / 1000.0  # dB per voiced frame
+        self.noise_db: Optional[float] = None  # seeded from the first frame
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._preroll: deque = deque(maxlen=max(self.start_frames, -(-preroll_ms // frame_ms) + self.start_frames))
+        self._frames: List[np.ndarray] = []
+        self._voiced_run = 0
+        self._silence = 0
+        self.in_speech = False
+
+    def feed(self, audio: np.ndarray) -> List[Tuple[str, Optional[np.ndarray]]]:
+        events = []
+        buf = np.concatenate((self._pending, audio)) if self._pending.size else audio
+        n = buf.shape[0] // self.frame
+        for i in range(n):
+            event = self._frame(buf[i * self.frame:(i + 1) * self.frame])
+            if event: events.append(event)
+        self._pending = buf[n * self.frame:].copy()
+        return events
+
+    def flush(self) -> Optional[np.ndarray]:
+        """End the current utterance now (client said it stopped talking); None if there is none."""
+        return self._end(trim=False) if self.in_speech else None
+
+    def _frame(self, frame: np.ndarray):
+        db = frame_dbfs(frame)
+        if self.noise_db is None:
+            self.noise_db = min(max(db, -90.0), self.min_dbfs + self.snr_db)
+        voiced = db > max(self.min_dbfs, self.noise_db + self.snr_db)
+        if voiced:  # slow minimum follower: only steady noise stays voiced long enough to lift it
+            self.noise_db = min(self.noise_db + self.noise_rise, db)
+        else:
+            self.noise_db += 0.05 * (max(db, -90.0) - self.noise_db)  # slow EMA over non-speech
+        if not self.in_speech:
+            self._preroll.append(frame)
+            if not voiced:
+                self._voiced_run = 0
+                return None
+            self._voiced_run += 1
+            if self._voiced_run < self.start_frames:
+                return None
+            self.in_speech, self._silence = True, 0
+            self._frames = list(self._preroll)
+            self._preroll.clear()
+            return ("start", None)
+        self._frames.append(frame)
+        self._silence = 0 if voiced else self._silence + 1
+        if self._silence >= self.end_frames or len(self._frames) >= self.max_frames:
+            return ("end", self._end(trim=True))
+        return None
+
+    def _end(self, trim: bool) -> np.ndarray:
+        frames = self._frames
+        if trim and self._silence > self.keep_frames:
+            frames = frames[:len(frames) - (self._silence - self.keep_frames)]
+        audio = np.concatenate(frames) if frames else np.zeros(0, dtype=np.float32)
+        self._frames, self._voiced_run, self._silence, self.in_speech = [], 0, 0, False
+        return audio
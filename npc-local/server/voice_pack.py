@@ -0,0 +1,180 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/voice_pack.py — pre-rendered NPC lines in one indexed file, served from a memory map
+#
+# Layout of VOICES_STORAGE/{npc_id}/lines.pack:
+#   header   MAGIC + <QQ index offset, index length>
+#   data     the WAV files back to back
+#   index    JSON {"voice_hash", "created", "lines": [{"text", "language", "offset", "length"}]}
+# The index is written last and the file is renamed into place, so readers only ever see whole packs.
+import json, mmap, os, struct, threading, time
+from typing import Dict, Iterator, Optional, Tuple
+
+from audio_cache import normalize_text
+from speaker_cache import file_sha256
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: PackLock only orders jobs within one process
+    fcntl = None
+
+MAGIC = b"NPCVPK1\n"
+HEADER = struct.Struct("<8sQQ")
+PACK_NAME = "lines.pack"
+
+def line_key(text: str, language: str) -> Tuple[str, str]:
+    return (language or "").lower(), normalize_text(text)
+
+class VoicePack:
+    """One pack, mmapped read-only: lookups are a dict probe and a slice of the page cache
+    (shared by every worker process that has the pack open)."""
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: not a voice pack")
+        index = json.loads(self._mm[index_offset:index_offset + index_length])
+        self.voice_hash: str = index["voice_hash"]
+        self.created: float = index.get("created", 0.0)
+        self._lines: Dict[Tuple[str, str], Tuple[str, int, int]] = {
+            line_key(l["text"], l["language"]): (l["text"], l["offset"], l["length"]) for l in index["lines"]}
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self._lines
+
+    @property
+    def size(self) -> int:
+        return len(self._mm)
+
+    def get(self, text: str, language: str) -> Optional[bytes]:
+        hit = self._lines.get(line_key(text, language))
+        return None if hit is None else self._mm[hit[1]:hit[1] + hit[2]]
+
+    def lines(self) -> Iterator[Tuple[str, str, bytes]]:
+        """(text, language, wav) of every line, for carrying lines over into a new pack."""
+        for (language, _), (text, offset, length) in self._lines.items():
+            yield text, language, self._mm[offset:offset + length]
+
+    def summary(self) -> Dict:
+        return {"lines": len(self), "bytes": self.size, "voice_hash": self.voice_hash, "created": self.created}
+
+class PackWriter:
+    """Builds a pack next to its final path; `commit()` renames it into place, `abort()` drops it.
+    Lines are appended as they are rendered, so a big job never holds all its audio in memory."""
+    def __init__(self, path: str, voice_hash: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path, self.voice_hash = path, voice_hash
+        self._tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._f = open(self._tmp, "wb")
+        self._f.write(HEADER.pack(MAGIC, 0, 0))
+        self._lines: Dict[Tuple[str, str], Dict] = {}
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        return key in self._lines
+
+    def add(self, text: str, language: str, wav: bytes):
+        key = line_key(text, language)
+        if key in self._lines: return
+        self._lines[key] = {"text": text, "language": key[0], "offset": self._f.tell(), "length": len(wav)}
+        self._f.write(wav)
+
+    def commit(self) -> int:
+        index = json.dumps({"voice_hash": self.voice_hash, "created": time.time(), "lines": list(self._lines.values())}).encode("utf-8")
+        offset = self._f.tell()
+        self._f.write(index)
+        self._f.seek(0)
+        self._f.write(HEADER.pack(MAGIC, offset, len(index)))
+        self._f.flush(); os.fsync(self._f.fileno()); self._f.close()
+        os.replace(self._tmp, self.path)
+        return len(self._lines)
+
+    def abort(self):
+        self._f.close()
+        try: os.remove(self._tmp)
+        except OSError: pass
+
+class PackLock:
+    """Exclusive lock on {pack}.lock, held by a prerender job from reading the old pack to
+    committing the new one, so jobs for one NPC in different worker processes run one after
+    another and each starts from the pack the previous one committed."""
+    def __init__(self, path: str):
+        self.path = path + ".lock"
+        self._f = None
+
+    def try_acquire(self) -> bool:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        f = open(self.path, "a+b")
+        if fcntl is not None:
+            try: fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return False
+        self._f = f
+        return True
+
+    def release(self):
+        if self._f is not None:
+            self._f.close()  # drops the flock
+            self._f = None
+
+class VoicePacks:
+    """The packs of all NPCs under `root` ({root}/{npc_id}/lines.pack), opened on first use and
+    reopened when the file is replaced (a finished job, possibly in another worker)."""
+    def __init__(self, root: str):
+        self.root = root
+        self._open: Dict[int, Tuple[Tuple[int, int, int], Optional[VoicePack]]] = {}
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}  # path -> (mtime_ns, size, sha256) of its current file
+        self._lock = threading.Lock()
+
+    def path(self, npc_id: int) -> str:
+        return os.path.join(self.root, str(npc_id), PACK_NAME)
+
+    def get(self, npc_id: int) -> Optional[VoicePack]:
+        path = self.path(npc_id)
+        try: st = os.stat(path)
+        except OSError:
+            self._open.pop(npc_id, None)
+            return None
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = self._open.get(npc_id)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with self._lock:
+            try: pack = VoicePack(path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"[voice_pack] ignoring {path}: {e}")
+                pack = None  # remembered until the file changes, so it's reported once
+            self._open[npc_id] = (stamp, pack)  # the old map closes once no reader holds it
+            return pack
+
+    def voice_hash(self, path: str) -> str:
+        st = os.stat(path)
+        path = os.path.abspath(path)
+        memo = self._hashes.get(path)
+        if memo is not None and memo[:2] == (st.st_mtime_ns, st.st_size):
+            return memo[2]
+        digest = file_sha256(path)
+        self._hashes[path] = (st.st_mtime_ns, st.st_size, digest)  # a re-upload replaces the entry
+        return digest
+
+    def lookup(self, npc_id: int, speaker_wav: str, text: str, language: str) -> Optional[bytes]:
+        """The pre-rendered WAV for exactly this line, if the pack was rendered with this voice."""
+        pack = self.get(npc_id)
+        if pack is None or line_key(text, language) not in pack: return None
+        try:
+            if self.voice_hash(speaker_wav) != pack.voice_hash: return None
+        except OSError: return None
+        return pack.get(text, language)
+
+    def remove(self, npc_id: int):
+        self._open.pop(npc_id, None)
+        for path in (self.path(npc_id), self.path(npc_id) + ".lock"):
+            try: os.remove(path)
+            except OSError: pass
+        try: os.rmdir(os.path.dirname(self.path(npc_id)))  # only if nothing else (a saved voice) is left
+        except OSError: pass
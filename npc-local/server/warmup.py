@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: MIT
+# Copyright (c) 2025 <Reza Jari>
+# server/warmup.py — background model warm-up and per-component readiness
+import asyncio, os, time
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Union
+
+Step = Callable[[], Union[None, Awaitable[None]]]  # sync steps run in a thread, async ones on the loop
+
+def process_age_s() -> Optional[float]:
+    """Seconds since this process was exec'd (so interpreter start and imports are included)."""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])  # field 22, starttime
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Warmup:
+    """Loads components in parallel after startup and runs one dummy inference through each.
+
+    Each component has a `load` step (construct/download the model) and an optional `warm` step
+    (tiny inference so kernels, allocators and caches are primed before the first player talks).
+    State per component: pending -> loading -> warming -> ready | failed; components not listed in
+    `enabled` are "lazy" (loaded on first use) and don't gate readiness.
+    """
+    def __init__(self, components: Dict[str, Dict[str, Optional[Step]]], enabled: Iterable[str]):
+        enabled = set(enabled)
+        self._steps = components
+        self.state: Dict[str, Dict] = {
+            name: {"state": "pending" if name in enabled else "lazy"} for name in components}
+        self._t0 = time.monotonic()
+        age = process_age_s()
+        self._process_t0 = self._t0 - age if age is not None else self._t0
+        self.cold_start_s: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return all(c["state"] in ("ready", "lazy") for c in self.state.values())
+
+    async def run(self):
+        await asyncio.gather(*(self._run_one(name) for name, c in self.state.items() if c["state"] == "pending"))
+        self._check_ready()
+
+    async def _run_one(self, name: str):
+        c = self.state[name]
+        c["started_at_s"] = round(time.monotonic() - self._process_t0, 3)
+        try:
+            for phase, label in (("load", "loading"), ("warm", "warming")):
+                step = self._steps[name].get(phase)
+                if step is None: continue
+                c["state"] = label
+                t = time.monotonic()
+                if asyncio.iscoroutinefunction(step): await step()
+                else: await asyncio.get_running_loop().run_in_executor(None, step)
+                c[f"{phase}_s"] = round(time.monotonic() - t, 3)
+            c["state"] = "ready"
+        except Exception as e:
+            c["state"], c["error"] = "failed", f"{type(e).__name__}: {e}"
+            print(f"[warmup] {name} failed: {c['error']}")
+        c["ready_at_s"] = round(time.monotonic() - self._process_t0, 3)
+        self._check_ready()
+
+    def _check_ready(self):
+        if self.cold_start_s is None and self.ready:
+            self.cold_start_s = round(time.monotonic() - self._process_t0, 3)
+            print(f"[warmup] ready {self.cold_start_s:.2f}s after process start "
+                  + ", ".join(f"{n}={c['state']}" for n, c in self.state.items()))
+
+    def report(self) -> Dict:
+        return {"ready": self.ready, "uptime_s": round(time.monotonic() - self._process_t0, 3),
+                "cold_start_s": self.cold_start_s, "components": {n: dict(c) for n, c in self.state.items()}}